@@ -0,0 +1,83 @@
+"Updating the session after a trial and drawing the trials to come"
+from mouse2afc.data import Data
+from mouse2afc.data import RawData
+from mouse2afc.definitions.matrix_state import MatrixState
+
+from benchmarks.common import SEED
+from benchmarks.common import data_at_trial
+from benchmarks.common import recorded_trials
+from benchmarks.common import synthetic_session
+from benchmarks.common import task_parameters
+
+
+class UpdateSuite:
+    "`CustomData.update` of trial `i_trial`, after updating all the others"
+    params = [10, 400, 5000]
+    param_names = ['i_trial']
+    timeout = 300
+    # Updating the trial again would push it into the bias and performance
+    # trackers and the reward ledger a second time, so every update is
+    # timed on a session set up anew
+    number = 1
+
+    def setup(self, i_trial):
+        self.data = data_at_trial(recorded_trials(), i_trial)
+
+    def time_update(self, i_trial):
+        self.data.custom.update(i_trial)
+
+
+class AssignFutureTrialsSuite:
+    params = [1, 10, 100, 1000]
+    param_names = ['num_trials']
+
+    def setup(self, num_trials):
+        self.data = Data(None, task_parameters(), seed=SEED)
+
+    def time_assign_future_trials(self, num_trials):
+        self.data.custom.assign_future_trials(0, num_trials)
+
+
+OUTCOME_STATES = (
+    MatrixState.WaitForStimulus,
+    MatrixState.BrokeFixation,
+    MatrixState.EarlyWithdrawal,
+    MatrixState.WaitForChoice,
+    MatrixState.TimeoutMissedChoice,
+    MatrixState.WaitForReward,
+    MatrixState.WaitForPunish,
+    MatrixState.Reward,
+    MatrixState.Punishment,
+)
+RAW_DATA_TRIALS = 500
+
+
+class RawDataConversionSuite:
+    "Converting every trial to records and extracting its outcome"
+    # The trials are released once converted, so every conversion is timed
+    # on a session set up anew
+    number = 1
+
+    def setup(self):
+        self.session = synthetic_session(recorded_trials(), RAW_DATA_TRIALS)
+
+    def time_trial_states(self):
+        raw_data = RawData(self.session)
+        for i_trial in range(RAW_DATA_TRIALS):
+            states = raw_data.trial_states(i_trial)
+            for matrix_state in OUTCOME_STATES:
+                if states.visited(matrix_state):
+                    states.times(matrix_state)
+
+
+class RawDataSuite:
+    "Extracting the outcomes of the trials from their states"
+
+    def setup(self):
+        session = synthetic_session(recorded_trials(), RAW_DATA_TRIALS)
+        self.raw_data = RawData(session)
+        self.raw_data.states(RAW_DATA_TRIALS - 1)
+
+    def time_state_durations(self):
+        for matrix_state in OUTCOME_STATES:
+            self.raw_data.state_durations(matrix_state)
@@ -0,0 +1,32 @@
+"Building the state matrix of the next trial"
+from mouse2afc.data import Data
+from mouse2afc.definitions.experiment import ExperimentType
+from mouse2afc.state_matrix import StateMatrix
+from mouse2afc.state_matrix import StateMatrixCache
+
+from benchmarks.common import OfflineBpod
+from benchmarks.common import SEED
+from benchmarks.common import task_parameters
+
+
+class StateMatrixSuite:
+    params = [experiment_type.name for experiment_type in ExperimentType]
+    param_names = ['experiment_type']
+
+    def setup(self, experiment_type):
+        self.bpod = OfflineBpod()
+        self.task_parameters = task_parameters()
+        self.task_parameters.primary_experiment_type = \
+            ExperimentType[experiment_type]
+        self.data = Data(self.bpod.session, self.task_parameters, seed=SEED)
+        self.data.custom.assign_future_trials(0, 1)
+        self.data.custom.generate_next_trial(0)
+        self.cache = StateMatrixCache(self.bpod)
+        # Compiles the trial's template
+        self.cache.state_matrix(self.task_parameters, self.data, 0)
+
+    def time_state_matrix(self, experiment_type):
+        StateMatrix(self.bpod, self.task_parameters, self.data, 0)
+
+    def time_cached_state_matrix(self, experiment_type):
+        self.cache.state_matrix(self.task_parameters, self.data, 0)
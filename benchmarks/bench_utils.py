@@ -0,0 +1,13 @@
+"Helpers called while building the state matrix"
+from mouse2afc.utils import get_valve_times
+
+# Left and right valves of the default ports
+VALVES = [1, 3]
+
+
+class ValveTimesSuite:
+    params = [1, 2]
+    param_names = ['num_valves']
+
+    def time_get_valve_times(self, num_valves):
+        get_valve_times(3, VALVES[:num_valves])
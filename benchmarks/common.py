@@ -0,0 +1,95 @@
+"Offline fixtures shared by the benchmarks: no Bpod, no GUI"
+import functools
+
+from types import SimpleNamespace
+
+from mouse2afc.data import Data
+from mouse2afc.simulation import bpod_hardware
+from mouse2afc.simulation import EventOccurrence
+from mouse2afc.simulation import SimulatedTrial
+from mouse2afc.simulation import simulate
+from mouse2afc.simulation import StateOccurrence
+from mouse2afc.simulation import VirtualSession
+from mouse2afc.task_parameters import TaskParameters
+
+# Trials of the recorded session the synthetic sessions are cycled from
+RECORDED_TRIALS = 200
+SEED = 0
+
+
+class OfflineBpod:
+    "Just enough of a `Bpod` to build state matrices"
+    def __init__(self, session=None):
+        self.hardware = bpod_hardware()
+        self.session = session
+
+
+def task_parameters():
+    task_parameters = TaskParameters(open_gui=False).task_parameters
+    # Normalized by `CustomData.update` before trials past the easy ones are
+    # assigned
+    omega_prob = task_parameters.omega_table.columns.omega_prob
+    task_parameters.omega_table.columns.omega_prob = [
+        prob / sum(omega_prob) for prob in omega_prob]
+    return task_parameters
+
+
+def _recorded_trial(raw_data, i_trial, channels):
+    "Rebuilds trial `i_trial`, released once converted, from its records"
+    trial = SimulatedTrial(
+        SimpleNamespace(
+            state_names=raw_data.original_state_names_by_number(i_trial)),
+        raw_data.trial_start_timestamp(i_trial))
+    trial.states_occurrences = [
+        StateOccurrence(raw_data.state_name(state_id), start, end)
+        for state_id, start, end in raw_data.states(i_trial)[
+            ['state', 'start', 'end']].tolist()]
+    trial.events_occurrences = [
+        EventOccurrence(event_id, channels.get_event_name(event_id), time)
+        for event_id, time in raw_data.events(i_trial).tolist()]
+    trial.states = raw_data.original_state_data(i_trial)
+    trial.state_timestamps = raw_data.original_state_timestamps(i_trial)
+    trial.event_timestamps = raw_data.original_event_timestamps(i_trial)
+    return trial
+
+
+@functools.lru_cache(maxsize=None)
+def recorded_trials():
+    "The trials of a session simulated against the default mouse model"
+    raw_data = simulate(RECORDED_TRIALS, seed=SEED).raw_data
+    channels = bpod_hardware().channels
+    return [_recorded_trial(raw_data, i_trial, channels)
+            for i_trial in range(RECORDED_TRIALS)]
+
+
+def _copy_trial(trial):
+    copy = SimulatedTrial(trial.sma, trial.trial_start_timestamp)
+    copy.states_occurrences = list(trial.states_occurrences)
+    copy.events_occurrences = list(trial.events_occurrences)
+    copy.states = list(trial.states)
+    copy.state_timestamps = list(trial.state_timestamps)
+    copy.event_timestamps = list(trial.event_timestamps)
+    return copy
+
+
+def synthetic_session(trials, num_trials):
+    """A session of `num_trials` trials cycling through copies of the
+       recorded `trials`, as `RawData` releases the trials it converts"""
+    session = VirtualSession()
+    session.trials = [_copy_trial(trials[i % len(trials)])
+                      for i in range(num_trials)]
+    return session
+
+
+def data_at_trial(trials, i_trial, **overrides):
+    """Returns the `Data` of a session whose trials up to `i_trial`
+       (excluded) were updated, `i_trial` being done but not updated yet"""
+    session = synthetic_session(trials, i_trial + 1)
+    parameters = task_parameters()
+    parameters.update(overrides)
+    data = Data(session, parameters, seed=SEED)
+    data.custom.assign_future_trials(0, 1)
+    data.custom.generate_next_trial(0)
+    for i in range(i_trial):
+        data.custom.update(i)
+    return data
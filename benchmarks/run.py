@@ -0,0 +1,156 @@
+"""Runs the benchmarks without asv and compares them to stored baselines.
+
+    python -m benchmarks.run                 # Compare to baselines.json
+    python -m benchmarks.run --save          # Store new baselines
+    python -m benchmarks.run -b UpdateSuite  # Only the matching benchmarks
+
+The suites follow asv's conventions (`time_*` methods, `params`,
+`param_names`, `setup`, `number`), so `asv run` works on them as well. Baselines are
+only meaningful on the machine they were saved on: save them again on the
+rig PC before relying on the comparison there."""
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+import pkgutil
+import platform
+import re
+import sys
+import timeit
+
+import numpy as np
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# A benchmark slower than its baseline by more than this fraction fails
+DEFAULT_TOLERANCE = 0.5
+REPEAT = 10
+
+
+def _machine():
+    return {'machine': platform.node(), 'processor': platform.processor(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def _benchmarks():
+    "Yields the (name, class, method name) of every benchmark"
+    package = os.path.dirname(__file__)
+    for module_info in sorted(pkgutil.iter_modules([package]),
+                              key=lambda module_info: module_info.name):
+        if not module_info.name.startswith('bench_'):
+            continue
+        module = importlib.import_module(f'benchmarks.{module_info.name}')
+        for class_name, class_ in inspect.getmembers(module, inspect.isclass):
+            if class_.__module__ != module.__name__:
+                continue
+            for method_name in sorted(vars(class_)):
+                if method_name.startswith('time_'):
+                    yield (f'{module_info.name}.{class_name}.{method_name}',
+                           class_, method_name)
+
+
+def _params(class_):
+    params = getattr(class_, 'params', [])
+    if not params:
+        return [()]
+    # A single list of parameters or a list of lists, as in asv
+    if len(getattr(class_, 'param_names', [])) == 1:
+        params = [params]
+    return list(itertools.product(*params))
+
+
+def _time(class_, method_name, params):
+    """Returns the best time per call, in seconds, over `REPEAT` repeats.
+       As in asv, a suite with a `number` of calls per repeat is set up
+       again before every repeat, the others once for as many calls as take
+       0.2 s per repeat"""
+    number = getattr(class_, 'number', 0)
+    if not number:
+        suite = class_()
+        if hasattr(suite, 'setup'):
+            suite.setup(*params)
+        method = getattr(suite, method_name)
+        timer = timeit.Timer(lambda: method(*params))
+        number, _ = timer.autorange()
+        return min(timer.repeat(REPEAT, number)) / number
+    times = []
+    for _ in range(REPEAT):
+        suite = class_()
+        if hasattr(suite, 'setup'):
+            suite.setup(*params)
+        method = getattr(suite, method_name)
+        times.append(timeit.Timer(lambda: method(*params)).timeit(number))
+    return min(times) / number
+
+
+def run(pattern=None):
+    "Returns {benchmark name: seconds per call} of the matching benchmarks"
+    results = {}
+    for name, class_, method_name in _benchmarks():
+        for params in _params(class_):
+            full_name = name if not params else \
+                f'{name}({", ".join(map(repr, params))})'
+            if pattern and not re.search(pattern, full_name):
+                continue
+            results[full_name] = _time(class_, method_name, params)
+            print(f'{full_name:70} {results[full_name] * 1e6:12.1f} us',
+                  flush=True)
+    return results
+
+
+def compare(results, baselines, tolerance):
+    "Prints the ratios to the baselines, returns the regressed benchmarks"
+    regressions = []
+    for name, seconds in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f'{name:70} no baseline')
+            continue
+        ratio = seconds / baseline
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print(f'{name:70} {ratio:6.2f}x{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-b', '--bench', metavar='REGEX',
+                        help='only run the benchmarks matching REGEX')
+    parser.add_argument('--save', action='store_true',
+                        help=f'store the results in {BASELINES_FILE}')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='slowdown fraction over the baseline to fail')
+    args = parser.parse_args()
+
+    results = run(args.bench)
+    if args.save:
+        baselines = {'machine': _machine(), 'results': {}}
+        if os.path.exists(BASELINES_FILE):
+            with open(BASELINES_FILE) as baselines_file:
+                baselines['results'] = json.load(baselines_file)['results']
+        baselines['results'].update(results)
+        with open(BASELINES_FILE, 'w') as baselines_file:
+            json.dump(baselines, baselines_file, indent=1, sort_keys=True)
+        return 0
+    if not os.path.exists(BASELINES_FILE):
+        print('No baselines, run with --save first')
+        return 0
+    with open(BASELINES_FILE) as baselines_file:
+        baselines = json.load(baselines_file)
+    if baselines['machine'] != _machine():
+        print(f'The baselines were saved on another machine: '
+              f'{baselines["machine"]}')
+    print()
+    regressions = compare(results, baselines['results'], args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.tolerance:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
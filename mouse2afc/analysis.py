@@ -0,0 +1,191 @@
+"""Offline analysis of sessions: psychometric, vevaiometric and trial rate
+curves, the plots the `show_psyc_stim`, `show_vevaiometric` and
+`show_trial_rate` task parameters ask for.
+
+`load_trials` turns a session, either in memory (`Data` or `Trials`) or
+saved (a `SessionReader` or its path), into a dict of float arrays with NaN
+for the missing values, and `concatenate` joins many of them. The curves
+are computed from these arrays with NumPy binning, so a month of sessions
+is analysed without looping over the trials."""
+import logging
+
+import numpy as np
+
+from mouse2afc.session_file import SessionReader
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('stimulus_omega', 'DV', 'choice_left', 'choice_correct',
+           'catch_trial', 'feedback_time', 'early_withdrawal', 'rewarded')
+DEFAULT_PSYCHOMETRIC_BINS = 10
+DEFAULT_VEVAIOMETRIC_BINS = 8
+DEFAULT_VEVAIOMETRIC_MIN_WT = 0.5
+# Of the trial rate, in seconds
+DEFAULT_RATE_BIN = 60
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise AnalysisError(message)
+
+
+def _floats(masked):
+    return np.ma.asarray(masked).astype(float).filled(np.nan)
+
+
+def load_trials(session, num_trials=None):
+    """Returns {column: float array} of the `COLUMNS` and the
+       'trial_start_timestamp' of the first `num_trials` trials of
+       `session` (all the trials done if None). `session` is a `Data`, a
+       `Trials` (without timestamps then), a `SessionReader` or the path of
+       a session directory."""
+    if isinstance(session, str):
+        session = SessionReader(session)
+    if isinstance(session, SessionReader):
+        num_trials = session.num_trials if num_trials is None else num_trials
+        trials = {name: _floats(session.column(f'trials.{name}')[:num_trials])
+                  for name in COLUMNS}
+        trials['trial_start_timestamp'] = np.array(
+            session.column('raw.trial_start_timestamp')[:num_trials],
+            dtype=float)
+        return trials
+    raw_data = getattr(session, 'raw_data', None)
+    columns = session.custom.trials if raw_data is not None else session
+    if num_trials is None:
+        # Only set once a trial is done, the others are generated ahead
+        num_trials = len(columns.trial_number)
+    trials = {name: _floats(getattr(columns, name).masked(0, num_trials))
+              for name in COLUMNS}
+    if raw_data is None:
+        trials['trial_start_timestamp'] = np.full(num_trials, np.nan)
+    else:
+        trials['trial_start_timestamp'] = np.fromiter(
+            (raw_data.trial_start_timestamp(i_trial)
+             for i_trial in range(num_trials)), dtype=float,
+            count=num_trials)
+    return trials
+
+
+def concatenate(sessions):
+    """Joins the `load_trials` of several sessions, adding the 'session'
+       index of every trial"""
+    if not sessions:
+        error('No sessions to concatenate.')
+    trials = {name: np.concatenate([session[name] for session in sessions])
+              for name in sessions[0]}
+    trials['session'] = np.repeat(
+        np.arange(len(sessions)),
+        [len(session['choice_left']) for session in sessions])
+    return trials
+
+
+def _binned(x, edges):
+    "Returns the bin of every x in `edges`, -1 outside of them"
+    bins = np.digitize(x, edges[1:-1])
+    bins[~((x >= edges[0]) & (x <= edges[-1]))] = -1
+    return bins
+
+
+def _bin_means(bins, values, num_bins):
+    "Returns the counts and means (NaN if empty) of `values` per bin"
+    valid = bins >= 0
+    counts = np.bincount(bins[valid], minlength=num_bins)
+    sums = np.bincount(bins[valid], weights=values[valid],
+                       minlength=num_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sums / counts
+
+
+def psychometric(trials, by='DV', bins=DEFAULT_PSYCHOMETRIC_BINS):
+    """Returns the fraction of left choices as a function of `by`
+       ('DV' or 'stimulus_omega'): {'x': mean of `by` per bin, 'p_left',
+       'sem': its binomial standard error, 'n': choices per bin}. `bins` is
+       a number of equal bins over the range of `by`, the bin edges, or None
+       for one point per distinct value of `by`."""
+    if by not in ('DV', 'stimulus_omega'):
+        error(f"Psychometric curves are by 'DV' or 'stimulus_omega', not "
+              f"'{by}'.")
+    choice_left = trials['choice_left']
+    valid = ~np.isnan(choice_left) & ~np.isnan(trials[by])
+    x, choice_left = trials[by][valid], choice_left[valid]
+    if bins is None:
+        values, bins = np.unique(x, return_inverse=True)
+        num_bins = len(values)
+    else:
+        if np.ndim(bins) == 0:
+            low, high = (-1, 1) if by == 'DV' else (0, 1)
+            bins = np.linspace(low, high, bins + 1)
+        num_bins = len(bins) - 1
+        bins = _binned(x, np.asarray(bins, dtype=float))
+    counts, x_means = _bin_means(bins, x, num_bins)
+    _, p_left = _bin_means(bins, choice_left, num_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sem = np.sqrt(p_left * (1 - p_left) / counts)
+    return {'x': x_means, 'p_left': p_left, 'sem': sem, 'n': counts}
+
+
+def vevaiometric(trials, num_bins=DEFAULT_VEVAIOMETRIC_BINS,
+                 min_wt=DEFAULT_VEVAIOMETRIC_MIN_WT):
+    """Returns how long the animal waited for the feedback as a function of
+       the DV, on the correct catch trials and on the errors, counting only
+       the waits longer than `min_wt` seconds: {'x': DV bin centers,
+       'catch_wt' and 'error_wt': mean waiting times per bin, 'catch_n' and
+       'error_n': their counts}"""
+    feedback_time = trials['feedback_time']
+    waited = feedback_time > min_wt
+    correct_catch = waited & (trials['catch_trial'] == 1) & \
+        (trials['choice_correct'] == 1)
+    errors = waited & (trials['choice_correct'] == 0) & \
+        (trials['early_withdrawal'] != 1)
+    edges = np.linspace(-1, 1, num_bins + 1)
+    bins = _binned(trials['DV'], edges)
+    catch_n, catch_wt = _bin_means(
+        np.where(correct_catch, bins, -1), feedback_time, num_bins)
+    error_n, error_wt = _bin_means(
+        np.where(errors, bins, -1), feedback_time, num_bins)
+    return {'x': (edges[:-1] + edges[1:]) / 2, 'catch_wt': catch_wt,
+            'error_wt': error_wt, 'catch_n': catch_n, 'error_n': error_n}
+
+
+def trial_rate(trials, bin_size=DEFAULT_RATE_BIN):
+    """Returns the number of trials started per `bin_size` seconds since
+       the start of their session: {'time': start of every bin in seconds,
+       'trials': mean number of trials per session in the bin,
+       'cumulative': its running total}"""
+    times = trials['trial_start_timestamp']
+    sessions = trials.get('session', np.zeros(len(times), dtype=int))
+    valid = ~np.isnan(times)
+    if not valid.any():
+        error('No trial start timestamps, the trial rate needs the Data or '
+              'the saved session rather than its Trials.')
+    times, sessions = times[valid], sessions[valid]
+    # Trials are in order within a session, its first one starts it
+    starts = np.full(sessions.max() + 1, np.inf)
+    np.minimum.at(starts, sessions, times)
+    elapsed = times - starts[sessions]
+    num_bins = int(elapsed.max() // bin_size) + 1
+    counts = np.bincount((elapsed // bin_size).astype(int),
+                         minlength=num_bins)
+    counts = counts / len(np.unique(sessions))
+    return {'time': np.arange(num_bins) * bin_size, 'trials': counts,
+            'cumulative': np.cumsum(counts)}
+
+
+def analyze(trials, task_parameters):
+    """Returns the curves the `show_psyc_stim`, `show_vevaiometric` and
+       `show_trial_rate` task parameters enable, by name"""
+    curves = {}
+    if task_parameters.show_psyc_stim:
+        curves['psychometric'] = psychometric(trials)
+    if task_parameters.show_vevaiometric:
+        curves['vevaiometric'] = vevaiometric(
+            trials, task_parameters.vevaiometric_n_bin,
+            task_parameters.vevaiometric_min_wt)
+    if task_parameters.show_trial_rate and \
+            not np.isnan(trials['trial_start_timestamp']).all():
+        curves['trial_rate'] = trial_rate(trials)
+    return curves
@@ -0,0 +1,213 @@
+"""Sounds of the softcodes: the error white noise (`SoftCode 11`) and the
+beep (`SoftCode 12`) of the ITI and of the end of the minimum sampling.
+
+Waveforms are synthesized once, at the start of the session, into read-only
+float32 buffers cached by their parameters. Playing a sound only hands its
+buffer to a sink whose output stream was opened beforehand, so nothing is
+allocated during a trial and the onset latency is the stream's (at most one
+block more than `SoundDeviceSink.latency`)."""
+import functools
+import logging
+import math
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ERROR_NOISE_SOFTCODE = 11
+BEEP_SOFTCODE = 12
+DEFAULT_SAMPLE_RATE = 44100
+# Fraction of the full scale
+DEFAULT_AMPLITUDE = 0.5
+BEEP_FREQUENCY = 5000
+BEEP_DURATION = 0.01
+NOISE_DURATION = 0.5
+# Of the cosine onset and offset ramps, avoiding clicks
+RAMP_DURATION = 0.001
+
+_buffers = {}
+
+
+class AudioError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise AudioError(message)
+
+
+def _cached(kind, synthesize, *key):
+    buffer = _buffers.get((kind,) + key)
+    if buffer is None:
+        buffer = synthesize(*key).astype(np.float32)
+        buffer.flags.writeable = False
+        _buffers[(kind,) + key] = buffer
+    return buffer
+
+
+def _ramped(samples, sample_rate):
+    num_ramp = min(int(RAMP_DURATION * sample_rate), len(samples) // 2)
+    if num_ramp:
+        ramp = (1 - np.cos(np.linspace(0, math.pi, num_ramp))) / 2
+        samples[:num_ramp] *= ramp
+        samples[-num_ramp:] *= ramp[::-1]
+    return samples
+
+
+def _num_samples(duration, sample_rate):
+    if duration <= 0:
+        error(f'Sounds must last more than 0 s, not {duration} s.')
+    return int(round(duration * sample_rate))
+
+
+def _tone(duration, frequency, amplitude, sample_rate):
+    times = np.arange(_num_samples(duration, sample_rate)) / sample_rate
+    return _ramped(amplitude * np.sin(2 * math.pi * frequency * times),
+                   sample_rate)
+
+
+def _white_noise(duration, amplitude, sample_rate):
+    # Seeded, the same parameters always give the same noise
+    samples = np.random.default_rng(0).uniform(
+        -amplitude, amplitude, _num_samples(duration, sample_rate))
+    return _ramped(samples, sample_rate)
+
+
+def tone(duration, frequency, amplitude=DEFAULT_AMPLITUDE,
+         sample_rate=DEFAULT_SAMPLE_RATE):
+    "Returns the cached buffer of a pure tone"
+    return _cached('tone', _tone, duration, frequency, amplitude, sample_rate)
+
+
+def white_noise(duration, amplitude=DEFAULT_AMPLITUDE,
+                sample_rate=DEFAULT_SAMPLE_RATE):
+    "Returns the cached buffer of a white noise"
+    return _cached('white_noise', _white_noise, duration, amplitude,
+                   sample_rate)
+
+
+def default_sounds(sample_rate=DEFAULT_SAMPLE_RATE):
+    "Returns {softcode: buffer} of the protocol's sounds"
+    return {
+        ERROR_NOISE_SOFTCODE: white_noise(NOISE_DURATION,
+                                          sample_rate=sample_rate),
+        BEEP_SOFTCODE: tone(BEEP_DURATION, BEEP_FREQUENCY,
+                            sample_rate=sample_rate),
+    }
+
+
+class NullSink:
+    """Plays nothing, records when each buffer would have started instead,
+       as (`clock()`, buffer) in `played`"""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, clock=time.time):
+        self.sample_rate = sample_rate
+        self._clock = clock
+        self.played = []
+
+    def open(self):
+        pass
+
+    def play(self, buffer):
+        self.played.append((self._clock(), buffer))
+
+    def close(self):
+        pass
+
+
+class SoundDeviceSink:
+    """Plays buffers on a mono output stream of the `sounddevice` package,
+       opened for the whole session. `play` only hands the buffer to the
+       stream's callback, which starts it at its next block. A sound
+       interrupts the one playing."""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, device=None,
+                 latency='low', blocksize=0):
+        self.sample_rate = sample_rate
+        self._device = device
+        self._latency = latency
+        self._blocksize = blocksize
+        self._stream = None
+        # Set by `play`, taken by the callback when `_requests` changes
+        self._next_buffer = None
+        self._requests = 0
+        self._started = 0
+        self._buffer = None
+        self._position = 0
+
+    @property
+    def latency(self):
+        "The output latency of the open stream, in seconds"
+        return None if self._stream is None else self._stream.latency
+
+    def open(self):
+        try:
+            import sounddevice
+        except ImportError:
+            error('Playing sounds requires the sounddevice package.')
+        self._stream = sounddevice.OutputStream(
+            samplerate=self.sample_rate, device=self._device, channels=1,
+            dtype='float32', latency=self._latency,
+            blocksize=self._blocksize, callback=self._callback)
+        self._stream.start()
+        logger.info(f'Audio output latency: {self._stream.latency} s')
+
+    def play(self, buffer):
+        self._next_buffer = buffer
+        self._requests += 1
+
+    def _callback(self, outdata, frames, _time, status):
+        if status:
+            logger.warning(f'Audio stream: {status}')
+        requests = self._requests
+        if requests != self._started:
+            self._started = requests
+            self._buffer = self._next_buffer
+            self._position = 0
+        if self._buffer is None:
+            outdata.fill(0)
+            return
+        chunk = self._buffer[self._position:self._position + frames]
+        outdata[:len(chunk), 0] = chunk
+        outdata[len(chunk):] = 0
+        self._position += frames
+        if self._position >= len(self._buffer):
+            self._buffer = None
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+
+
+class AudioPlayer:
+    """Plays `sounds` ({softcode: buffer}, `default_sounds` at the sink's
+       sample rate if None) through `sink` when their softcode is received"""
+
+    def __init__(self, sink, sounds=None):
+        self._sink = sink
+        self._sounds = sounds if sounds is not None else \
+            default_sounds(sink.sample_rate)
+
+    @property
+    def sounds(self):
+        return dict(self._sounds)
+
+    def register(self, softcodes):
+        """Registers the sounds in the `SoftcodeDispatcher` `softcodes`,
+           inline: playing is only handing a buffer to the sink"""
+        for softcode in self._sounds:
+            softcodes.register(
+                softcode, functools.partial(self.play, softcode), inline=True)
+
+    def play(self, softcode):
+        self._sink.play(self._sounds[softcode])
+
+    def open(self):
+        self._sink.open()
+
+    def close(self):
+        self._sink.close()
@@ -0,0 +1,215 @@
+"""Liquid calibration of the valves: how long to open a valve to deliver an
+amount of water, and how much a valve open for some time delivered.
+
+Every valve's calibration is validated and fitted once, when loaded, and
+the open times looked up are cached, as the same few reward amounts are
+looked up every trial."""
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Of the polynomials fitted to the valves without coefficients
+FIT_DEGREE = 2
+MIN_MEASUREMENTS = 2
+
+
+class CalibrationError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise CalibrationError(message)
+
+
+class LiquidCalClass:
+    def __init__(self, table, coeffs):
+        self.table = table
+        self.coeffs = coeffs
+
+
+class CalibrationTables:
+    "Default calibration of the valves, rows are [open time in ms, ul]"
+    DEFAULT_TABLES = [
+        [
+            [15.0000, 0],
+            [20.0000, 0.1700],
+            [50.0000, 1.3500],
+            [50.0000, 1.3100],
+            [30.0000, 0.5500],
+            [75.0000, 2.6350],
+            [100.0000, 3.8200],
+            [150.0000, 6.5900],
+        ],
+        [
+            [10.0000, 0],
+            [20.0000, 0.2050],
+            [50.0000, 1.1800],
+            [50.0000, 1.0850],
+            [30.0000, 0.4600],
+            [75.0000, 2.2000],
+            [100.0000, 3.3600],
+            [150.0000, 5.6300],
+        ],
+        [
+            [10.0000, 0],
+            [20.0000, 0.4900],
+            [50.0000, 1.5200],
+            [50.0000, 1.2950],
+            [30.0000, 0.6200],
+            [75.0000, 2.7750],
+            [100.0000, 4.1800],
+            [150.0000, 6.6500],
+        ],
+        [], [], [], [], []
+    ]
+    COEFFS = [
+        [0.6847, 24.7278, 16.3721],
+        [1.1799, 30.5735, 14.1329],
+        [0.6150, 24.5236, 12.5769],
+        [0], [0], [0], [0], [0]
+    ]
+
+    LiquidCal = [LiquidCalClass(table, coeffs)
+                 for table, coeffs in zip(DEFAULT_TABLES, COEFFS)]
+
+
+class LiquidCalibration:
+    """The calibration of the valves in `tables`, {valve number: rows of
+       [open time in ms, amount in ul]}. `coeffs`, {valve number: polynomial
+       coefficients of the open time in ms as a function of the amount}, is
+       used when given, the others are fitted to the table. A valve without
+       enough measurements can't be looked up."""
+
+    def __init__(self, tables, coeffs=None):
+        coeffs = coeffs or {}
+        self._tables = {}
+        self._coeffs = {}
+        self._invalid = {}
+        for valve, table in tables.items():
+            self._tables[valve] = [list(row) for row in table]
+            if len(table) < MIN_MEASUREMENTS:
+                self._invalid[valve] = (
+                    f'Not enough liquid calibration measurements exist for '
+                    f'valve {valve}. Bpod needs at least {MIN_MEASUREMENTS} '
+                    f'measurements.')
+                continue
+            table = np.array(table, dtype=float)
+            if coeffs.get(valve) is not None:
+                valve_coeffs = np.array(coeffs[valve], dtype=float)
+            else:
+                valve_coeffs = np.polyfit(table[:, 1], table[:, 0],
+                                          FIT_DEGREE)
+            # Open times must grow with the amount for the inverse to exist
+            amounts = np.linspace(0, table[:, 1].max(), 100)
+            if np.any(np.polyval(np.polyder(valve_coeffs), amounts) < 0):
+                error(f'Wrong liquid calibration for valve {valve}. The open '
+                      f'time decreases with the amount.')
+            self._coeffs[valve] = valve_coeffs
+        self._valve_times = {}
+
+    @classmethod
+    def from_tables(cls, calibration_tables=CalibrationTables):
+        "The calibration of the `CalibrationTables` class constants"
+        return cls(
+            {valve: liquid_cal.table for valve, liquid_cal in enumerate(
+                calibration_tables.LiquidCal, start=1)},
+            {valve: liquid_cal.coeffs for valve, liquid_cal in enumerate(
+                calibration_tables.LiquidCal, start=1)})
+
+    @classmethod
+    def load(cls, file_):
+        """Loads the json file `file_`, {"valves": {valve number: {"table":
+           rows, "coeffs": coefficients or missing}}}"""
+        try:
+            with open(file_) as json_file:
+                valves = json.load(json_file)['valves']
+        except (OSError, ValueError, KeyError) as exception:
+            error(f'Could not read the liquid calibration {file_}: '
+                  f'{exception}')
+        return cls({int(valve): calibration['table']
+                    for valve, calibration in valves.items()},
+                   {int(valve): calibration.get('coeffs')
+                    for valve, calibration in valves.items()})
+
+    def save(self, file_):
+        valves = {}
+        for valve, table in self._tables.items():
+            valves[str(valve)] = {'table': table}
+            if valve in self._coeffs:
+                valves[str(valve)]['coeffs'] = self._coeffs[valve].tolist()
+        with open(file_, 'w') as json_file:
+            json.dump({'valves': valves}, json_file, indent=1)
+
+    @property
+    def valves(self):
+        "The valves that can be looked up"
+        return sorted(self._coeffs)
+
+    def coeffs(self, valve):
+        self._check(valve)
+        return self._coeffs[valve].copy()
+
+    def _check(self, valve):
+        if valve in self._invalid:
+            error(self._invalid[valve])
+        if valve not in self._coeffs:
+            error(f'No liquid calibration for valve {valve}.')
+
+    def valve_time(self, amount, valve):
+        "Returns how long, in seconds, to open `valve` to deliver `amount` ul"
+        valve_time = self._valve_times.get((valve, amount))
+        if valve_time is None:
+            valve_time = float(self.valve_times(amount, valve))
+            self._valve_times[(valve, amount)] = valve_time
+        return valve_time
+
+    def valve_times(self, amounts, valve):
+        "Vectorized `valve_time`, not cached"
+        self._check(valve)
+        valve_times = np.polyval(self._coeffs[valve],
+                                 np.asarray(amounts, dtype=float))
+        if np.any(valve_times < 0):
+            error(f'Wrong liquid calibration for valve {valve}. Negative open '
+                  f'time.')
+        return valve_times / 1000
+
+    def amounts(self, valve_times, valve):
+        """Returns the amounts, in ul, delivered by `valve` open for
+           `valve_times` seconds, 0 for the times too short to deliver any"""
+        self._check(valve)
+        coeffs = np.trim_zeros(self._coeffs[valve], 'f')
+        times_ms = np.asarray(valve_times, dtype=float) * 1000
+        if len(coeffs) == 2:
+            amounts = (times_ms - coeffs[1]) / coeffs[0]
+        elif len(coeffs) == 3:
+            p2, p1, p0 = coeffs
+            amounts = (-p1 + np.sqrt(
+                np.maximum(p1 ** 2 - 4 * p2 * (p0 - times_ms), 0))) / (2 * p2)
+        else:
+            amounts = np.vectorize(
+                lambda time_ms: _smallest_root(coeffs, time_ms))(times_ms)
+        return np.maximum(amounts, 0)
+
+
+def _smallest_root(coeffs, value):
+    "Returns the smallest non-negative real x where polyval(coeffs, x) = value"
+    coeffs = coeffs.copy()
+    coeffs[-1] -= value
+    roots = [root.real for root in np.roots(coeffs)
+             if abs(root.imag) < 1e-9 and root.real >= 0]
+    return min(roots) if roots else 0.
+
+
+_default = None
+
+
+def default_calibration():
+    "The calibration of the `CalibrationTables`, built on first use"
+    global _default
+    if _default is None:
+        _default = LiquidCalibration.from_tables()
+    return _default
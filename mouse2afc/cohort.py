@@ -0,0 +1,186 @@
+"""Columns of many saved sessions at once, for cohort analyses.
+
+A `Cohort` indexes session directories written by `SessionWriter` by
+subject and start time, reading only their schema and index files. Columns
+are then read from the memory-mapped column files of the selected sessions
+only, and of the selected trials only when `where` names a boolean column,
+e.g. the catch trials' `feedback_time` of one subject over three months:
+
+    cohort = Cohort.find('/data')
+    columns = cohort.columns(['trials.feedback_time'], subjects=['m12'],
+                             start=start, end=end,
+                             where='trials.catch_trial')
+
+touches the `catch_trial` column and the pages of `feedback_time` holding
+catch trials of that subject's sessions, and nothing else. The sessions
+are never loaded as `Data`."""
+import logging
+import os
+
+import numpy as np
+
+from mouse2afc.analysis import COLUMNS
+from mouse2afc.session_file import SessionReader
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA_FILE = 'schema.json'
+
+INDEX = np.dtype([
+    ('subject', '<i4'),
+    ('start_time', '<f8'),
+    ('num_trials', '<i8'),
+    # Of the session's first trial among all the trials of the cohort
+    ('first_trial', '<i8'),
+])
+
+
+class CohortError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise CohortError(message)
+
+
+def _subject(path, metadata):
+    "The subject in the session's metadata, else its parent directory"
+    subject = metadata.get('subject')
+    if subject is None:
+        subject = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return str(subject)
+
+
+class Cohort:
+    """The sessions saved in the directories `paths`, sorted by subject
+       then start time. Their subjects are `subjects` if given, else the
+       'subject' of their metadata, else the name of the directory holding
+       them."""
+
+    def __init__(self, paths, subjects=None):
+        if not paths:
+            error('No sessions in the cohort.')
+        if subjects is not None and len(subjects) != len(paths):
+            error(f'{len(subjects)} subjects for {len(paths)} sessions.')
+        readers = []
+        for path in paths:
+            if not os.path.exists(os.path.join(path, _SCHEMA_FILE)):
+                error(f'{path} holds no session.')
+            readers.append(SessionReader(path))
+        session_subjects = [
+            str(subjects[i]) if subjects is not None
+            else _subject(path, reader.metadata)
+            for i, (path, reader) in enumerate(zip(paths, readers))]
+        start_times = [reader.metadata.get('start_time', np.nan)
+                       for reader in readers]
+        order = sorted(range(len(paths)), key=lambda i: (
+            session_subjects[i], start_times[i], paths[i]))
+        self._paths = [paths[i] for i in order]
+        self._readers = [readers[i] for i in order]
+        self._subjects = sorted(set(session_subjects))
+        self._index = np.zeros(len(paths), dtype=INDEX)
+        self._index['subject'] = [
+            self._subjects.index(session_subjects[i]) for i in order]
+        self._index['start_time'] = [start_times[i] for i in order]
+        self._index['num_trials'] = [reader.num_trials
+                                     for reader in self._readers]
+        self._index['first_trial'][1:] = np.cumsum(
+            self._index['num_trials'])[:-1]
+
+    @classmethod
+    def find(cls, root):
+        "The cohort of all the sessions saved under the directory `root`"
+        paths = sorted(directory for directory, _, files in os.walk(root)
+                       if _SCHEMA_FILE in files)
+        if not paths:
+            error(f'No sessions under {root}.')
+        return cls(paths)
+
+    @property
+    def subjects(self):
+        return list(self._subjects)
+
+    @property
+    def paths(self):
+        "The session directories, in the order of `index`"
+        return list(self._paths)
+
+    @property
+    def index(self):
+        """The `INDEX` of every session, sorted by subject then start time,
+           its subject as an index in `subjects`"""
+        return self._index.copy()
+
+    @property
+    def num_trials(self):
+        return int(self._index['num_trials'].sum())
+
+    def reader(self, session):
+        "The `SessionReader` of the `session`th session of `index`"
+        return self._readers[session]
+
+    def sessions(self, subjects=None, start=None, end=None):
+        """Returns the indices of the sessions of `subjects` (all if None)
+           started from `start` up to `end`, in seconds since the epoch"""
+        selected = np.ones(len(self._index), dtype=bool)
+        if subjects is not None:
+            unknown = set(subjects) - set(self._subjects)
+            if unknown:
+                error(f'No sessions of the subjects {sorted(unknown)}.')
+            selected &= np.isin(self._index['subject'], [
+                self._subjects.index(subject) for subject in subjects])
+        if start is not None:
+            selected &= self._index['start_time'] >= start
+        if end is not None:
+            selected &= self._index['start_time'] < end
+        return np.flatnonzero(selected)
+
+    def columns(self, names, subjects=None, start=None, end=None,
+                where=None, sessions=None):
+        """Returns {name: masked array} of the columns `names` (e.g.
+           'trials.feedback_time') over the trials of the selected sessions
+           (see `sessions()`, or the indices `sessions` if given), along
+           with the 'session' and 'trial' in its session of every trial.
+           Only the trials where the boolean column `where` is True are
+           read if given."""
+        if sessions is None:
+            sessions = self.sessions(subjects, start, end)
+        parts = {name: [] for name in names}
+        parts['session'] = []
+        parts['trial'] = []
+        for session in sessions:
+            reader = self._readers[session]
+            if where is None:
+                trials = slice(None)
+                trial_numbers = np.arange(reader.num_trials)
+            else:
+                condition = reader.column(where)
+                trial_numbers = np.flatnonzero(
+                    condition.filled(False) if np.ma.isMaskedArray(
+                        condition) else condition)
+                trials = trial_numbers
+            for name in names:
+                parts[name].append(reader.column(name)[trials])
+            parts['session'].append(np.full(len(trial_numbers), session))
+            parts['trial'].append(trial_numbers)
+        columns = {name: np.ma.concatenate(parts[name]) if parts[name]
+                   else np.ma.masked_array([]) for name in names}
+        for name in ('session', 'trial'):
+            columns[name] = np.concatenate(parts[name]) if parts[name] \
+                else np.empty(0, dtype=int)
+        return columns
+
+    def trials(self, subjects=None, start=None, end=None, sessions=None):
+        """Returns the trials of the selected sessions as `analysis`
+           expects them (see `analysis.load_trials`), the 'session' being an
+           index in `index`"""
+        names = [f'trials.{name}' for name in COLUMNS] + [
+            'raw.trial_start_timestamp']
+        columns = self.columns(names, subjects, start, end,
+                               sessions=sessions)
+        trials = {name.split('.')[-1]: np.ma.asarray(
+                      columns[name]).astype(float).filled(np.nan)
+                  for name in names}
+        trials['session'] = columns['session']
+        return trials
@@ -0,0 +1,140 @@
+"Growable NumPy-backed columns used to store per-trial data"
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 800
+
+
+class ColumnError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise ColumnError(message)
+
+
+class Column:
+    """A typed, growable array of per-trial values.
+
+       Behaves like the preallocated lists it replaces: `column[i]` returns a
+       python value (or None for masked/unset entries) and `column[i] = value`
+       stores it, growing the underlying arrays by doubling when `i` is past
+       the current capacity. `column[start:stop] = values` stores a whole
+       batch at once. The NumPy arrays themselves are exposed through
+       `values`, `mask` and `masked()` as views, so no copies are made when
+       slicing whole columns."""
+
+    def __init__(self, dtype, fill=None, width=None, capacity=DEFAULT_CAPACITY):
+        self._dtype = np.dtype(dtype)
+        self._fill = fill
+        self._shape = () if width is None else (width,)
+        self._values = np.zeros((capacity,) + self._shape, dtype=self._dtype)
+        self._mask = np.zeros(capacity, dtype=bool)
+        self._len = 0
+        self._reset(0, capacity)
+
+    def _reset(self, start, stop):
+        if self._fill is None:
+            self._mask[start:stop] = True
+        else:
+            self._values[start:stop] = self._fill
+
+    def _grow(self, index):
+        capacity = len(self._mask)
+        new_capacity = max(capacity * 2, index + 1)
+        values = np.zeros((new_capacity,) + self._shape, dtype=self._dtype)
+        values[:capacity] = self._values
+        mask = np.zeros(new_capacity, dtype=bool)
+        mask[:capacity] = self._mask
+        self._values = values
+        self._mask = mask
+        self._reset(capacity, new_capacity)
+
+    def _index(self, index):
+        if index < 0:
+            index += self._len
+            if index < 0:
+                raise IndexError('Column index out of range')
+        return index
+
+    def _get(self, index):
+        index = self._index(index)
+        if index >= len(self._mask):
+            return self._fill
+        if self._mask[index]:
+            return None
+        value = self._values[index]
+        return value.tolist() if self._shape else value.item()
+
+    def _coerce(self, value):
+        value = np.asarray(value, dtype=self._dtype)
+        if value.shape == self._shape:
+            return value
+        if not self._shape and value.size == 1:
+            return value.reshape(())
+        if not self._shape and value.size == 0:
+            return None
+        error(f'Cannot store value of shape {value.shape} in a column of '
+              f'shape {self._shape}.')
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._get(i) for i in range(*key.indices(self._len))]
+        return self._get(key)
+
+    def _set_slice(self, key, values):
+        if key.step not in (None, 1) or key.start is None or key.stop is None:
+            error('Only [start:stop] slices of a column can be assigned.')
+        start, stop = self._index(key.start), self._index(key.stop)
+        if stop <= start:
+            return
+        if stop > len(self._mask):
+            self._grow(stop - 1)
+        self._values[start:stop] = np.asarray(values, dtype=self._dtype)
+        self._mask[start:stop] = False
+        self._len = max(self._len, stop)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._set_slice(index, value)
+            return
+        index = self._index(index)
+        if index >= len(self._mask):
+            self._grow(index)
+        if value is not None:
+            value = self._coerce(value)
+        if value is None:
+            self._mask[index] = True
+        else:
+            self._values[index] = value
+            self._mask[index] = False
+        self._len = max(self._len, index + 1)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return (self._get(i) for i in range(self._len))
+
+    @property
+    def values(self):
+        "A view of the stored values, masked entries hold arbitrary data"
+        return self._values[:self._len]
+
+    @property
+    def mask(self):
+        "A view of the mask, True where the value is None"
+        return self._mask[:self._len]
+
+    def masked(self, start=None, stop=None):
+        "Returns a `numpy.ma.MaskedArray` view over [start, stop)"
+        start, stop, _ = slice(start, stop).indices(self._len)
+        mask = self._mask[start:stop]
+        if self._shape:
+            mask = np.repeat(mask[:, np.newaxis], self._shape[0], axis=1)
+        return np.ma.MaskedArray(self._values[start:stop], mask=mask,
+                                 copy=False)
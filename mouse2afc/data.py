@@ -1,10 +1,22 @@
 import logging
+import math
 import time
 
 from collections import OrderedDict
+from contextlib import contextmanager
 
 from numpy import arange
+from numpy import array
+from numpy import clip
+from numpy import count_nonzero
+from numpy import dtype
+from numpy import ediff1d
+from numpy import empty
+from numpy import repeat
+from numpy import where
 
+from mouse2afc.calibration import default_calibration
+from mouse2afc.columns import Column
 from mouse2afc.definitions.constant import Constant as Const
 from mouse2afc.definitions.experiment import ExperimentType
 from mouse2afc.definitions.matrix_state import MatrixState
@@ -12,27 +24,28 @@ from mouse2afc.definitions.feedback_delay_selection import FeedbackDelaySelectio
 from mouse2afc.definitions.min_sample_type import MinSampleType
 from mouse2afc.definitions.stimulus_selection_criteria \
     import StimulusSelectionCriteria
-from  mouse2afc.utils import betarnd
+from mouse2afc.latency import PhaseLatencies
+from mouse2afc.rng import SessionRNG
+from mouse2afc.running_stats import BiasTracker
+from mouse2afc.running_stats import PerformanceTracker
+from mouse2afc.running_stats import RewardLedger
 from  mouse2afc.utils import iff
-from  mouse2afc.utils import rand
-from  mouse2afc.utils import randi
-from  mouse2afc.utils import randsample
 from  mouse2afc.utils import round
 from  mouse2afc.utils import floor
-from  mouse2afc.utils import random_unif
 from  mouse2afc.utils import diff
 from  mouse2afc.utils import get_catch_stim_idx
+from  mouse2afc.utils import get_ports
 from  mouse2afc.utils import truncated_exponential
 from  mouse2afc.utils import calc_aud_click_train
 from  mouse2afc.utils import calc_light_intensity
 from  mouse2afc.utils import calc_grating_orientation
 from  mouse2afc.utils import calc_dots_coherence
 from  mouse2afc.utils import controlled_random
-from  mouse2afc.utils import isnan
 
 logger = logging.getLogger(__name__)
 
-NUM_OF_TRIALS = 800 #This can be changed. 800 is arbitrary
+# Initial capacity of the per-trial columns, they grow as needed
+NUM_OF_TRIALS = 800
 
 def error(message):
     logger.error(message)
@@ -47,107 +60,417 @@ def datalist(value=0, size=NUM_OF_TRIALS):
     return [value] * size
 
 
+def datacolumn(dtype, fill=None, width=None):
+    return Column(dtype, fill, width=width, capacity=NUM_OF_TRIALS)
+
+
 class DataError(Exception):
     pass
 
 
+# Compact records of the states and events of the trials. States are
+# identified by their `MatrixState` value, the states that aren't one by
+# negative ids.
+STATE_RECORD = dtype([
+    ('state', '<i2'),
+    ('start', '<f8'),
+    ('end', '<f8'),
+    # Whether the state has a valid host timestamp
+    ('visited', '?'),
+])
+EVENT_RECORD = dtype([
+    ('event', '<i2'),
+    ('time', '<f8'),
+])
+
+
+class TrialStates:
+    """Index of the states of a single trial: the visit intervals of every
+       `MatrixState` as an (n, 2) array of (start, end) times and the states
+       that were visited (i.e. have a valid host timestamp)"""
+    __slots__ = ('_intervals', '_visited')
+
+    _NO_INTERVALS = empty((0, 2))
+    _NO_INTERVALS.flags.writeable = False
+
+    def __init__(self, intervals, visited):
+        """`intervals` are the {state id: [(start, end)]} of the trial,
+           `visited` the ids of the states visited"""
+        self._intervals = intervals
+        self._visited = visited
+
+    @classmethod
+    def from_records(cls, states):
+        "The index of the `STATE_RECORD`s `states`"
+        intervals = {}
+        for state_id, start, end in states[['state', 'start', 'end']].tolist():
+            intervals.setdefault(state_id, []).append((start, end))
+        return cls(intervals,
+                   frozenset(states['state'][states['visited']].tolist()))
+
+    def visited(self, matrix_state):
+        return matrix_state.value in self._visited
+
+    def times(self, matrix_state):
+        times = self._intervals.get(matrix_state.value)
+        if times is None:
+            return self._NO_INTERVALS
+        # Only the states that are looked up are converted
+        if isinstance(times, list):
+            times = self._intervals[matrix_state.value] = array(
+                times, dtype=float)
+        return times
+
+
+class _TrialRecords:
+    """Records of every trial appended to one array, along with the end of
+       each trial's records in it. The records of the trials appended since
+       the last `flush()` are pending, to store them in one go"""
+
+    def __init__(self, record_dtype, capacity):
+        self._dtype = record_dtype
+        self._records = Column(record_dtype, capacity=capacity)
+        self._offsets = datacolumn(int, 0)
+        self._pending = []
+        self._pending_offsets = []
+
+    @property
+    def num_pending(self):
+        "The number of trials pending"
+        return len(self._pending_offsets)
+
+    def append(self, records):
+        "Appends the records of the next trial"
+        self._pending.extend(records)
+        self._pending_offsets.append(len(self._records) + len(self._pending))
+
+    def flush(self):
+        "Stores the pending records in the array"
+        if not self._pending_offsets:
+            return
+        for column, records, record_dtype in (
+                (self._records, self._pending, self._dtype),
+                (self._offsets, self._pending_offsets, int)):
+            column[len(column):len(column) + len(records)] = array(
+                records, dtype=record_dtype)
+            records.clear()
+
+    @property
+    def values(self):
+        "The records stored, of all the trials but the pending ones"
+        return self._records.values
+
+    @property
+    def offsets(self):
+        "The end of the records of every trial stored"
+        return self._offsets.values
+
+    def trial(self, trial_num):
+        "The records of trial `trial_num`, which is stored"
+        start = self._offsets[trial_num - 1] if trial_num else 0
+        return self._records.values[start:self._offsets[trial_num]]
+
+
+# The messages of pybpod's session history that are only the states and
+# events of a trial
+_OCCURRENCE_MESSAGES = frozenset(('STATE', 'EVENT', 'EVENT-SUMMARY'))
+
+
 class RawData:
+    """The states and events of the trials of `session`. Every finished
+       trial is converted once, when first looked up, from pybpod's objects
+       to compact `STATE_RECORD`s and `EVENT_RECORD`s appended to arrays of
+       the whole session, which `states()`, `events()` and
+       `state_durations()` query across trials without any python loop.
+       Once converted, the trial is released: pybpod's occurrences of its
+       states and events are dropped from the trial and from the session's
+       history, as is its state machine, and the `original_*()` accessors
+       read the records instead. A trial then costs 19 bytes per state
+       occurrence and 10 per event, along with its path through the states,
+       instead of a few hundred bytes per occurrence."""
+    # Trials are only indexed once they are done, so there is no need to
+    # keep more than the last few around
+    _TRIAL_STATES_CACHE_SIZE = 16
+    # Trials whose records are pending before they are stored anyway
+    _MAX_PENDING = 32
+
     def __init__(self, session):
         self._session = session
         self.state_machine_error_codes = {}
+        self._trial_states = OrderedDict()
+        self._state_ids = {matrix_state.name: matrix_state.value
+                           for matrix_state in MatrixState}
+        self._state_names = {value: name
+                             for name, value in self._state_ids.items()}
+        self._states = _TrialRecords(STATE_RECORD, NUM_OF_TRIALS * 16)
+        self._events = _TrialRecords(EVENT_RECORD, NUM_OF_TRIALS * 16)
+        # The numbers of the states the trials went through, and the times
+        # they did, as pybpod's `Trial.states` and `Trial.state_timestamps`
+        self._paths = _TrialRecords('<i2', NUM_OF_TRIALS * 8)
+        self._path_timestamps = _TrialRecords('<f8', NUM_OF_TRIALS * 8)
+        self._trial_start_timestamps = datacolumn(float)
+        # The state names of every trial's state machine, shared by the
+        # trials whose state machines have the same states
+        self._state_name_tables = []
+        self._interned_state_names = {}
+        self._num_converted = 0
+        # Messages of the session's history before which the occurrences of
+        # the released trials were dropped
+        self._history_start = 0
+
+    @property
+    def num_converted(self):
+        "The number of trials converted, they are converted in order"
+        return self._num_converted
+
+    def _state_id(self, state_name):
+        state_id = self._state_ids.get(state_name)
+        if state_id is None:
+            state_id = self._state_ids[state_name] = \
+                -1 - (len(self._state_ids) - len(MatrixState))
+            self._state_names[state_id] = state_name
+        return state_id
+
+    def _convert(self, trial_num):
+        """Converts the trials up to `trial_num` included, all finished,
+           indexing their states on the way, and releases them"""
+        state_ids = self._state_ids
+        for i_trial in range(self._num_converted, trial_num + 1):
+            trial = self._session.trials[i_trial]
+            intervals = {}
+            visited = set()
+            states = []
+            for state in trial.states_occurrences:
+                state_id = state_ids.get(state.state_name)
+                if state_id is None:
+                    state_id = self._state_id(state.state_name)
+                end = math.nan if state.end_timestamp is None \
+                    else state.end_timestamp
+                is_visited = not math.isnan(state.host_timestamp)
+                states.append((state_id, state.start_timestamp, end,
+                               is_visited))
+                times = intervals.get(state_id)
+                if times is None:
+                    times = intervals[state_id] = []
+                times.append((state.start_timestamp, end))
+                if is_visited:
+                    visited.add(state_id)
+            self._cache_trial_states(
+                i_trial, TrialStates(intervals, frozenset(visited)))
+            self._states.append(states)
+            self._events.append((event.event_id, event.host_timestamp)
+                                for event in trial.events_occurrences)
+            self._paths.append(trial.states)
+            self._path_timestamps.append(trial.state_timestamps)
+            self._trial_start_timestamps[i_trial] = \
+                trial.trial_start_timestamp
+            state_names = tuple(trial.sma.state_names)
+            self._state_name_tables.append(
+                self._interned_state_names.setdefault(state_names,
+                                                      state_names))
+            self._release(trial)
+            self._num_converted += 1
+            if self._states.num_pending >= self._MAX_PENDING:
+                self._flush()
+
+    @staticmethod
+    def _release(trial):
+        "Drops pybpod's objects of the converted `trial`"
+        trial.sma = None
+        trial.states_occurrences.clear()
+        trial.events_occurrences.clear()
+        trial.states.clear()
+        trial.state_timestamps.clear()
+        trial.event_timestamps.clear()
+        trial.states_durations.clear()
+
+    def _compact_history(self):
+        """Drops the occurrences of the converted trials from the session's
+           history, which the Bpod's thread may be appending to"""
+        history = getattr(self._session, 'history', None)
+        if history is None:
+            return
+        start = self._history_start
+        end = len(history)
+        trials = self._session.trials
+        if self._num_converted < len(trials):
+            # The occurrences of the trials not converted follow theirs
+            next_trial = trials[self._num_converted]
+            end = next((index for index in range(start, end)
+                        if history[index] is next_trial), start)
+        kept = [message for message in history[start:end]
+                if getattr(message, 'MESSAGE_TYPE_ALIAS', None)
+                not in _OCCURRENCE_MESSAGES]
+        # Only appended to past `end` meanwhile
+        history[start:end] = kept
+        self._history_start = start + len(kept)
+
+    def _flush(self):
+        "Stores the pending records in the arrays"
+        if not self._states.num_pending:
+            return
+        for records in (self._states, self._events, self._paths,
+                        self._path_timestamps):
+            records.flush()
+        self._compact_history()
+
+    def _records(self, records, trial_num):
+        if trial_num is not None and trial_num >= self._num_converted:
+            self._convert(trial_num)
+        self._flush()
+        if trial_num is None:
+            return records.values
+        return records.trial(trial_num)
+
+    def states(self, trial_num=None):
+        """The `STATE_RECORD`s of trial `trial_num`, or of all the trials
+           converted so far if None"""
+        return self._records(self._states, trial_num)
+
+    def events(self, trial_num=None):
+        """The `EVENT_RECORD`s of trial `trial_num`, or of all the trials
+           converted so far if None"""
+        return self._records(self._events, trial_num)
+
+    def state_trials(self):
+        "The trial of every record of `states()`"
+        self._flush()
+        offsets = self._states.offsets
+        return repeat(arange(self._num_converted),
+                      ediff1d(offsets, to_begin=offsets[:1]))
+
+    def state_durations(self, matrix_state):
+        """Returns the trials and durations of all the visits of
+           `matrix_state` in the trials converted so far"""
+        states = self.states()
+        visits = states['state'] == matrix_state.value
+        return self.state_trials()[visits], \
+            states['end'][visits] - states['start'][visits]
+
+    def state_name(self, state_id):
+        return self._state_names[state_id]
+
+    def _cache_trial_states(self, trial_num, trial_states):
+        self._trial_states[trial_num] = trial_states
+        if len(self._trial_states) > self._TRIAL_STATES_CACHE_SIZE:
+            self._trial_states.popitem(last=False)
+
+    def trial_states(self, trial_num):
+        """Returns the `TrialStates` index of `trial_num`, built when the
+           trial is converted"""
+        if trial_num >= self.num_converted:
+            self._convert(trial_num)
+        trial_states = self._trial_states.get(trial_num)
+        if trial_states is None:
+            trial_states = TrialStates.from_records(self.states(trial_num))
+            self._cache_trial_states(trial_num, trial_states)
+        return trial_states
+
+    def trial_start_timestamp(self, trial_num):
+        if trial_num >= self.num_converted:
+            self._convert(trial_num)
+        return self._trial_start_timestamps[trial_num]
 
     def states_visited_names(self, trial_num):
-        return [state.state_name for state in self._session.trials[
-            trial_num].states_occurrences if not isnan(state.host_timestamp) ]
+        states = self.states(trial_num)
+        return [self._state_names[state_id]
+                for state_id in states['state'][states['visited']].tolist()]
 
     def states_visited_times(self, trial_num):
         res_dict = OrderedDict()
-        for state in self._session.trials[trial_num].states_occurrences:
-            state_name = state.state_name
-            res_dict[state_name] = res_dict.get(state_name, [])
-            res_dict[state_name].append(
-                (state.start_timestamp, state.end_timestamp))
+        for state_id, start, end in self.states(trial_num)[
+                ['state', 'start', 'end']].tolist():
+            res_dict.setdefault(self._state_names[state_id], []).append(
+                (start, end))
         return res_dict
 
     def original_state_names_by_number(self, trial_num):
-        return self._session.trials[trial_num].sma.state_names
+        if trial_num >= self.num_converted:
+            self._convert(trial_num)
+        return self._state_name_tables[trial_num]
 
     def original_state_data(self, trial_num):
-        return self._session.trials[trial_num].states
+        return self._records(self._paths, trial_num).tolist()
 
     def orginal_event_data(self, trial_num):
-        return self._session.trials[trial_num].events_occurrences
+        "The `EVENT_RECORD`s of the trial, pybpod's event occurrences"
+        return self.events(trial_num)
 
     def original_state_timestamps(self, trial_num):
-        return self._session.trials[trial_num].state_timestamps
+        return self._records(self._path_timestamps, trial_num).tolist()
 
     def original_event_timestamps(self, trial_num):
-        return self._session.trials[trial_num].event_timestamps
+        return self.events(trial_num)['time'].tolist()
 
 
 class CustomData:
 
     _DEFAULT_CATCH_COUNT_LEN = 21
+    # The bias is calculated over the current trial and the 10 before it
+    _BIAS_WINDOW = 11
+    _PERFORMANCE_WINDOW = 20
 
-    def __init__(self, task_parameters, timer, raw_data):
+    def __init__(self, task_parameters, timer, raw_data, rng, calibration):
         self.task_parameters = task_parameters
+        self.rng = rng
+        self.calibration = calibration
         self.draw_params = DrawParams()
         self.timer = timer
         self.raw_data = raw_data
         self.trials = Trials(task_parameters)
+        self.bias_tracker = BiasTracker(self._BIAS_WINDOW)
+        self.performance_tracker = PerformanceTracker(
+            self._PERFORMANCE_WINDOW)
+        self.reward_ledger = RewardLedger()
         self.DVs_already_generated = 0
+        self._prepared_trial = None
 
     def assign_future_trials(self,start_from,num_trials_to_generate):
         "Assigns left_rewarded as true or false for future trials "
-        is_left_rewarded = controlled_random((1 -self.task_parameters.left_bias),
-                                              num_trials_to_generate)
-        last_idx = start_from
-        for a in range(num_trials_to_generate):
-            #If it's a fifty-fifty trial, then place stimulus in the middle
-            if (rand(1,1) < self.task_parameters.percent_50_fifty and
-                (last_idx+a) > self.task_parameters.start_easy_trials):
-                stimulus_omega = .5
-            else:
-                gui_ssc = self.task_parameters.stimulus_selection_criteria
-                beta_dist = self.task_parameters.beta_dist_alpha_n_beta
-                if gui_ssc == StimulusSelectionCriteria.beta_distribution:
-                    # Divide beta by 4 if we are in an easy trial
-                    beta_div = iff((last_idx+a) <= self.task_parameters.start_easy_trials,4,1)
-                    stimulus_omega = betarnd(beta_dist/beta_div,beta_dist/beta_div,1)
-                    stimulus_omega = iff(stimulus_omega < 0.1, 0.1, stimulus_omega)
-                    stimulus_omega = iff(stimulus_omega > 0.9,0.9,stimulus_omega)
-                elif gui_ssc == StimulusSelectionCriteria.discrete_pairs:
-                    omega_prob = self.task_parameters.omega_table.columns.omega_prob
-                    if (last_idx+a) <= self.task_parameters.start_easy_trials:
-                        index = next(omega_prob.index(prob)
-                                    for prob in omega_prob if prob > 0)
-                        stimulus_omega = self.task_parameters.omega_table.columns.omega[
-                            index] / 100
-                    else:
-                        #Choose a value randomly given the each value probability
-                        stimulus_omega = (
-                            (randsample
-                             (self.task_parameters.omega_table.columns.omega,
-                              1,
-                              1,
-                              omega_prob)
-                              / 100).tolist())[0]
-                else:
-                    error('Unexpected Stimulus Selection Criteria')
-
-                if ((is_left_rewarded[a] and stimulus_omega < 0.5) or
-                     (not is_left_rewarded[a] and stimulus_omega >= 0.5)):
-                    stimulus_omega = -stimulus_omega + 1
-
-            self.trials.stimulus_omega[last_idx+a] = stimulus_omega
-            if stimulus_omega != 0.5:
-                self.trials.left_rewarded[last_idx+a] = stimulus_omega > 0.5
-            else:
-                self.trials.left_rewarded[last_idx+a] = rand() < .5
+        rng = self.rng.stimulus
+        is_left_rewarded = array(
+            controlled_random((1 -self.task_parameters.left_bias),
+                              num_trials_to_generate, rng=rng), dtype=bool)
+        trials_idxs = arange(start_from, start_from + num_trials_to_generate)
+        easy_trials = trials_idxs <= self.task_parameters.start_easy_trials
+        #If it's a fifty-fifty trial, then place stimulus in the middle
+        fifty_fifty = (rng.random(num_trials_to_generate) <
+                       self.task_parameters.percent_50_fifty) & ~easy_trials
+        gui_ssc = self.task_parameters.stimulus_selection_criteria
+        if gui_ssc == StimulusSelectionCriteria.beta_distribution:
+            beta_dist = self.task_parameters.beta_dist_alpha_n_beta
+            # Divide beta by 4 if we are in an easy trial
+            beta_params = where(easy_trials, beta_dist / 4, beta_dist)
+            stimulus_omega = clip(rng.beta(beta_params, beta_params), 0.1, 0.9)
+        elif gui_ssc == StimulusSelectionCriteria.discrete_pairs:
+            omega_table = self.task_parameters.omega_table.columns
+            omegas = array(omega_table.omega) / 100
+            stimulus_omega = empty(num_trials_to_generate)
+            # Easy trials use the first omega that has a probability
+            stimulus_omega[easy_trials] = next(
+                omega for omega, prob in zip(omegas, omega_table.omega_prob)
+                if prob > 0)
+            #Choose a value randomly given the each value probability
+            num_hard_trials = count_nonzero(~easy_trials)
+            if num_hard_trials:
+                stimulus_omega[~easy_trials] = rng.choice(
+                    omegas, num_hard_trials, p=omega_table.omega_prob)
+        else:
+            error('Unexpected Stimulus Selection Criteria')
+        flip = (is_left_rewarded & (stimulus_omega < 0.5)) | \
+            (~is_left_rewarded & (stimulus_omega >= 0.5))
+        stimulus_omega = where(flip, -stimulus_omega + 1, stimulus_omega)
+        stimulus_omega[fifty_fifty] = .5
+        left_rewarded = where(stimulus_omega != 0.5, stimulus_omega > 0.5,
+                              rng.random(num_trials_to_generate) < .5)
 
+        trials_slice = slice(start_from, start_from + num_trials_to_generate)
+        self.trials.stimulus_omega[trials_slice] = stimulus_omega
+        self.trials.left_rewarded[trials_slice] = left_rewarded
         self.DVs_already_generated = start_from + num_trials_to_generate
 
     def generate_next_trial(self,trial_num):
+        laps = self.timer.laps(trial_num)
         #Calc Trial DV
         if self.task_parameters.primary_experiment_type == \
                     ExperimentType.auditory:
@@ -185,7 +508,7 @@ class CustomData:
                 f"{stim_intensity}{iff(DV < 0, '# R', '# L')}"
 
         # determine if optogentics trial
-        opto_enabled = rand(1, 1) < self.task_parameters.opto_prob
+        opto_enabled = self.rng.opto.random() < self.task_parameters.opto_prob
         if trial_num < self.task_parameters.start_easy_trials:
             opto_enabled = False
         self.trials.opto_enabled[trial_num] = opto_enabled
@@ -194,14 +517,49 @@ class CustomData:
 
         # Determine if Forced LED trial:
         if self.task_parameters.port_led_to_cue_reward:
-            self.trials.forced_led_trial[trial_num] = rand(1, 1) < \
+            self.trials.forced_led_trial[trial_num] = \
+                self.rng.forced_led.random() < \
                 self.task_parameters.percent_forced_led_trial
         else:
             self.trials.forced_led_trial[trial_num] = False
-        self.timer.custom_catch_n_force_led[trial_num] = time.time()
+        laps.lap('custom_catch_n_force_led')
+
+    def prepare_next_trial(self, trial_num):
+        """Generates `trial_num` ahead of the `update` of the trial before it.
+           Only possible if its stimulus was already drawn, as `update` may
+           otherwise redraw it after bias correction"""
+        if trial_num >= self.DVs_already_generated:
+            return False
+        self.generate_next_trial(trial_num)
+        self._prepared_trial = trial_num
+        return True
+
+    def _account_rewards(self, i_trial, states):
+        """Pushes the water the valves delivered during `i_trial` to the
+           `reward_ledger`, from how long they were open"""
+        left_port, center_port, right_port = get_ports(
+            self.task_parameters.ports_lmr_air)
+        deliveries = [(MatrixState.Reward, iff(
+            self.trials.left_rewarded[i_trial], left_port, right_port))]
+        if self.task_parameters.reward_after_min_sampling:
+            deliveries.append(
+                (MatrixState.CenterPortRewardDelivery, center_port))
+        if self.task_parameters.pre_stim_delay_cntr_reward:
+            deliveries.append((MatrixState.PreStimReward, center_port))
+        trial_start = self.raw_data.trial_start_timestamp(i_trial)
+        for matrix_state, valve in deliveries:
+            if not states.visited(matrix_state):
+                continue
+            for start, end in states.times(matrix_state):
+                self.reward_ledger.push(
+                    trial_start + end, valve,
+                    float(self.calibration.amounts(end - start, valve)))
+        # Tracks the amount of water the animal received up to this point
+        self.trials.reward_received_total[i_trial] = self.reward_ledger.total
 
     def update(self, i_trial):
         "Update variables according to data from pervious trials. Called after every trial"
+        laps = self.timer.laps(i_trial)
         # Standard values
 
         # Stores which lateral port the animal poked into (if any)
@@ -244,33 +602,26 @@ class CustomData:
         # Signals whether a center-port reward was given after min-sampling
         # ends.
         self.trials.reward_after_min_sampling[i_trial] = False
-        # Tracks the amount of water the animal received up tp this point
-        # TODO: Check if reward_received_total is needed and calculate it using
-        # CalcRewObtained() function.
-        # We will updated later
-        self.trials.reward_received_total[i_trial + 1] = 0
-
         self.trials.trial_number[i_trial] = i_trial
 
-        self.timer.custom_initialize[i_trial] = time.time()
+        laps.lap('custom_initialize')
 
         # Checking states and rewriting standard
 
         # Extract the states that were used in the last trial
-        states_visited_this_trial_names = self.raw_data.states_visited_names(i_trial)
-        states_visited_this_trial_times = self.raw_data.states_visited_times(i_trial)
-        if str(MatrixState.WaitForStimulus) in states_visited_this_trial_names:
-            last_wait_for_stimulus_states_times = states_visited_this_trial_times[
-                str(MatrixState.WaitForStimulus)][-1]
-            last_trigger_wait_for_stimulus_state_times = states_visited_this_trial_times[
-                str(MatrixState.TriggerWaitForStimulus)][-1]
+        states = self.raw_data.trial_states(i_trial)
+        if states.visited(MatrixState.WaitForStimulus):
+            last_wait_for_stimulus_states_times = states.times(
+                MatrixState.WaitForStimulus)[-1]
+            last_trigger_wait_for_stimulus_state_times = states.times(
+                MatrixState.TriggerWaitForStimulus)[-1]
             self.trials.fix_dur[i_trial] = last_wait_for_stimulus_states_times[1] - \
                 last_wait_for_stimulus_states_times[0] + \
                 last_trigger_wait_for_stimulus_state_times[1] - \
                 last_trigger_wait_for_stimulus_state_times[0]
-        if str(MatrixState.StimulusDelivery) in states_visited_this_trial_names:
-            stimulus_delivery_state_times = states_visited_this_trial_times[
-                str(MatrixState.StimulusDelivery)]
+        if states.visited(MatrixState.StimulusDelivery):
+            stimulus_delivery_state_times = states.times(
+                MatrixState.StimulusDelivery)
             if self.task_parameters.reward_after_min_sampling:
                 self.trials.st[i_trial] = diff(stimulus_delivery_state_times)
             else:
@@ -278,13 +629,11 @@ class CustomData:
                 # 'reward_after_min_sampling' is active, in such case it means
                 # that min sampling is done and we are in the optional
                 # sampling stage.
-                if str(MatrixState.CenterPortRewardDelivery) in \
-                        states_visited_this_trial_names and \
+                if states.visited(MatrixState.CenterPortRewardDelivery) and \
                         self.task_parameters.stimulus_time > \
                         self.task_parameters.min_sample:
                     center_port_reward_delivery_state_times = \
-                        states_visited_this_trial_times[
-                            str(MatrixState.CenterPortRewardDelivery)]
+                        states.times(MatrixState.CenterPortRewardDelivery)
                     self.trials.st[i_trial] = [
                         center_port_reward_delivery_state_times[0][
                             1] - stimulus_delivery_state_times[0][0]
@@ -292,28 +641,23 @@ class CustomData:
                 else:
                     # This covers early_withdrawal
                     self.trials.st[i_trial] = diff(stimulus_delivery_state_times)
-        if str(MatrixState.StimulusTime) in states_visited_this_trial_names:
-            stimulus_time_state_times = states_visited_this_trial_times[
-                str(MatrixState.StimulusTime)][-1]
+        if states.visited(MatrixState.StimulusTime):
+            stimulus_time_state_times = states.times(
+                MatrixState.StimulusTime)[-1]
             self.trials.st[i_trial] = stimulus_time_state_times[-1] - \
                 stimulus_delivery_state_times[0][1]
-        if str(MatrixState.WaitForChoice) in states_visited_this_trial_names and \
-            str(MatrixState.TimeoutMissedChoice) not in \
-                states_visited_this_trial_names:
-            wait_for_choice_state_times = states_visited_this_trial_times[
-                str(MatrixState.WaitForChoice)]
-            wait_for_choice_state_start_times = [
-                start_time for start_time, end_time in wait_for_choice_state_times]
+        if states.visited(MatrixState.WaitForChoice) and \
+            not states.visited(MatrixState.TimeoutMissedChoice):
+            wait_for_choice_state_start_times = states.times(
+                MatrixState.WaitForChoice)[:, 0]
             # We might have more than multiple WaitForChoice if
             # Habituate Ignore Incorrect is enabeld
-            self.trials.mt[-1] = diff(wait_for_choice_state_start_times[:2])
+            self.trials.mt[i_trial] = diff(wait_for_choice_state_start_times[:2])
 
         # Extract trial outcome. Check first if it's a wrong choice or a
         # Habituate Ignore Incorrect but first choice was wrong choice
-        if str(MatrixState.WaitForPunishStart) in \
-            states_visited_this_trial_names or \
-           str(MatrixState.RegisterWrongWaitCorrect) in \
-                states_visited_this_trial_names:
+        if states.visited(MatrixState.WaitForPunishStart) or \
+           states.visited(MatrixState.RegisterWrongWaitCorrect):
             self.trials.choice_correct[i_trial] = False
             # Correct choice = left
             if self.trials.left_rewarded[i_trial]:
@@ -321,18 +665,17 @@ class CustomData:
             else:
                 self.trials.choice_left[i_trial] = True
             # Feedback waiting time
-            if str(MatrixState.WaitForPunish) in states_visited_this_trial_names:
-                wait_for_punish_state_times = states_visited_this_trial_times[
-                    str(MatrixState.WaitForPunish)]
-                wait_for_punish_start_state_times = states_visited_this_trial_times[
-                    str(MatrixState.WaitForPunishStart)]
+            if states.visited(MatrixState.WaitForPunish):
+                wait_for_punish_state_times = states.times(
+                    MatrixState.WaitForPunish)
+                wait_for_punish_start_state_times = states.times(
+                    MatrixState.WaitForPunishStart)
                 self.trials.feedback_time[i_trial] = wait_for_punish_state_times[
                     -1][1] - wait_for_punish_start_state_times[0][0]
             else:  # It was a  RegisterWrongWaitCorrect state
                 self.trials.feedback_time[i_trial] = None
         # CorrectChoice
-        elif str(MatrixState.WaitForRewardStart) in \
-                states_visited_this_trial_names:
+        elif states.visited(MatrixState.WaitForRewardStart):
             self.trials.choice_correct[i_trial] = True
             if self.trials.catch_trial[i_trial]:
                 catch_stim_idx = get_catch_stim_idx(
@@ -351,11 +694,11 @@ class CustomData:
                 self.trials.catch_count[catch_stim_idx] += stim_prob
                 self.trials.last_success_catch_trial = i_trial
             # Feedback waiting time
-            if str(MatrixState.WaitForReward) in states_visited_this_trial_names:
-                wait_for_reward_state_times = states_visited_this_trial_times[
-                    str(MatrixState.WaitForReward)]
-                wait_for_reward_start_state_times = states_visited_this_trial_times[
-                    str(MatrixState.WaitForRewardStart)]
+            if states.visited(MatrixState.WaitForReward):
+                wait_for_reward_state_times = states.times(
+                    MatrixState.WaitForReward)
+                wait_for_reward_start_state_times = states.times(
+                    MatrixState.WaitForRewardStart)
                 self.trials.feedback_time[i_trial] = wait_for_reward_state_times[
                     -1][1] - wait_for_reward_start_state_times[0][0]
                 # Correct choice = left
@@ -366,31 +709,25 @@ class CustomData:
             else:
                 warning("'WaitForReward' state should always appear"
                         " if 'WaitForRewardStart' was initiated")
-        elif str(MatrixState.BrokeFixation) in states_visited_this_trial_names:
+        elif states.visited(MatrixState.BrokeFixation):
             self.trials.fix_broke[i_trial] = True
-        elif str(MatrixState.EarlyWithdrawal) in states_visited_this_trial_names:
+        elif states.visited(MatrixState.EarlyWithdrawal):
             self.trials.early_withdrawal[i_trial] = True
-        elif str(MatrixState.TimeoutMissedChoice) in \
-                states_visited_this_trial_names:
+        elif states.visited(MatrixState.TimeoutMissedChoice):
             self.trials.feedback[i_trial] = False
             self.trials.missed_choice[i_trial] = True
-        if str(MatrixState.TimeoutSkippedFeedback) in \
-                states_visited_this_trial_names:
+        if states.visited(MatrixState.TimeoutSkippedFeedback):
             self.trials.feedback[i_trial] = False
-        if str(MatrixState.Reward) in states_visited_this_trial_names \
-            and not self.trials.catch_trial:
+        if states.visited(MatrixState.Reward) \
+            and not self.trials.catch_trial[i_trial]:
             self.trials.rewarded[i_trial] = True
-            self.trials.reward_received_total[i_trial] += \
-                self.task_parameters.reward_amount
-        if str(MatrixState.CenterPortRewardDelivery) in \
-                states_visited_this_trial_names and \
+        if states.visited(MatrixState.CenterPortRewardDelivery) and \
            self.task_parameters.reward_after_min_sampling:
             self.trials.reward_after_min_sampling[i_trial] = True
-            self.trials.reward_received_total[i_trial] += \
-                self.task_parameters.center_port_rew_amount
-        if str(MatrixState.WaitCenterPortOut) in states_visited_this_trial_names:
-            wait_center_port_out_state_times = states_visited_this_trial_times[
-                str(MatrixState.WaitCenterPortOut)]
+        self._account_rewards(i_trial, states)
+        if states.visited(MatrixState.WaitCenterPortOut):
+            wait_center_port_out_state_times = states.times(
+                MatrixState.WaitCenterPortOut)
             self.trials.reaction_time[i_trial] = diff(
                 wait_center_port_out_state_times)
         else:
@@ -401,7 +738,7 @@ class CustomData:
         self.trials.stim_delay[i_trial] = self.task_parameters.stim_delay
         self.trials.feedback_delay[i_trial] = self.task_parameters.feedback_delay
         self.trials.min_sample[i_trial] = self.task_parameters.min_sample
-        self.timer.custom_extract_data[i_trial] = time.time()
+        laps.lap('custom_extract_data')
 
         # IF we are running grating experiments,
         # add the grating orientation that was used
@@ -427,12 +764,12 @@ class CustomData:
                             i_trial] + self.task_parameters.stim_delay_incr))
         else:
             if not self.trials.fix_broke[i_trial]:
-                self.task_parameters.stim_delay = random_unif(
+                self.task_parameters.stim_delay = self.rng.delays.uniform(
                     self.task_parameters.stim_delay_min,
                     self.task_parameters.stim_delay_max)
             else:
                 self.task_parameters.stim_delay = self.trials.stim_delay[i_trial]
-        self.timer.custom_stim_delay[i_trial] = time.time()
+        laps.lap('custom_stim_delay')
 
         # min sampling time
         if self.task_parameters.min_sample_type == MinSampleType.fix_min:
@@ -465,8 +802,8 @@ class CustomData:
                         self.trials.min_sample[i_trial]))
         elif self.task_parameters.min_sample_type == \
                 MinSampleType.rand_bet_min_max_def_is_max:
-            use_rand = rand(
-                1, 1) < self.task_parameters.min_sample_rand_prob
+            use_rand = self.rng.delays.random() < \
+                self.task_parameters.min_sample_rand_prob
             if not use_rand or i_trial <= self.task_parameters.start_easy_trials:
                 self.task_parameters.min_sample = \
                     self.task_parameters.min_sample_max
@@ -476,10 +813,11 @@ class CustomData:
                     self.task_parameters.min_sample_min
                 self.task_parameters.min_sample = \
                     min_sample_difference * \
-                    rand(1, 1) + self.task_parameters.min_sample_min
+                    self.rng.delays.random() + \
+                    self.task_parameters.min_sample_min
         elif MinSampleType.rand_num_intervals_min_max_def_is_max:
-            use_rand = rand(
-                1, 1) < self.task_parameters.min_sample_rand_prob
+            use_rand = self.rng.delays.random() < \
+                self.task_parameters.min_sample_rand_prob
             if not use_rand or i_trial <= self.task_parameters.start_easy_trials:
                 self.task_parameters.min_sample = \
                     self.task_parameters.min_sample_max
@@ -500,15 +838,14 @@ class CustomData:
                         self.task_parameters.min_sample_min,
                         self.task_parameters.min_sample_max + 1,
                         step))
-                    intervals_idx = randi(
+                    intervals_idx = self.rng.delays.integers(
                         1, self.task_parameters.min_sample_num_interval)
-                    print("Intervals:")  # disp("Intervals:");
-                    print(intervals)  # disp(intervals)
+                    logger.debug(f'Min sample intervals: {intervals}')
                     self.task_parameters.min_sample = intervals[
                         intervals_idx]
         else:
             error('Unexpected Min Sample Type value')
-        self.timer.custom_min_sampling[i_trial] = time.time()
+        laps.lap('custom_min_sampling')
 
         # feedback delay
         if self.task_parameters.feedback_delay_selection == \
@@ -543,13 +880,14 @@ class CustomData:
             self.task_parameters.feedback_delay = truncated_exponential(
                 self.task_parameters.feedback_delay_min,
                 self.task_parameters.feedback_delay_max,
-                self.task_parameters.feedback_delay_tau)
+                self.task_parameters.feedback_delay_tau,
+                rng=self.rng.delays)
         elif FeedbackDelaySelection.fix:
             self.task_parameters.feedback_delay = \
                 self.task_parameters.feedback_delay_max
         else:
             error('Unexpected Feedback Delay Selection value')
-        self.timer.custom_feedback_delay[i_trial] = time.time()
+        laps.lap('custom_feedback_delay')
 
         # Drawing future trials
 
@@ -561,50 +899,15 @@ class CustomData:
         # else
         #   indices_rwd = 1;
         # end
-        LAST_TRIALS = 10
-        indices_rwd = iff(i_trial > LAST_TRIALS, i_trial - LAST_TRIALS, 0)
-        # ndxRewd = self.trials.rewarded(indices_rwd:i_trial);
-        choice_correct_slice = self.trials.choice_correct[
-            indices_rwd: i_trial + 1]
-        choice_left_slice = self.trials.choice_left[indices_rwd: i_trial + 1]
-        left_rewarded_slice = self.trials.left_rewarded[indices_rwd: i_trial + 1]
-        ndx_left_rewd = [choice_c and choice_l for choice_c, choice_l in zip(
-            choice_correct_slice, choice_left_slice)]
-        ndx_left_rew_done = [l_rewarded and choice_l is not None
-                          for l_rewarded, choice_l in zip(
-                              left_rewarded_slice, choice_left_slice)]
-        ndx_right_rewd = [choice_c and not choice_l
-                        for choice_c, choice_l in zip(
-                            choice_correct_slice, choice_left_slice)]
-        ndx_right_rew_done = [not l_rewarded and choice_l is not None
-                           for l_rewarded, choice_l in zip(
-                               left_rewarded_slice, choice_left_slice)]
-        if not any(ndx_left_rew_done):
-            # Since we don't have trials on this side, then measure by how good
-            # the animals was performing on the other side. If it did bad on
-            # the side then then consider this side performance to be good so
-            # it'd still get more trials on the other side.
-            denominator = iff(sum(filter(None,ndx_right_rew_done)),
-                              sum(filter(None,ndx_right_rew_done)) * 2,
-                              1)
-            perf_left = 1 - (sum(filter(None,ndx_right_rewd)) / (denominator * 2))
-        else:
-            perf_left = (sum(filter(None,ndx_left_rewd)) /
-                         sum(filter(None,ndx_left_rew_done)))
-        if not any(ndx_right_rew_done):
-            denominator = iff(sum(filter(None,ndx_left_rew_done)),
-                              sum(filter(None,ndx_left_rew_done)) * 2,
-                              1)
-            perf_right = 1 - (sum(filter(None,ndx_left_rewd)) / (denominator* 2))
-        else:
-            perf_right = sum(filter(None,ndx_right_rewd)) / sum(filter(None,ndx_right_rew_done))
-        self.task_parameters.calc_left_bias = (perf_left - perf_right) / 2 + 0.5
-        self.timer.custom_calc_bias[i_trial] = time.time()
-
-        choice_made_trials = [
-            choice_c is not None for choice_c in self.trials.choice_correct]
-        rewarded_trials_count = sum(r is True for r in self.trials.rewarded)
-        length_choice_made_trials = sum(x for x in choice_made_trials if True)
+        self.bias_tracker.push(self.trials.choice_correct[i_trial],
+                               self.trials.choice_left[i_trial],
+                               self.trials.left_rewarded[i_trial])
+        self.task_parameters.calc_left_bias = self.bias_tracker.left_bias
+
+        self.performance_tracker.push(self.trials.choice_correct[i_trial],
+                                      self.trials.rewarded[i_trial])
+        rewarded_trials_count = self.performance_tracker.rewarded_count
+        length_choice_made_trials = self.performance_tracker.choice_made_count
         if length_choice_made_trials >= 1:
             performance = rewarded_trials_count / length_choice_made_trials
             self.task_parameters.performance = [
@@ -613,25 +916,28 @@ class CustomData:
             performance = rewarded_trials_count / (i_trial + 1)
             self.task_parameters.all_preformance = [
                 f'{performance * 100:.2f}', '#/', str(i_trial + 1), 'T']
-            NUM_LAST_TRIALS = 20
+            NUM_LAST_TRIALS = self.performance_tracker.window
             if i_trial > NUM_LAST_TRIALS:
                 if length_choice_made_trials > NUM_LAST_TRIALS:
-                    rewarded_trials_ = choice_made_trials[
+                    # Counts the trials with a choice made whose index falls
+                    # in the window ending at length_choice_made_trials
+                    choice_made_mask = self.trials.choice_correct.mask[
                         length_choice_made_trials - NUM_LAST_TRIALS + 1:
                         length_choice_made_trials + 1]
-                    performance = sum(rewarded_trials_) / NUM_LAST_TRIALS
+                    performance = count_nonzero(
+                        ~choice_made_mask) / NUM_LAST_TRIALS
                     self.task_parameters.performance = [
                         self.task_parameters.performance, ' - ',
                         f'{performance * 100:.2f}', '#/',
                         str(NUM_LAST_TRIALS), 'T']
-                rewarded_trials_count = sum(self.trials.rewarded[
-                    i_trial - NUM_LAST_TRIALS + 1: i_trial + 1])
+                rewarded_trials_count = \
+                    self.performance_tracker.recent_rewarded_count
                 performance = rewarded_trials_count / NUM_LAST_TRIALS
                 self.task_parameters.all_preformance = [
                     self.task_parameters.all_preformance, ' - ',
                     f'{performance * 100:.2f}', '#/', str(NUM_LAST_TRIALS),
                     'T']
-        self.timer.custom_calc_bias[i_trial] = time.time()
+        laps.lap('custom_calc_bias')
 
         # Create future trials
         # Check if its time to generate more future trials
@@ -647,11 +953,11 @@ class CustomData:
                 if 0.45 <= left_bias <= 0.55:
                     left_bias = 0.5
                 if left_bias is None:
-                    print('Left bias is None.')
+                    logger.warning('Left bias is None.')
                     left_bias = 0.5
             else:
                 left_bias = self.task_parameters.left_bias
-            self.timer.custom_adjust_bias[i_trial] = time.time()
+            laps.lap('custom_adjust_bias')
 
             # Adjustment of P(Omega) to make sure that sum(P(Omega))=1
             if self.task_parameters.stimulus_selection_criteria != \
@@ -667,19 +973,20 @@ class CustomData:
                     for omega_prob
                     in self.task_parameters.omega_table.columns.omega_prob
                 ]
-            self.timer.custom_calc_omega[i_trial] = time.time()
+            laps.lap('custom_calc_omega')
             self.assign_future_trials(i_trial+1,Const.PRE_GENERATE_TRIAL_COUNT)
 
-            self.timer.custom_gen_new_trials[i_trial] = time.time()
+            laps.lap('custom_gen_new_trials')
         else:
             self.timer.custom_adjust_bias[i_trial] = 0
             self.timer.custom_calc_omega[i_trial] = 0
             self.timer.custom_prep_new_trials[i_trial] = 0
             self.timer.custom_gen_new_trials[i_trial] = 0
 
-        self.generate_next_trial(i_trial+1)
+        if self._prepared_trial != i_trial + 1:
+            self.generate_next_trial(i_trial+1)
 
-        self.timer.custom_finalize_update[i_trial] = time.time()
+        laps.lap('custom_finalize_update')
 
         # Update RDK GUI  #TODO:Figure out where this goes
         self.task_parameters.omega_table.columns.rdk = [
@@ -702,7 +1009,7 @@ class CustomData:
             elif i_trial + 1 < self.trials.last_success_catch_trial + upper_limit:
                 # TODO: If Omega Prob changed since last time, then redo it
                 non_zero_prob = [
-                    self.task_parameters.omega_table.omega[i] / 100
+                    self.task_parameters.omega_table.columns.omega[i] / 100
                     for i, prob in enumerate(
                         self.task_parameters.omega_table.columns.omega_prob)
                     if prob > 0]
@@ -728,31 +1035,77 @@ class CustomData:
             self.trials.catch_trial[i_trial + 1], 'true', 'false')
 
 
+class _Laps:
+    "Times consecutive phases, each lap lasting since the previous one"
+    __slots__ = ('_timer', '_i_trial', '_mark')
+
+    def __init__(self, timer, i_trial):
+        self._timer = timer
+        self._i_trial = i_trial
+        self._mark = time.perf_counter_ns()
+
+    def lap(self, phase):
+        now = time.perf_counter_ns()
+        self._timer.record(phase, self._i_trial, now - self._mark)
+        self._mark = now
+
+
 class TimerData:
-    "Initialize class variables"
+    """Durations in seconds of the phases of every trial, timed with the
+       monotonic `time.perf_counter_ns`. The durations of the whole session
+       are also kept in `latencies` for their distributions."""
     def __init__(self):
-        self.start_new_iter = datalist()
-        self.sync_gui = datalist()
-        self.build_state_matrix = datalist()
-        self.send_state_matrix = datalist()
-        self.append_data = datalist()
-        self.handle_pause = datalist()
-        self.update_custom_data_fields = datalist()
-        self.send_plot_data = datalist()
-        self.save_data = datalist()
-        self.calcilate_timeout = datalist()
-        self.custom_extract_data = datalist()
-        self.custom_adjust_bias = datalist()
-        self.custom_calc_omega = datalist()
-        self.custom_initialize = datalist()
-        self.custom_finalize_update = datalist()
-        self.custom_catch_n_force_led = datalist()
-        self.custom_stim_delay = datalist()
-        self.custom_min_sampling = datalist()
-        self.custom_feedback_delay = datalist()
-        self.custom_calc_bias = datalist()
-        self.custom_prep_new_trials = datalist()
-        self.custom_gen_new_trials = datalist()
+        self.start_new_iter = datacolumn(float, 0)
+        self.sync_gui = datacolumn(float, 0)
+        self.build_state_matrix = datacolumn(float, 0)
+        # Built ahead on a worker thread while the trial before runs
+        self.prepare_state_matrix = datacolumn(float, 0)
+        self.send_state_matrix = datacolumn(float, 0)
+        self.append_data = datacolumn(float, 0)
+        self.handle_pause = datacolumn(float, 0)
+        self.update_custom_data_fields = datacolumn(float, 0)
+        self.send_plot_data = datacolumn(float, 0)
+        self.save_data = datacolumn(float, 0)
+        self.calcilate_timeout = datacolumn(float, 0)
+        self.custom_extract_data = datacolumn(float, 0)
+        self.custom_adjust_bias = datacolumn(float, 0)
+        self.custom_calc_omega = datacolumn(float, 0)
+        self.custom_initialize = datacolumn(float, 0)
+        self.custom_finalize_update = datacolumn(float, 0)
+        self.custom_catch_n_force_led = datacolumn(float, 0)
+        self.custom_stim_delay = datacolumn(float, 0)
+        self.custom_min_sampling = datacolumn(float, 0)
+        self.custom_feedback_delay = datacolumn(float, 0)
+        self.custom_calc_bias = datacolumn(float, 0)
+        self.custom_prep_new_trials = datacolumn(float, 0)
+        self.custom_gen_new_trials = datacolumn(float, 0)
+        # From the end of a trial to the start of the next one, i.e. how
+        # long the Bpod waits for the protocol
+        self.between_trials = datacolumn(float, 0)
+        self.latencies = PhaseLatencies()
+        self._trial_phases = {}
+
+    def record(self, phase, i_trial, duration_ns):
+        getattr(self, phase)[i_trial] = duration_ns / 1e9
+        self.latencies.record(phase, duration_ns)
+        self._trial_phases.setdefault(i_trial, {})[phase] = duration_ns / 1e6
+
+    def pop_phases(self, i_trial):
+        "Returns, and forgets, the {phase: milliseconds} timed for `i_trial`"
+        return self._trial_phases.pop(i_trial, {})
+
+    @contextmanager
+    def span(self, phase, i_trial):
+        "Times the phase run in the `with` block"
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(phase, i_trial, time.perf_counter_ns() - start)
+
+    def laps(self, i_trial):
+        "Returns a `_Laps` to time consecutive phases of `i_trial`"
+        return _Laps(self, i_trial)
 
 
 class DrawParams:
@@ -783,55 +1136,65 @@ class Trials:
     _DEFAULT_CATCH_COUNT_LEN = 21
     def __init__(self,task_parameters):
         self.task_parameters = task_parameters
-        self.choice_left = datalist(None)
-        self.choice_correct = datalist(None)
-        self.feedback = datalist(None)
-        self.feedback_time = datalist(None)
-        self.feedback_delay = datalist(None)
-        self.fix_broke = datalist(None)
-        self.early_withdrawal = datalist(None)
-        self.missed_choice = datalist(None)
-        self.fix_dur = datalist(None)
-        self.mt = datalist(None)
-        self.catch_trial = datalist(None)
-        self.st = datalist(None)
-        self.opto_enabled = datalist(None)
-        self.rewarded = datalist(None)
-        self.reward_after_min_sampling = datalist(False)
-        self.pre_stim_counter_reward = datalist(None)
-        self.pre_stim_cntr_reward = datalist(size=NUM_OF_TRIALS + 1)
-        self.min_sample = datalist(None)
-        self.light_intensity_left = datalist()
-        self.light_intensity_right = datalist()
-        self.grating_orientation = datalist(None)
-        self.reward_magnitude = datalist([
+        self.choice_left = datacolumn(bool)
+        self.choice_correct = datacolumn(bool)
+        self.feedback = datacolumn(bool)
+        self.feedback_time = datacolumn(float)
+        self.feedback_delay = datacolumn(float)
+        self.fix_broke = datacolumn(bool)
+        self.early_withdrawal = datacolumn(bool)
+        self.missed_choice = datacolumn(bool)
+        self.fix_dur = datacolumn(float)
+        self.mt = datacolumn(float)
+        self.catch_trial = datacolumn(bool)
+        self.st = datacolumn(float)
+        self.opto_enabled = datacolumn(bool)
+        self.rewarded = datacolumn(bool)
+        self.reward_after_min_sampling = datacolumn(bool, False)
+        self.pre_stim_counter_reward = datacolumn(float)
+        self.pre_stim_cntr_reward = datacolumn(float, 0)
+        self.min_sample = datacolumn(float)
+        self.light_intensity_left = datacolumn(float, 0)
+        self.light_intensity_right = datacolumn(float, 0)
+        self.grating_orientation = datacolumn(float)
+        self.reward_magnitude = datacolumn(float, [
             self.task_parameters.reward_amount,
             self.task_parameters.reward_amount
-        ])
-        self.reward_received_total = datalist(size=NUM_OF_TRIALS + 1)
-        self.reaction_time = datalist(None)
-        self.center_port_rew_amount = datalist(
-            self.task_parameters.center_port_rew_amount)
-        self.trial_number = datalist(None)
-        self.forced_led_trial = datalist(None)
+        ], width=2)
+        self.reward_received_total = datacolumn(float, 0)
+        self.reaction_time = datacolumn(float)
+        self.center_port_rew_amount = datacolumn(
+            float, self.task_parameters.center_port_rew_amount)
+        self.trial_number = datacolumn(int)
+        self.forced_led_trial = datacolumn(bool)
         self.catch_count = datalist(size=self._DEFAULT_CATCH_COUNT_LEN)
         self.last_success_catch_trial = True
-        self.stimulus_omega = datalist(None)
-        self.stim_delay = datalist(None)
-        self.left_rewarded = datalist(None)
-        self.DV = datalist()
-        self.trial_start_sys_time = datalist(None)
-        self.dots_coherence = datalist(None)
+        self.stimulus_omega = datacolumn(float)
+        self.stim_delay = datacolumn(float)
+        self.left_rewarded = datacolumn(bool)
+        self.DV = datacolumn(float, 0)
+        self.trial_start_sys_time = datacolumn(float)
+        self.dots_coherence = datacolumn(float)
         self.early_withdrawal_timer_start = None
 
 class Data:
     "Initialize class variables"
-    def __init__(self, session, task_parameters):
+    def __init__(self, session, task_parameters, seed=None, calibration=None):
+        """Valve times are looked up in `calibration`, `default_calibration()`
+           if None"""
         self.task_parameters = task_parameters
+        self.calibration = calibration if calibration is not None else \
+            default_calibration()
         self.raw_data = RawData(session)
         self.timer = TimerData()
-        self.custom = CustomData(task_parameters, self.timer, self.raw_data)
-        self.trail_start_timestamp = datalist()
-        self.trail_start_timestamp = datalist()
+        # Pass `seed` to replay a session
+        self.rng = SessionRNG(seed)
+        self.seed = self.rng.seed
+        self.spawn_key = self.rng.spawn_key
+        logger.info(f'Session seed: {self.seed}, spawn key: '
+                    f'{self.spawn_key}')
+        self.custom = CustomData(task_parameters, self.timer, self.raw_data,
+                                 self.rng, self.calibration)
+        self.trail_start_timestamp = datacolumn(float, 0)
         self.settings_file = None
         self.dots_mapped_file = None
@@ -0,0 +1,175 @@
+"""Shared-memory channel publishing the `DrawParams` of every trial to an
+external visual stimulus renderer.
+
+The channel is a small file of fixed layout that both sides memory-map, all
+values little-endian:
+
+    offset  type        field
+    0       char[4]     magic, b'M2DP'
+    4       uint32      layout version, `VERSION`
+    8       uint32      number of parameters, len(`FIELDS`)
+    12      uint32      reserved
+    16      uint64      sequence: odd while the parameters are being written,
+                        incremented to even once they are consistent
+    24      int64       trial the parameters belong to
+    32      uint64      start: sequence of the parameters to draw now
+    40      uint64      stop: incremented to stop drawing
+    48      uint64      ack: last sequence the renderer loaded (written by it)
+    56      float64[n]  the `FIELDS`, NaN for None and enums as their value
+
+The protocol publishes the parameters of a trial as soon as its state
+matrix is sent, so the renderer can load them (and acknowledge them) while
+the mouse initiates the trial. `SoftCode 5` then only sets `start`, which
+the renderer polls once per frame, and `SoftCode 6` bumps `stop`. No
+serialization happens on the trial's critical path."""
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+from mouse2afc.data import DrawParams
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'M2DP'
+VERSION = 1
+FIELDS = tuple(vars(DrawParams()))
+
+_LAYOUT = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('num_params', '<u4'),
+    ('reserved', '<u4'),
+    ('sequence', '<u8'),
+    ('trial', '<i8'),
+    ('start', '<u8'),
+    ('stop', '<u8'),
+    ('ack', '<u8'),
+    ('params', '<f8', (len(FIELDS),)),
+])
+# Retries of a reader racing the writer before giving up
+_MAX_READ_ATTEMPTS = 1000
+
+
+class DrawParamsChannelError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise DrawParamsChannelError(message)
+
+
+def _param_value(value):
+    if value is None:
+        return math.nan
+    return float(getattr(value, 'value', value))
+
+
+class DrawParamsChannel:
+    "The protocol's end of the channel, creating (or resetting) `path`"
+
+    def __init__(self, path):
+        self._path = path
+        self._buffer = np.memmap(path, dtype=_LAYOUT, mode='w+', shape=())
+        self._buffer['magic'] = MAGIC
+        self._buffer['version'] = VERSION
+        self._buffer['num_params'] = len(FIELDS)
+        self._buffer['trial'] = -1
+        self._buffer['params'] = math.nan
+        self._buffer.flush()
+
+    @property
+    def sequence(self):
+        return int(self._buffer['sequence'])
+
+    @property
+    def acknowledged(self):
+        "Whether the renderer loaded the last published parameters"
+        return int(self._buffer['ack']) == self.sequence
+
+    def publish(self, i_trial, draw_params):
+        "Publishes the parameters of `i_trial`, returns their sequence"
+        params = [_param_value(getattr(draw_params, field, None))
+                  for field in FIELDS]
+        sequence = self.sequence
+        self._buffer['sequence'] = sequence + 1
+        self._buffer['trial'] = i_trial
+        self._buffer['params'] = params
+        self._buffer['sequence'] = sequence + 2
+        return sequence + 2
+
+    def start(self):
+        "Tells the renderer to draw the last published parameters"
+        if not self.acknowledged:
+            logger.warning(f'Starting trial {int(self._buffer["trial"])} '
+                           f'before the renderer loaded its parameters')
+        self._buffer['start'] = self.sequence
+
+    def stop(self):
+        self._buffer['stop'] += 1
+
+    @property
+    def closed(self):
+        return self._buffer is None
+
+    def close(self):
+        if self._buffer is None:
+            return
+        self._buffer.flush()
+        self._buffer = None
+
+
+class DrawParamsReceiver:
+    """The renderer's end of the channel. A reference implementation of the
+       handshake for python renderers (and tests): poll `start` and `stop`
+       once per frame, `read()` and `acknowledge()` new parameters as soon
+       as `sequence` changes."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            error(f'No draw parameters channel at {path}.')
+        self._buffer = np.memmap(path, dtype=_LAYOUT, mode='r+', shape=())
+        if self._buffer['magic'].item() != MAGIC or \
+                int(self._buffer['version']) != VERSION or \
+                int(self._buffer['num_params']) != len(FIELDS):
+            error(f'{path} is not a version {VERSION} draw parameters '
+                  f'channel.')
+
+    @property
+    def sequence(self):
+        return int(self._buffer['sequence'])
+
+    @property
+    def start(self):
+        return int(self._buffer['start'])
+
+    @property
+    def stop(self):
+        return int(self._buffer['stop'])
+
+    def read(self):
+        """Returns the (sequence, trial, parameters) last published, the
+           parameters as a dict with None for the unset ones"""
+        for _ in range(_MAX_READ_ATTEMPTS):
+            sequence = self.sequence
+            if sequence % 2:
+                # Lets the writer finish, it may share the core
+                time.sleep(0)
+                continue
+            trial = int(self._buffer['trial'])
+            params = self._buffer['params'].tolist()
+            if self.sequence == sequence:
+                return sequence, trial, {
+                    field: None if math.isnan(value) else value
+                    for field, value in zip(FIELDS, params)}
+        error('The draw parameters kept changing while being read.')
+
+    def acknowledge(self, sequence):
+        "Tells the protocol the parameters of `sequence` are loaded"
+        self._buffer['ack'] = sequence
+
+    def close(self):
+        del self._buffer
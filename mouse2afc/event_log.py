@@ -0,0 +1,115 @@
+"""Non-blocking logging of the protocol, with a structured event log.
+
+`EventLog` routes the records of the mouse2afc loggers through a queue to
+a background thread, so logging on the trial path costs a queue put rather
+than the handlers' I/O. The thread writes them as text to stderr and, if
+given a file, as json lines with their structured fields, e.g. the end of
+every trial, along with how long each of its phases took:
+
+    {"time": 1700000000.1, "level": "INFO", "logger": "mouse2afc.mouse2afc",
+     "message": "Trial 12 done", "trial": 12, "choice_correct": true,
+     "rewarded": true, "reward_received_total": 73.2,
+     "phases_ms": {"build_state_matrix": 0.52, "send_state_matrix": 3.9,
+                   "between_trials": 5.4, ...}}
+
+Fields are passed with the `extra` argument of the logging calls."""
+import json
+import logging
+import queue
+import sys
+
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+DEFAULT_LEVEL = logging.INFO
+DEFAULT_EVENT_LEVEL = logging.DEBUG
+PACKAGE_LOGGER = 'mouse2afc'
+
+# Set on every record, the others are structured fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    "Formats records as json lines, with their structured fields"
+
+    def format(self, record):
+        event = {'time': record.created, 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        event.update((name, value) for name, value in vars(record).items()
+                     if name not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+class _InProcessQueueHandler(QueueHandler):
+    """Queues the records as they are: they stay in the process, so unlike
+       `QueueHandler` there is no need to format them before queuing"""
+
+    def prepare(self, record):
+        return record
+
+
+class EventLog:
+    """Logs the mouse2afc records at or above `level` to `stream` (stderr
+       if None), and those at or above `event_level` to the json lines file
+       `file_` if given, from a background thread. The records no longer
+       propagate to the root logger while started. Use as a context manager
+       or call `start()` and `stop()`."""
+
+    def __init__(self, file_=None, level=DEFAULT_LEVEL,
+                 event_level=DEFAULT_EVENT_LEVEL, stream=None):
+        self._file = file_
+        self._level = level
+        self._event_level = event_level
+        self._stream = stream
+        self._logger = logging.getLogger(PACKAGE_LOGGER)
+        self._queue_handler = None
+        self._listener = None
+        self._previous = None
+
+    def start(self):
+        if self._listener is not None:
+            return
+        stream_handler = logging.StreamHandler(self._stream or sys.stderr)
+        stream_handler.setLevel(self._level)
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = [stream_handler]
+        logger_level = self._level
+        if self._file is not None:
+            file_handler = logging.FileHandler(self._file)
+            file_handler.setLevel(self._event_level)
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+            logger_level = min(logger_level, self._event_level)
+        records = queue.SimpleQueue()
+        self._queue_handler = _InProcessQueueHandler(records)
+        self._listener = QueueListener(records, *handlers,
+                                       respect_handler_level=True)
+        self._previous = (self._logger.level, self._logger.propagate)
+        self._logger.addHandler(self._queue_handler)
+        self._logger.setLevel(logger_level)
+        self._logger.propagate = False
+        self._listener.start()
+
+    def stop(self):
+        "Writes the records still queued and restores the mouse2afc logger"
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._queue_handler)
+        self._logger.setLevel(self._previous[0])
+        self._logger.propagate = self._previous[1]
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        self._queue_handler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
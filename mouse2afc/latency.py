@@ -0,0 +1,59 @@
+"Session-wide latency distributions of the protocol's phases"
+import json
+
+import numpy as np
+
+# Log-spaced from 1 us to 10 s, 4 bins per decade
+HISTOGRAM_EDGES_NS = np.logspace(3, 10, 29)
+PERCENTILES = (50, 95, 99)
+
+
+class PhaseLatencies:
+    """Every duration, in nanoseconds, recorded for each phase of a session.
+       Durations are only aggregated when asked for, so recording one is a
+       list append"""
+
+    def __init__(self):
+        self._durations_ns = {}
+
+    def record(self, phase, duration_ns):
+        durations_ns = self._durations_ns.get(phase)
+        if durations_ns is None:
+            durations_ns = self._durations_ns[phase] = []
+        durations_ns.append(duration_ns)
+
+    @property
+    def phases(self):
+        return list(self._durations_ns)
+
+    def durations(self, phase):
+        "The durations of `phase` in seconds, in the order they were recorded"
+        return np.array(self._durations_ns.get(phase, []), dtype=float) / 1e9
+
+    def histogram(self, phase):
+        "Returns the counts of the durations of `phase` in the default bins"
+        counts, _ = np.histogram(self._durations_ns.get(phase, []),
+                                 bins=HISTOGRAM_EDGES_NS)
+        return counts
+
+    def summary(self):
+        """Returns the count, mean, max and percentiles (in milliseconds) and
+           the histogram counts of every phase"""
+        summary = {}
+        for phase, durations_ns in self._durations_ns.items():
+            durations_ms = np.array(durations_ns, dtype=float) / 1e6
+            percentiles = np.percentile(durations_ms, PERCENTILES)
+            phase_summary = {'count': len(durations_ms),
+                             'mean_ms': float(durations_ms.mean()),
+                             'max_ms': float(durations_ms.max())}
+            for percentile, value in zip(PERCENTILES, percentiles):
+                phase_summary[f'p{percentile}_ms'] = float(value)
+            phase_summary['histogram'] = self.histogram(phase).tolist()
+            summary[phase] = phase_summary
+        return summary
+
+    def export(self, file_):
+        "Writes the `summary` and the histogram bins to the json file `file_`"
+        with open(file_, 'w') as json_file:
+            json.dump({'histogram_edges_ns': HISTOGRAM_EDGES_NS.tolist(),
+                       'phases': self.summary()}, json_file, indent=1)
@@ -2,8 +2,17 @@ import logging
 
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+from mouse2afc.audio import AudioPlayer
+from mouse2afc.calibration import LiquidCalibration
 from mouse2afc.data import Data
-from mouse2afc.state_matrix import StateMatrix
+from mouse2afc.draw_params_channel import DrawParamsChannel
+from mouse2afc.plot_feed import PlotFeed
+from mouse2afc.session_file import SessionWriter
+from mouse2afc.softcodes import SoftcodeDispatcher
+from mouse2afc.state_matrix import StateMatrixCache
+from mouse2afc.state_matrix import state_matrix_signature
 from mouse2afc.task_parameters import TaskParameters
 
 
@@ -22,38 +31,299 @@ NUM_TRIALS_TO_GENERATE = 1
 START_FROM = 0
 
 class Mouse2AFC:
-    def __init__(self, bpod, config_file=None):
+    def __init__(self, bpod, config_file=None, seed=None, open_gui=True,
+                 clock=time.time, session_path=None, draw_params_path=None,
+                 softcode_worker=True, audio_sink=None,
+                 calibration_file=None, water_budget=None, water_received=0,
+                 plot_feed_path=None, subject=None, snapshot=None):
+        """`clock` returns the current time in seconds, it's only replaced
+           when the protocol runs in virtual time (e.g. in a simulation),
+           along with `softcode_worker`: the softcodes are then handled
+           inline rather than on a worker thread (see `softcodes`).
+           The sounds of the softcodes are played through `audio_sink` if
+           given, e.g. an `audio.SoundDeviceSink` (see `audio`). The valves'
+           liquid calibration is loaded from `calibration_file` if given,
+           the `calibration.CalibrationTables` are used otherwise. The
+           session stops once the animal received `water_budget` ul if
+           given, counting the `water_received` before the session.
+           Every finished trial is appended to the session directory
+           `session_path` if given (see `session_file`), with the name of
+           the animal, `subject`, in its metadata. The visual
+           stimuli parameters are published to a renderer through the
+           shared-memory file `draw_params_path` if given (see
+           `draw_params_channel`). A summary of every finished trial is
+           pushed to the live plot feed `plot_feed_path` if given (see
+           `plot_feed`). The task parameters are copied from `snapshot` if
+           given, the parameters of `config_file` already loaded with
+           `task_parameters.load_snapshot()`."""
         self._bpod = bpod
+        self._clock = clock
+        self._config_file = config_file
+        self._session_path = session_path
+        self._subject = subject
+        self._plot_feed_path = plot_feed_path
         self._task_parameters = TaskParameters(
-            file_=config_file).task_parameters
-        self._data = Data(self._bpod.session, self._task_parameters)
-
-    def my_softcode_handler(self,_softcode):
-        "Defines what each SoftCode output does"
-        if _softcode == 1:
-            self._data.custom.trials.early_withdrawal_timer_start = time.time()
-        elif _softcode == 2:
-            if (time.time() -
-                self._data.custom.trials.early_withdrawal_timer_start >
-                self._task_parameters.timeout_early_withdrawal):
-
-                self._bpod.trigger_event_by_name(event_name = 'SoftCode1',
-                                                 event_data = None)
-
-    def run(self):
-        "Runs the protocol"
-        i_trial = 0
+            file_=config_file, open_gui=open_gui,
+            snapshot=snapshot).task_parameters
+        calibration = None if calibration_file is None else \
+            LiquidCalibration.load(calibration_file)
+        self._data = Data(self._bpod.session, self._task_parameters, seed,
+                          calibration)
+        self._data.custom.reward_ledger.budget = water_budget
+        self._data.custom.reward_ledger.previous_total = water_received
+        if draw_params_path is not None:
+            self._data.dots_mapped_file = DrawParamsChannel(draw_params_path)
+        self._state_matrices = StateMatrixCache(self._bpod)
+        self._num_trials = 0
+        self._session_writer = None
+        self._plot_feed = None
+        # When the last trial ended, in `time.perf_counter_ns()`
+        self._trial_end = None
+        self._softcodes = SoftcodeDispatcher(
+            worker=softcode_worker, latencies=self._data.timer.latencies)
+        # Timed from when the softcodes are received, and the event
+        # triggered while the trial that sent them runs
+        self._softcodes.register(
+            1, self._start_early_withdrawal_timer, inline=True)
+        self._softcodes.register(
+            2, self._check_early_withdrawal_timeout, inline=True)
+        if self._data.dots_mapped_file is not None:
+            # A single store in the shared memory, run in the Bpod's reading
+            # thread so the stimulus isn't delayed by a slower handler
+            self._softcodes.register(
+                5, self._data.dots_mapped_file.start, inline=True)
+            self._softcodes.register(
+                6, self._data.dots_mapped_file.stop, inline=True)
+        self._audio = None
+        if audio_sink is not None:
+            self._audio = AudioPlayer(audio_sink)
+            self._audio.register(self._softcodes)
+
+    @property
+    def task_parameters(self):
+        return self._task_parameters
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def num_trials(self):
+        "The number of trials done"
+        return self._num_trials
+
+    @property
+    def softcodes(self):
+        "The `SoftcodeDispatcher`, to register more softcode handlers"
+        return self._softcodes
+
+    def _start_early_withdrawal_timer(self):
+        "SoftCode 1"
+        self._data.custom.trials.early_withdrawal_timer_start = self._clock()
+
+    def _check_early_withdrawal_timeout(self):
+        "SoftCode 2"
+        if (self._clock() -
+            self._data.custom.trials.early_withdrawal_timer_start >
+            self._task_parameters.timeout_early_withdrawal):
+
+            self._bpod.trigger_event_by_name(event_name = 'SoftCode1',
+                                             event_data = None)
+
+    def _open_session_writer(self):
+        if self._session_path is None:
+            return None
+        channels = getattr(self._bpod.hardware, 'channels', None)
+        return SessionWriter(
+            self._session_path, self._data,
+            event_names=getattr(channels, 'event_names', None),
+            metadata={'config_file': self._config_file,
+                      'subject': self._subject})
+
+    def _patch_state_matrix(self, sma, i_trial):
+        """Patches the values `update()` changed since into the state matrix
+           of `i_trial` built ahead"""
+        with self._data.timer.span('build_state_matrix', i_trial):
+            return self._state_matrices.patch(
+                sma, self._task_parameters, self._data, i_trial)
+
+    def _log_trial(self, i_trial):
+        trials = self._data.custom.trials
+        logger.info(f'Trial {i_trial} done', extra={
+            'trial': i_trial,
+            'choice_correct': trials.choice_correct[i_trial],
+            'rewarded': trials.rewarded[i_trial],
+            'reward_received_total': trials.reward_received_total[i_trial],
+            'phases_ms': self._data.timer.pop_phases(i_trial)})
+
+    def _log_latencies(self):
+        for phase, summary in self._data.timer.latencies.summary().items():
+            logger.info(f"{phase}: p50 {summary['p50_ms']:.3f} ms, "
+                        f"p95 {summary['p95_ms']:.3f} ms, "
+                        f"p99 {summary['p99_ms']:.3f} ms, "
+                        f"max {summary['max_ms']:.3f} ms")
+
+    def prepare_trial(self, i_trial):
+        """Prepares trial `i_trial` while the trial before it is running,
+           for `next_state_matrix()`. Returns the state matrix along with
+           the signature it was built from, or None if the trial can't be
+           generated ahead."""
+        if not self._data.custom.prepare_next_trial(i_trial):
+            return None
+        # Taken first, the task parameters updated while the matrix is built
+        # have it built again
+        signature = state_matrix_signature(
+            self._task_parameters, self._data, i_trial)
+        # Off the critical path, the matrix the trial gets, patched or built
+        # again, is timed as `build_state_matrix`
+        with self._data.timer.span('prepare_state_matrix', i_trial):
+            sma = self._state_matrices.state_matrix(
+                self._task_parameters, self._data, i_trial)
+        return sma, signature
+
+    def next_state_matrix(self, i_trial, prepared):
+        """Returns the state matrix of `i_trial` once the trial before it is
+           updated: the one `prepared` by `prepare_trial()` with the timers
+           the staircases moved patched in, or built again if its outcome
+           changed any of the other values it depends on"""
+        if prepared is not None and prepared[1] == state_matrix_signature(
+                self._task_parameters, self._data, i_trial):
+            return self._patch_state_matrix(prepared[0], i_trial)
+        return self.build_state_matrix(i_trial)
+
+    # The steps of a session, in order: `start_session()`, then for every
+    # trial `build_state_matrix()`, `send_trial()`, `run_trial()`,
+    # `update_trial()`, `save_trial()` and `monitor_trial()` until
+    # `run_trial()` returns False or `budget_reached()`, and
+    # `end_session()`. Pipelined, `prepare_trial()` runs along with
+    # `run_trial()` and `next_state_matrix()` builds the matrices but the
+    # first. `run()` runs them in a loop, `session_runner` on asyncio.
+
+    def start_session(self):
+        "Generates the first trial and starts the session's helpers"
         self._data.custom.assign_future_trials(START_FROM,NUM_TRIALS_TO_GENERATE)
-        self._data.custom.generate_next_trial(i_trial)
-        self._bpod.softcode_handler_function = self.my_softcode_handler
-        while True:
-            logger.error('Before StateMatrix()')
-            sma = StateMatrix(
-                self._bpod, self._task_parameters, self._data, i_trial)
-            logger.error('Before send_state_machine()')
+        self._data.custom.generate_next_trial(0)
+        self._bpod.softcode_handler_function = self._softcodes
+        if self._audio is not None:
+            self._audio.open()
+        self._softcodes.start()
+        self._session_writer = self._open_session_writer()
+        self._plot_feed = None if self._plot_feed_path is None else \
+            PlotFeed(self._plot_feed_path)
+        self._trial_end = None
+
+    def end_session(self):
+        self._softcodes.stop()
+        if self._audio is not None:
+            self._audio.close()
+        if self._session_writer is not None:
+            self._session_writer.close()
+        if self._plot_feed is not None:
+            self._plot_feed.close()
+        if self._data.dots_mapped_file is not None:
+            self._data.dots_mapped_file.close()
+        self._log_latencies()
+
+    def build_state_matrix(self, i_trial):
+        with self._data.timer.span('build_state_matrix', i_trial):
+            return self._state_matrices.state_matrix(
+                self._task_parameters, self._data, i_trial)
+
+    def send_trial(self, i_trial, sma):
+        with self._data.timer.span('send_state_matrix', i_trial):
             self._bpod.send_state_machine(sma)
-            logger.error('Before run_state_machine()')
-            if not self._bpod.run_state_machine(sma):
-                break
+        self._data.custom.draw_params = sma.draw_params
+        if self._data.dots_mapped_file is not None:
+            self._data.dots_mapped_file.publish(i_trial, sma.draw_params)
+
+    def run_trial(self, i_trial, sma):
+        """Runs the state matrix sent, `sma`, on the Bpod until the trial
+           ends. Returns False if the Bpod ran no trial, the session is
+           over then."""
+        if self._trial_end is not None:
+            self._data.timer.record('between_trials', i_trial,
+                                    time.perf_counter_ns() - self._trial_end)
+        if not self._bpod.run_state_machine(sma):
+            return False
+        self._trial_end = time.perf_counter_ns()
+        return True
+
+    def record_pause(self, i_trial, duration_ns):
+        """Records that the session was paused for `duration_ns` before
+           trial `i_trial`, which isn't a latency of the protocol"""
+        self._data.timer.record('handle_pause', i_trial, duration_ns)
+        if self._trial_end is not None:
+            self._trial_end += duration_ns
+
+    def update_trial(self, i_trial):
+        with self._data.timer.span('update_custom_data_fields', i_trial):
             self._data.custom.update(i_trial)
-            i_trial += 1
+        self._num_trials = i_trial + 1
+
+    def trial_row(self, i_trial, draw_params=None):
+        """Returns a copy of the updated trial `i_trial`, drawn with
+           `draw_params` (the last ones sent if None), for `save_row()`, or
+           None if the session isn't saved"""
+        if self._session_writer is None:
+            return None
+        return self._session_writer.row(i_trial, draw_params)
+
+    def save_row(self, i_trial, row):
+        """Appends the `trial_row()` of trial `i_trial` to the session file.
+           Only the session file is used, so it can be called from another
+           thread than the other steps."""
+        if row is not None:
+            # Only known once the trial's row is written, so the session
+            # file holds 0 for it
+            with self._data.timer.span('save_data', i_trial):
+                self._session_writer.write(row)
+
+    def save_trial(self, i_trial, draw_params=None):
+        "Appends the updated trial `i_trial` to the session file"
+        self.save_row(i_trial, self.trial_row(i_trial, draw_params))
+
+    def monitor_trial(self, i_trial):
+        "Pushes the saved trial `i_trial` to the plot feed and the log"
+        if self._plot_feed is not None:
+            with self._data.timer.span('send_plot_data', i_trial):
+                self._plot_feed.push(i_trial, self._data)
+        self._log_trial(i_trial)
+
+    def budget_reached(self):
+        reward_ledger = self._data.custom.reward_ledger
+        if reward_ledger.budget_reached:
+            logger.info(f'Stopping the session, the water budget of '
+                        f'{reward_ledger.budget} ul is reached')
+        return reward_ledger.budget_reached
+
+    def run(self, pipelined=False):
+        """Runs the protocol. If `pipelined`, the next trial and its state
+           matrix are prepared on a worker thread while the current trial
+           runs. The timers the staircases move are patched in once the
+           current trial is updated, the state matrix is only rebuilt if
+           its outcome changed any of the other values it depends on. See
+           `session_runner` to run it on asyncio instead."""
+        i_trial = 0
+        self.start_session()
+        executor = ThreadPoolExecutor(max_workers=1) if pipelined else None
+        sma = self.build_state_matrix(i_trial)
+        try:
+            while True:
+                self.send_trial(i_trial, sma)
+                if pipelined:
+                    next_trial = executor.submit(
+                        self.prepare_trial, i_trial + 1)
+                if not self.run_trial(i_trial, sma):
+                    break
+                prepared = next_trial.result() if pipelined else None
+                self.update_trial(i_trial)
+                self.save_trial(i_trial)
+                self.monitor_trial(i_trial)
+                if self.budget_reached():
+                    break
+                i_trial += 1
+                sma = self.next_state_matrix(i_trial, prepared)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            self.end_session()
@@ -0,0 +1,363 @@
+"""Live monitoring of a session, plotted by another process.
+
+The protocol pushes a summary of every finished trial into a ring buffer in
+a memory-mapped file, without locks or waiting for the plotting process: a
+push is one record store and a counter increment. The file has a fixed
+layout, all values little-endian:
+
+    offset  type        field
+    0       char[4]     magic, b'M2PF'
+    4       uint32      layout version, `VERSION`
+    8       uint32      capacity, the number of records of the ring
+    12      uint32      reserved
+    16      uint64      head: number of records pushed, the record of
+                        push n is at n % capacity and is complete once head
+                        is above n
+    24      record[c]   the `RECORD` of the trials, NaN for the values unset
+
+`PlotFeedReader` reads the records pushed since its last read, losing the
+ones the protocol overwrote, or may be overwriting, if it fell `capacity`
+trials behind.
+`LivePlot` draws the outcome raster, the rolling performance and bias and
+the `min_sample` and `feedback_delay` staircases with matplotlib. It adds
+only the new records to what it keeps, the last `history` trials, and draws
+at most `max_points` points per line however long the session.
+`run_plotter` refreshes it from a feed until its window is closed."""
+import logging
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'M2PF'
+VERSION = 1
+DEFAULT_CAPACITY = 4096
+# Of the drawn lines, and of the trials of the outcome raster
+DEFAULT_MAX_POINTS = 200
+# Of the lines, in trials
+DEFAULT_HISTORY = 2000
+# Of the rolling performance and bias, in trials
+DEFAULT_ROLLING_WINDOW = 20
+# Between the refreshes of the plot, in seconds
+DEFAULT_REFRESH_INTERVAL = 1
+
+RECORD = np.dtype([
+    ('trial', '<i8'),
+    ('start_time', '<f8'),
+    ('dv', '<f8'),
+    ('choice_left', '<f8'),
+    ('choice_correct', '<f8'),
+    ('rewarded', '<f8'),
+    ('early_withdrawal', '<f8'),
+    ('fix_broke', '<f8'),
+    ('missed_choice', '<f8'),
+    ('catch_trial', '<f8'),
+    ('left_bias', '<f8'),
+    ('min_sample', '<f8'),
+    ('feedback_delay', '<f8'),
+])
+_HEADER = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('capacity', '<u4'),
+    ('reserved', '<u4'),
+    ('head', '<u8'),
+])
+
+# Of the outcome raster
+OUTCOMES = ('correct', 'error', 'early_withdrawal', 'fix_broke',
+            'missed_choice')
+_OUTCOME_COLORS = ('tab:green', 'tab:red', 'tab:orange', 'tab:gray',
+                   'black')
+
+
+class PlotFeedError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise PlotFeedError(message)
+
+
+def _value(value):
+    return math.nan if value is None else float(value)
+
+
+def _map(path, mode, capacity=None):
+    "Returns the whole, header and records of the feed file `path`"
+    if capacity is None:
+        capacity = int(np.memmap(path, dtype=_HEADER, mode='r',
+                                 shape=())['capacity'])
+    layout = np.dtype([('header', _HEADER), ('records', RECORD, (capacity,))])
+    buffer = np.memmap(path, dtype=layout, mode=mode, shape=())
+    return buffer, buffer['header'], buffer['records']
+
+
+class PlotFeed:
+    "The protocol's end of the feed, creating (or resetting) `path`"
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self._buffer, self._header, self._records = _map(path, 'w+', capacity)
+        self._header['magic'] = MAGIC
+        self._header['version'] = VERSION
+        self._header['capacity'] = capacity
+        self._capacity = capacity
+        self._head = 0
+        self._buffer.flush()
+
+    @property
+    def head(self):
+        return self._head
+
+    def push(self, i_trial, data):
+        "Pushes the summary of the finished trial `i_trial` of `data`"
+        trials = data.custom.trials
+        self._records[self._head % self._capacity] = (
+            i_trial, data.raw_data.trial_start_timestamp(i_trial),
+            _value(trials.DV[i_trial]),
+            _value(trials.choice_left[i_trial]),
+            _value(trials.choice_correct[i_trial]),
+            _value(trials.rewarded[i_trial]),
+            _value(trials.early_withdrawal[i_trial]),
+            _value(trials.fix_broke[i_trial]),
+            _value(trials.missed_choice[i_trial]),
+            _value(trials.catch_trial[i_trial]),
+            _value(data.task_parameters.calc_left_bias),
+            _value(trials.min_sample[i_trial]),
+            _value(trials.feedback_delay[i_trial]))
+        # Published only once the record is complete
+        self._head += 1
+        self._header['head'] = self._head
+
+    def close(self):
+        self._buffer.flush()
+        del self._buffer, self._header, self._records
+
+
+class PlotFeedReader:
+    "The plotting end of the feed at `path`"
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            error(f'No plot feed at {path}.')
+        header = np.memmap(path, dtype=_HEADER, mode='r', shape=())
+        if header['magic'].item() != MAGIC or \
+                int(header['version']) != VERSION:
+            error(f'{path} is not a version {VERSION} plot feed.')
+        self._buffer, self._header, self._records = _map(path, 'r')
+        self._capacity = len(self._records)
+        self._tail = 0
+        self.lost = 0
+
+    def read(self):
+        """Returns the records pushed since the last read, as an array of
+           `RECORD`. The records overwritten before they were read are
+           counted in `lost`."""
+        head = int(self._header['head'])
+        start = max(self._tail, head - self._capacity)
+        records = self._records[np.arange(start, head) % self._capacity]
+        # The protocol may have overwritten the oldest ones meanwhile, and
+        # may be writing push number head, over record head - capacity
+        overwritten = int(self._header['head']) + 1 - self._capacity - start
+        if overwritten > 0:
+            records = records[overwritten:]
+            start += overwritten
+        self.lost += start - self._tail
+        self._tail = head
+        return records
+
+    def close(self):
+        del self._buffer, self._header, self._records
+
+
+def _last(values, count):
+    "The last `count` of `values`, none if `count` is 0"
+    return values[max(0, len(values) - count):]
+
+
+def _rolling_mean(values, window, previous=()):
+    """Mean of the last `window` values not NaN at every value, NaN if none,
+       `previous` the values before the first"""
+    previous = _last(np.asarray(previous, dtype=float), window - 1)
+    values = np.concatenate([previous, values])
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0))
+    counts = np.cumsum(valid)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts)[len(previous):]
+
+
+def downsample(x, y, max_points):
+    """Returns `x` and `y` averaged over at most `max_points` consecutive
+       bins, the NaN values of `y` left out"""
+    if len(x) <= max_points:
+        return x, y
+    starts = np.linspace(0, len(x), max_points, endpoint=False).astype(int)
+    valid = ~np.isnan(y)
+    counts = np.add.reduceat(valid.astype(int), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.add.reduceat(x, starts) / np.diff(starts, append=len(x)),
+                np.add.reduceat(np.where(valid, y, 0), starts) / counts)
+
+
+def outcomes(records):
+    "Returns the index in `OUTCOMES` of the outcome of every record"
+    outcome = np.where(records['choice_correct'] == 1, 0, 1)
+    outcome[records['missed_choice'] == 1] = 4
+    outcome[records['fix_broke'] == 1] = 3
+    outcome[records['early_withdrawal'] == 1] = 2
+    return outcome
+
+
+class LivePlot:
+    """The plots of the records of a session, added with `update()`. Only
+       the last `max_points` trials are in the outcome raster, the lines of
+       the last `history` trials are downsampled to `max_points` points."""
+
+    # The lines: the rolling fractions of correct and of left choices, and
+    # the values of the records as they are
+    _ROLLING = {'performance': 'choice_correct',
+                'left_choices': 'choice_left'}
+    _VALUES = ('left_bias', 'min_sample', 'feedback_delay')
+
+    def __init__(self, max_points=DEFAULT_MAX_POINTS,
+                 rolling_window=DEFAULT_ROLLING_WINDOW,
+                 history=DEFAULT_HISTORY):
+        self._max_points = max_points
+        self._rolling_window = rolling_window
+        self._history = history
+        self._num_records = 0
+        self._raster_records = np.empty(0, dtype=RECORD)
+        self._trials = np.empty(0)
+        self._values = {name: np.empty(0)
+                        for name in (*self._ROLLING, *self._VALUES)}
+        # The values of the last trials, the rolling means continue from
+        self._previous = {field: np.empty(0)
+                          for field in self._ROLLING.values()}
+        self._figure = None
+
+    @property
+    def num_records(self):
+        return self._num_records
+
+    def _append(self, name, values):
+        self._values[name] = _last(
+            np.concatenate([self._values[name], values]), self._history)
+
+    def update(self, records):
+        """Adds `records` to the plots, at a cost independent of the number
+           of records added before"""
+        if not len(records):
+            return
+        self._num_records += len(records)
+        self._raster_records = _last(
+            np.concatenate([self._raster_records, records]), self._max_points)
+        self._trials = _last(np.concatenate([self._trials, records['trial']]),
+                             self._history)
+        for name, field in self._ROLLING.items():
+            self._append(name, _rolling_mean(
+                records[field], self._rolling_window, self._previous[field]))
+            self._previous[field] = _last(
+                np.concatenate([self._previous[field], records[field]]),
+                self._rolling_window - 1)
+        for name in self._VALUES:
+            self._append(name, records[name])
+
+    def series(self):
+        """Returns the points to draw, {name: (x, y)}: the 'outcome' raster
+           (trial, `OUTCOMES` index), 'performance' and 'left_choices', the
+           rolling fractions of correct and of left choices, 'left_bias',
+           'min_sample' and 'feedback_delay'"""
+        raster = self._raster_records
+        series = {'outcome': (raster['trial'], outcomes(raster))}
+        trial = self._trials.astype(float)
+        for name, values in self._values.items():
+            series[name] = downsample(trial, values, self._max_points)
+        return series
+
+    def draw(self):
+        "Draws the plots, in a new matplotlib figure on the first call"
+        if self._figure is None:
+            self._create_figure()
+        series = self.series()
+        trial, outcome = series['outcome']
+        self._raster.set_offsets(np.column_stack([trial, outcome]))
+        self._raster.set_color(np.take(_OUTCOME_COLORS, outcome))
+        for name, line in self._lines.items():
+            line.set_data(*series[name])
+        for axes in self._axes:
+            axes.relim()
+            axes.autoscale_view(scaley=axes is not self._axes[0])
+        self._figure.canvas.draw_idle()
+
+    def _create_figure(self):
+        try:
+            from matplotlib import pyplot
+        except ImportError:
+            error('Plotting requires the matplotlib package.')
+        self._pyplot = pyplot
+        self._figure, self._axes = pyplot.subplots(4, 1, sharex=True,
+                                                   figsize=(8, 9))
+        outcome_axes, performance_axes, bias_axes, staircase_axes = \
+            self._axes
+        self._raster = outcome_axes.scatter([], [], marker='|')
+        outcome_axes.set_yticks(range(len(OUTCOMES)))
+        outcome_axes.set_yticklabels(OUTCOMES)
+        outcome_axes.set_ylim(len(OUTCOMES) - 0.5, -0.5)
+        self._lines = {
+            'performance': performance_axes.plot([], [], label='correct')[0],
+            'left_choices': bias_axes.plot([], [], label='left choices')[0],
+            'left_bias': bias_axes.plot([], [], label='left bias')[0],
+            'min_sample': staircase_axes.plot([], [],
+                                              label='min sample')[0],
+            'feedback_delay': staircase_axes.plot([], [],
+                                                  label='feedback delay')[0]}
+        performance_axes.set_ylabel('Performance')
+        bias_axes.set_ylabel('Bias')
+        staircase_axes.set_ylabel('Seconds')
+        staircase_axes.set_xlabel('Trial')
+        for axes in self._axes[1:]:
+            axes.legend(loc='upper left')
+        self._figure.tight_layout()
+        pyplot.show(block=False)
+
+    @property
+    def closed(self):
+        "Whether the figure was drawn then closed"
+        return self._figure is not None and \
+            not self._pyplot.fignum_exists(self._figure.number)
+
+
+def run_plotter(path, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                max_points=DEFAULT_MAX_POINTS, history=DEFAULT_HISTORY):
+    "Plots the feed at `path` live, until the window is closed"
+    reader = PlotFeedReader(path)
+    plot = LivePlot(max_points, history=history)
+    try:
+        while True:
+            plot.update(reader.read())
+            plot.draw()
+            if plot.closed:
+                break
+            plot._pyplot.pause(refresh_interval)
+    finally:
+        if reader.lost:
+            logger.warning(f'{reader.lost} trials were overwritten before '
+                           f'being plotted')
+        reader.close()
+
+
+def start_plotter(path, **kwargs):
+    """Returns the process, started, plotting the feed at `path` (see
+       `run_plotter` for the keyword arguments)"""
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_plotter, args=(path,), kwargs=kwargs,
+        name='mouse2afc-plotter', daemon=True)
+    process.start()
+    return process
@@ -0,0 +1,44 @@
+"Seeded random number streams of a session"
+import numpy as np
+
+
+class SessionRNG:
+    """Independent `numpy.random.Generator` substreams of a session, all
+       spawned from a single seed so that a session can be replayed and
+       sessions simulated in parallel don't share any state.
+
+       Every stream is an attribute named after what it draws, e.g.
+       `rng.stimulus.random()`. New streams must be appended to `STREAMS`
+       so that the existing ones keep their values for a given seed."""
+    STREAMS = (
+        'stimulus',  # Stimulus omega and rewarded side of future trials
+        'opto',  # Optogenetics trials
+        'forced_led',  # Forced LED trials
+        'delays',  # Stimulus delay, min sampling and feedback delay
+    )
+
+    def __init__(self, seed=None):
+        if isinstance(seed, np.random.SeedSequence):
+            self._seed_sequence = seed
+        else:
+            self._seed_sequence = np.random.SeedSequence(seed)
+        streams_seeds = self._seed_sequence.spawn(len(self.STREAMS))
+        for name, stream_seed in zip(self.STREAMS, streams_seeds):
+            setattr(self, name, np.random.default_rng(stream_seed))
+
+    @property
+    def seed(self):
+        "The root seed of the session, that it may have been spawned from"
+        return self._seed_sequence.entropy
+
+    @property
+    def spawn_key(self):
+        """Which of the sequences spawned from `seed` the session's is, ()
+           if it wasn't spawned. The session is replayed by passing
+           `numpy.random.SeedSequence(seed, spawn_key=spawn_key)`"""
+        return self._seed_sequence.spawn_key
+
+    def spawn(self, num_sessions):
+        "Returns `num_sessions` independent `SessionRNG`s, e.g. for workers"
+        return [SessionRNG(seed_sequence) for seed_sequence in
+                self._seed_sequence.spawn(num_sessions)]
@@ -0,0 +1,129 @@
+"Running trial statistics that are updated in constant time per trial"
+from collections import deque
+
+# Of the `RewardLedger` rolling total, in seconds
+REWARD_WINDOW = 3600
+
+
+class RingBuffer:
+    "Keeps the last `size` values pushed and their running sum"
+    def __init__(self, size):
+        self._buffer = [0] * size
+        self._pos = 0
+        self.count = 0
+        self.sum = 0
+
+    def push(self, value):
+        self.sum += value - self._buffer[self._pos]
+        self._buffer[self._pos] = value
+        self._pos = (self._pos + 1) % len(self._buffer)
+        self.count = min(self.count + 1, len(self._buffer))
+
+    def __len__(self):
+        return self.count
+
+
+class BiasTracker:
+    """Counts correct and completed choices per side over the last `window`
+       trials, replacing the re-slicing of the trial lists every update"""
+    def __init__(self, window):
+        self._left_rewd = RingBuffer(window)
+        self._left_rew_done = RingBuffer(window)
+        self._right_rewd = RingBuffer(window)
+        self._right_rew_done = RingBuffer(window)
+
+    def push(self, choice_correct, choice_left, left_rewarded):
+        choice_made = choice_left is not None
+        self._left_rewd.push(int(bool(choice_correct and choice_left)))
+        self._left_rew_done.push(int(bool(left_rewarded and choice_made)))
+        self._right_rewd.push(int(bool(choice_correct and not choice_left)))
+        self._right_rew_done.push(int(bool(not left_rewarded and choice_made)))
+
+    @staticmethod
+    def _side_performance(rewd, rew_done, other_rewd, other_rew_done):
+        if not rew_done:
+            # Since we don't have trials on this side, then measure by how good
+            # the animals was performing on the other side. If it did bad on
+            # the side then then consider this side performance to be good so
+            # it'd still get more trials on the other side.
+            denominator = other_rew_done * 2 if other_rew_done else 1
+            return 1 - (other_rewd / (denominator * 2))
+        return rewd / rew_done
+
+    @property
+    def left_bias(self):
+        perf_left = self._side_performance(
+            self._left_rewd.sum, self._left_rew_done.sum,
+            self._right_rewd.sum, self._right_rew_done.sum)
+        perf_right = self._side_performance(
+            self._right_rewd.sum, self._right_rew_done.sum,
+            self._left_rewd.sum, self._left_rew_done.sum)
+        return (perf_left - perf_right) / 2 + 0.5
+
+
+class PerformanceTracker:
+    "Cumulative and last-`window` counts of choices made and rewards"
+    def __init__(self, window):
+        self.window = window
+        self.trials_count = 0
+        self.choice_made_count = 0
+        self.rewarded_count = 0
+        self._recent_rewarded = RingBuffer(window)
+
+    def push(self, choice_correct, rewarded):
+        self.trials_count += 1
+        self.choice_made_count += choice_correct is not None
+        self.rewarded_count += rewarded is True
+        self._recent_rewarded.push(int(bool(rewarded)))
+
+    @property
+    def recent_rewarded_count(self):
+        return self._recent_rewarded.sum
+
+
+class RewardLedger:
+    """Volume of water, in ul, delivered per valve and in total over the
+       session, and over the last `window` seconds. Deliveries are pushed in
+       time order. With a `budget`, the budget is reached once the water the
+       animal had received before the session, `previous_total`, plus the
+       session's total reaches it"""
+    def __init__(self, window=REWARD_WINDOW, budget=None, previous_total=0):
+        self.window = window
+        self.budget = budget
+        self.previous_total = previous_total
+        self.total = 0
+        # Of the last delivery pushed, None before the first one
+        self.last_time = None
+        self._valve_totals = {}
+        self._recent = deque()
+        self._recent_total = 0
+
+    def push(self, time, valve, volume):
+        self.total += volume
+        self.last_time = time
+        self._valve_totals[valve] = self._valve_totals.get(valve, 0) + volume
+        self._recent.append((time, volume))
+        self._recent_total += volume
+        self._expire(time)
+
+    def _expire(self, now):
+        while self._recent and self._recent[0][0] <= now - self.window:
+            self._recent_total -= self._recent.popleft()[1]
+        if not self._recent:
+            # Drops the rounding errors accumulated
+            self._recent_total = 0
+
+    def valve_total(self, valve):
+        return self._valve_totals.get(valve, 0)
+
+    def rolling_total(self, now=None):
+        """The volume delivered over the `window` up to `now`, or up to the
+           last delivery if None"""
+        if now is not None:
+            self._expire(now)
+        return self._recent_total
+
+    @property
+    def budget_reached(self):
+        return self.budget is not None and \
+            self.previous_total + self.total >= self.budget
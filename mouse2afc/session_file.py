@@ -0,0 +1,391 @@
+"""Append-only, columnar session files.
+
+`SessionWriter` appends every finished trial of a session to a directory
+holding one raw binary file per column, so that a column is a plain array
+on disk that `SessionReader` memory-maps without parsing anything:
+
+    schema.json                   Columns, their dtype and shape, and the
+                                  session's metadata, written first
+    trials.<field>                One per `Column` of `Trials`, ...
+    timer.<field>                 ... of `TimerData` ...
+    draw_params.<field>           ... and per field of `DrawParams`
+    trials.mask, timer.mask, ...  (trials, columns) bools, True for None
+    raw.trial_start_timestamp     The trial's start timestamp
+    raw.states.state              `MatrixState` value (-1 if unknown) of
+    raw.states.start                every state occurrence, its start
+    raw.states.end                  and end timestamps
+    raw.states.offsets            End of every trial's states in the above
+    raw.events.event              Event id of every event occurrence and
+    raw.events.time                 its host timestamp
+    raw.events.offsets            End of every trial's events
+    commits                       The trial numbers written, appended last
+    index.json                    Number of trials, written on close
+    latencies.json                The session's `TimerData.latencies`,
+                                  written on close
+
+A trial only counts once its number is in `commits`, which is written after
+all its columns have been flushed, so a session that dies mid-trial loses
+at most that trial. Files are fsync'ed every `fsync_every` trials to bound
+what an OS crash or power loss costs: as the commits may then have reached
+the disk before the columns, trials past the end of any column don't count
+either."""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from mouse2afc.columns import Column
+from mouse2afc.data import DrawParams
+from mouse2afc.definitions.matrix_state import MatrixState
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+DEFAULT_FSYNC_EVERY = 10
+
+_SCHEMA_FILE = 'schema.json'
+_INDEX_FILE = 'index.json'
+_LATENCIES_FILE = 'latencies.json'
+_COMMITS_FILE = 'commits'
+_COMMIT_DTYPE = np.dtype('<i8')
+_OFFSET_DTYPE = np.dtype('<i8')
+_RAW_COLUMNS = {
+    'raw.trial_start_timestamp': '<f8',
+    'raw.states.state': '<i2',
+    'raw.states.start': '<f8',
+    'raw.states.end': '<f8',
+    'raw.states.offsets': _OFFSET_DTYPE.str,
+    'raw.events.event': '<i2',
+    'raw.events.time': '<f8',
+    'raw.events.offsets': _OFFSET_DTYPE.str,
+}
+# Of the states and events of all the trials, indexed by the offsets
+_RECORD_COLUMNS = ('raw.states.state', 'raw.states.start', 'raw.states.end',
+                   'raw.events.event', 'raw.events.time')
+_STATES_VALUES = {matrix_state.name: matrix_state.value
+                  for matrix_state in MatrixState}
+_DRAW_PARAMS_FIELDS = tuple(vars(DrawParams()))
+
+
+class SessionFileError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SessionFileError(message)
+
+
+def _fields_columns(obj):
+    return [(name, value) for name, value in vars(obj).items()
+            if isinstance(value, Column)]
+
+
+def _draw_param_value(value):
+    if value is None:
+        return None
+    return getattr(value, 'value', value)
+
+
+def _write_json(path, content):
+    "Writes atomically, a crash leaves either the old file or the new one"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(content, json_file, indent=1)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class SessionWriter:
+    """Appends the trials of `data` to the session directory `path`, which
+       must not hold a session already. `event_names` (e.g. the Bpod's
+       `hardware.channels.event_names`) and `metadata` are saved in the
+       schema. Use as a context manager or call `close()` at the end.
+       A trial is either `append()`ed, or copied with `row()` and the copy
+       `write()`n, e.g. on a thread of its own so that the writes and
+       fsyncs don't hold up the trials."""
+
+    def __init__(self, path, data, event_names=None, metadata=None,
+                 fsync_every=DEFAULT_FSYNC_EVERY):
+        self._path = path
+        self._data = data
+        self._fsync_every = fsync_every
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, _SCHEMA_FILE)):
+            error(f'{path} already holds a session.')
+        self._groups = {
+            'trials': _fields_columns(data.custom.trials),
+            'timer': _fields_columns(data.timer),
+        }
+        columns = {}
+        for group, group_columns in self._groups.items():
+            for name, column in group_columns:
+                columns[f'{group}.{name}'] = {
+                    'dtype': column.values.dtype.str,
+                    'shape': list(column.values.shape[1:])}
+        for name in _DRAW_PARAMS_FIELDS:
+            columns[f'draw_params.{name}'] = {'dtype': '<f8', 'shape': []}
+        for name, dtype in _RAW_COLUMNS.items():
+            columns[name] = {'dtype': dtype, 'shape': []}
+        self._dtypes = {name: np.dtype(column['dtype'])
+                        for name, column in columns.items()}
+        # Written in place of the values that are None
+        self._blanks = {name: bytes(np.zeros(column['shape'],
+                                             dtype=column['dtype']).nbytes)
+                        for name, column in columns.items()}
+        masks = {group: [f'{group}.{name}' for name, _ in group_columns]
+                 for group, group_columns in self._groups.items()}
+        masks['draw_params'] = [f'draw_params.{name}'
+                                for name in _DRAW_PARAMS_FIELDS]
+        self._files = {name: open(os.path.join(path, name), 'ab')
+                       for name in list(columns) + [
+                           f'{group}.mask' for group in masks]}
+        _write_json(os.path.join(path, _SCHEMA_FILE), {
+            'format_version': FORMAT_VERSION,
+            'columns': columns,
+            'masks': masks,
+            'states': _STATES_VALUES,
+            'event_names': list(event_names or []),
+            'metadata': dict(metadata or {}, seed=data.seed,
+                             spawn_key=list(data.spawn_key),
+                             start_time=time.time()),
+        })
+        self._commits = open(os.path.join(path, _COMMITS_FILE), 'ab')
+        self._num_trials = 0
+        self._num_states = 0
+        self._num_events = 0
+
+    @property
+    def num_trials(self):
+        return self._num_trials
+
+    def _chunk(self, name, values):
+        return np.asarray(values, dtype=self._dtypes[name]).tobytes()
+
+    def _row_chunks(self, chunks, group, values):
+        mask = []
+        for name, value in values:
+            column_name = f'{group}.{name}'
+            mask.append(value is None)
+            chunks[column_name] = self._blanks[column_name] \
+                if value is None else self._chunk(column_name, value)
+        chunks[f'{group}.mask'] = np.array(mask).tobytes()
+
+    def row(self, i_trial, draw_params=None):
+        """Returns the bytes of trial `i_trial`, which must be updated,
+           along with the `DrawParams` it was drawn with, by default the
+           last ones of `data`, to pass to `write()`. They are copies, so
+           `write()` can run on another thread while the next trials
+           update `data`."""
+        chunks = {}
+        for group, group_columns in self._groups.items():
+            self._row_chunks(chunks, group, [
+                (name, column[i_trial]) for name, column in group_columns])
+        if draw_params is None:
+            draw_params = self._data.custom.draw_params
+        self._row_chunks(chunks, 'draw_params', [
+            (name, _draw_param_value(getattr(draw_params, name, None)))
+            for name in _DRAW_PARAMS_FIELDS])
+        raw_data = self._data.raw_data
+        chunks['raw.trial_start_timestamp'] = self._chunk(
+            'raw.trial_start_timestamp',
+            raw_data.trial_start_timestamp(i_trial))
+        states = raw_data.states(i_trial)
+        # The states that aren't a `MatrixState` are all unknown in the file
+        chunks['raw.states.state'] = self._chunk(
+            'raw.states.state', np.maximum(states['state'], -1))
+        chunks['raw.states.start'] = self._chunk(
+            'raw.states.start', states['start'])
+        chunks['raw.states.end'] = self._chunk('raw.states.end',
+                                               states['end'])
+        events = raw_data.events(i_trial)
+        chunks['raw.events.event'] = self._chunk('raw.events.event',
+                                                 events['event'])
+        chunks['raw.events.time'] = self._chunk('raw.events.time',
+                                                events['time'])
+        return i_trial, chunks, len(states), len(events)
+
+    def write(self, row):
+        """Writes a trial's `row()`, which must be the next trial, and
+           commits it"""
+        i_trial, chunks, num_states, num_events = row
+        if i_trial != self._num_trials:
+            error(f'Trial {i_trial} appended after {self._num_trials} '
+                  f'trials, trials must be appended in order.')
+        self._num_states += num_states
+        self._num_events += num_events
+        chunks['raw.states.offsets'] = self._chunk('raw.states.offsets',
+                                                   self._num_states)
+        chunks['raw.events.offsets'] = self._chunk('raw.events.offsets',
+                                                   self._num_events)
+        for name, chunk in chunks.items():
+            self._files[name].write(chunk)
+        for data_file in self._files.values():
+            data_file.flush()
+        self._commits.write(
+            np.array([i_trial], dtype=_COMMIT_DTYPE).tobytes())
+        self._commits.flush()
+        self._num_trials += 1
+        if self._num_trials % self._fsync_every == 0:
+            self.sync()
+
+    def append(self, i_trial, draw_params=None):
+        "Writes the `row()` of trial `i_trial`"
+        self.write(self.row(i_trial, draw_params))
+
+    def sync(self):
+        "Forces the trials written so far to disk"
+        for data_file in self._files.values():
+            os.fsync(data_file.fileno())
+        os.fsync(self._commits.fileno())
+
+    def close(self):
+        if self._commits.closed:
+            return
+        self.sync()
+        for data_file in self._files.values():
+            data_file.close()
+        self._commits.close()
+        self._data.timer.latencies.export(
+            os.path.join(self._path, _LATENCIES_FILE))
+        _write_json(os.path.join(self._path, _INDEX_FILE), {
+            'num_trials': self._num_trials,
+            'end_time': time.time(),
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SessionReader:
+    """Memory-maps the columns of a session written by `SessionWriter`,
+       including one whose process died: only the trials committed, and
+       whose columns were all written, are read then. Columns are read-only
+       arrays of the session's trials."""
+
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, _SCHEMA_FILE)) as schema_file:
+            self._schema = json.load(schema_file)
+        if self._schema['format_version'] > FORMAT_VERSION:
+            error(f'{path} has format version '
+                  f'{self._schema["format_version"]}, only versions up to '
+                  f'{FORMAT_VERSION} can be read.')
+        index_path = os.path.join(path, _INDEX_FILE)
+        self.complete = os.path.exists(index_path)
+        if self.complete:
+            with open(index_path) as index_file:
+                self.num_trials = json.load(index_file)['num_trials']
+        self._mask_indices = {
+            name: (group, i) for group, names in self._schema['masks'].items()
+            for i, name in enumerate(names)}
+        if not self.complete:
+            self.num_trials = self._recovered_trials()
+            logger.warning(f'{path} was not closed, recovered '
+                           f'{self.num_trials} trials')
+
+    def _num_records(self, name, record_nbytes):
+        return os.path.getsize(os.path.join(self._path, name)) // \
+            record_nbytes
+
+    def _recovered_trials(self):
+        """Returns the number of trials of a session that wasn't closed:
+           those committed in order whose columns were all written, as the
+           files may have been cut anywhere by a crash"""
+        commits = np.fromfile(
+            os.path.join(self._path, _COMMITS_FILE), dtype=_COMMIT_DTYPE,
+            count=self._num_records(_COMMITS_FILE, _COMMIT_DTYPE.itemsize))
+        out_of_order = np.flatnonzero(commits != np.arange(len(commits)))
+        num_trials = int(out_of_order[0]) if len(out_of_order) else \
+            len(commits)
+        columns = self._schema['columns']
+        for name, column in columns.items():
+            if name in _RECORD_COLUMNS:
+                continue
+            num_trials = min(num_trials, self._num_records(
+                name, np.zeros(column['shape'], column['dtype']).nbytes))
+        for group, names in self._schema['masks'].items():
+            num_trials = min(num_trials,
+                             self._num_records(f'{group}.mask', len(names)))
+        # The trials whose states and events were all written
+        for kind in ('states', 'events'):
+            offsets = self._map(f'raw.{kind}.offsets', _OFFSET_DTYPE, (),
+                                num_trials)
+            num_records = min(
+                self._num_records(name, np.dtype(columns[name]['dtype'])
+                                  .itemsize)
+                for name in _RECORD_COLUMNS if name.startswith(f'raw.{kind}.'))
+            num_trials = int(np.searchsorted(offsets, num_records,
+                                             side='right'))
+        return num_trials
+
+    @property
+    def metadata(self):
+        return self._schema['metadata']
+
+    @property
+    def event_names(self):
+        return self._schema['event_names']
+
+    @property
+    def columns(self):
+        return list(self._schema['columns'])
+
+    def _map(self, name, dtype, shape, length):
+        if not length:
+            return np.empty((0,) + shape, dtype=dtype)
+        return np.memmap(os.path.join(self._path, name), dtype=dtype,
+                         mode='r', shape=(length,) + shape)
+
+    def _raw(self, name, length=None):
+        return self._map(name, np.dtype(self._schema['columns'][name][
+            'dtype']), (), self.num_trials if length is None else length)
+
+    def column(self, name, masked=True):
+        """Returns column `name` (e.g. 'trials.choice_correct'), as a
+           `numpy.ma.MaskedArray` masking the None values if `masked`"""
+        if name not in self._schema['columns']:
+            error(f"{self._path} has no column '{name}'.")
+        if name.startswith('raw.states.') or name.startswith('raw.events.'):
+            if not name.endswith('.offsets'):
+                kind = name.split('.')[1]
+                return self._raw(name, self._raw_length(kind))
+        column = self._schema['columns'][name]
+        values = self._map(name, np.dtype(column['dtype']),
+                           tuple(column['shape']), self.num_trials)
+        if not masked or name not in self._mask_indices:
+            return values
+        group, index = self._mask_indices[name]
+        mask = self._map(f'{group}.mask', np.dtype(bool),
+                         (len(self._schema['masks'][group]),),
+                         self.num_trials)[:, index]
+        if values.ndim > 1:
+            mask = np.repeat(mask[:, np.newaxis], values.shape[1], axis=1)
+        return np.ma.MaskedArray(values, mask=mask, copy=False)
+
+    def _raw_length(self, kind):
+        offsets = self._raw(f'raw.{kind}.offsets')
+        return int(offsets[-1]) if len(offsets) else 0
+
+    def trial_states(self, i_trial):
+        "Returns the `MatrixState` values, starts and ends of a trial's states"
+        return self._trial_slice('states', i_trial, 'state', 'start', 'end')
+
+    def trial_events(self, i_trial):
+        "Returns the event ids and times of a trial's events"
+        return self._trial_slice('events', i_trial, 'event', 'time')
+
+    def _trial_slice(self, kind, i_trial, *names):
+        if not 0 <= i_trial < self.num_trials:
+            error(f'{self._path} has no trial {i_trial}.')
+        offsets = self._raw(f'raw.{kind}.offsets')
+        start = int(offsets[i_trial - 1]) if i_trial else 0
+        stop = int(offsets[i_trial])
+        return tuple(self.column(f'raw.{kind}.{name}')[start:stop]
+                     for name in names)
@@ -0,0 +1,233 @@
+"""Runs a `Mouse2AFC` session on asyncio, so it can be paused, resumed,
+stopped or have its parameters changed while it runs.
+
+The session is made of cooperating tasks:
+
+- the trials task sends every state matrix and waits, in a thread, for the
+  Bpod to run it, while the next trial and its state matrix are prepared
+  in another (see `Mouse2AFC.run(pipelined=True)`), then updates the trial
+  and hands it over to
+- the persistence task, copying it then appending the copy to the session
+  file in a thread of its own, which hands it over to
+- the monitoring task, pushing it to the plot feed and the event log,
+- the parameters task, applying the updates of `update_parameters()`.
+
+Saving and monitoring a trial happen while the next one runs on the Bpod.
+Only the copy of the trial, the plot feed's stores and the log happen on
+the event loop, the session file's writes and fsyncs can't delay sending
+the next state matrix. The trials are handed over through queues of
+`queue_size` trials: if saving falls that far behind, the trials task
+waits for it rather than piling up trials in memory. For instance:
+
+    runner = SessionRunner(Mouse2AFC(bpod, open_gui=False))
+    asyncio.run(runner.run())
+
+while another task, or thread, calls `runner.pause()`, `runner.resume()`
+or `runner.stop()`."""
+import asyncio
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 16
+
+RUNNING = 'running'
+PAUSED = 'paused'
+STOPPING = 'stopping'
+STOPPED = 'stopped'
+
+
+class SessionRunnerError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SessionRunnerError(message)
+
+
+class SessionRunner:
+    """Runs the session of `protocol`, a `Mouse2AFC`, with `run()`. Its
+       other methods can be called from the event loop or from any other
+       thread."""
+
+    def __init__(self, protocol, queue_size=DEFAULT_QUEUE_SIZE,
+                 pipelined=True):
+        self._protocol = protocol
+        self._queue_size = queue_size
+        self._pipelined = pipelined
+        self._state = STOPPED
+        self._loop = None
+        self._resumed = None
+        self._updates = None
+        self._failure = None
+        self._i_trial = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    def _call(self, callback, *args):
+        "Runs `callback` on the event loop, from any thread"
+        if self._loop is None:
+            error('The session is not running.')
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def pause(self):
+        "Pauses the session once the running trial ends"
+        self._call(self._pause)
+
+    def _pause(self):
+        if self._state == RUNNING:
+            self._state = PAUSED
+            self._resumed.clear()
+
+    def resume(self):
+        self._call(self._resume)
+
+    def _resume(self):
+        if self._state == PAUSED:
+            self._state = RUNNING
+            self._resumed.set()
+
+    def stop(self):
+        "Ends the session once the running trial ends"
+        self._call(self._stop)
+
+    def _stop(self):
+        if self._state in (RUNNING, PAUSED):
+            self._state = STOPPING
+            self._resumed.set()
+
+    def update_parameters(self, **parameters):
+        """Updates the task parameters, from the state matrix of the next
+           trial built on"""
+        unknown = set(parameters) - set(self._protocol.task_parameters)
+        if unknown:
+            error(f'Unknown task parameters {sorted(unknown)}.')
+        self._call(self._updates.put_nowait, parameters)
+
+    async def run(self):
+        "Runs the session until it's stopped, ends or fails"
+        if self._loop is not None:
+            error('The session is already running.')
+        self._loop = asyncio.get_running_loop()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._updates = asyncio.Queue()
+        self._state = RUNNING
+        saved = asyncio.Queue(self._queue_size)
+        monitored = asyncio.Queue(self._queue_size)
+        protocol = self._protocol
+        protocol.start_session()
+        # The Bpod's trials are run in one thread, the next ones prepared in
+        # another and the trials are written and fsync'ed in a third
+        bpod_executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='bpod')
+        prepare_executor = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='prepare')
+        persistence_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='persistence')
+        tasks = [
+            asyncio.create_task(self._consume(
+                saved, partial(self._save, persistence_executor), monitored),
+                name='persistence'),
+            asyncio.create_task(self._consume(
+                monitored, self._monitor), name='monitoring'),
+            asyncio.create_task(self._sync_parameters(), name='parameters')]
+        try:
+            await self._run_trials(bpod_executor, prepare_executor, saved)
+            await saved.put(None)
+            await asyncio.gather(*tasks[:2])
+            if self._failure is not None:
+                raise self._failure
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            bpod_executor.shutdown(wait=True)
+            prepare_executor.shutdown(wait=True)
+            persistence_executor.shutdown(wait=True)
+            protocol.end_session()
+            self._state = STOPPED
+            self._loop = None
+
+    async def _run_trials(self, executor, prepare_executor, saved):
+        protocol = self._protocol
+        i_trial = 0
+        prepared = None
+        while True:
+            self._i_trial = i_trial
+            if not self._resumed.is_set():
+                logger.info(f'Session paused before trial {i_trial}')
+                pause_start = time.perf_counter_ns()
+                await self._resumed.wait()
+                protocol.record_pause(
+                    i_trial, time.perf_counter_ns() - pause_start)
+            if self._state == STOPPING:
+                logger.info(f'Session stopped before trial {i_trial}')
+                break
+            # Once paused, with the parameters updated meanwhile
+            sma = protocol.next_state_matrix(i_trial, prepared)
+            protocol.send_trial(i_trial, sma)
+            if self._pipelined:
+                next_trial = self._loop.run_in_executor(
+                    prepare_executor, protocol.prepare_trial, i_trial + 1)
+            if not await self._loop.run_in_executor(
+                    executor, protocol.run_trial, i_trial, sma):
+                break
+            prepared = await next_trial if self._pipelined else None
+            protocol.update_trial(i_trial)
+            # Only waits if saving fell `queue_size` trials behind
+            await saved.put((i_trial, sma.draw_params))
+            if self._failure is not None:
+                raise self._failure
+            if protocol.budget_reached():
+                break
+            i_trial += 1
+
+    async def _save(self, executor, i_trial, draw_params):
+        """Copies the trial on the event loop, as the next trials update the
+           data there, and writes it in the persistence thread"""
+        row = self._protocol.trial_row(i_trial, draw_params)
+        await self._loop.run_in_executor(
+            executor, self._protocol.save_row, i_trial, row)
+
+    async def _monitor(self, i_trial):
+        # Only stores to the plot feed's shared memory and logs, it can run
+        # on the event loop
+        self._protocol.monitor_trial(i_trial)
+
+    async def _consume(self, trials, handle, next_trials=None):
+        """Awaits `handle` on the `trials` queued, then queues them to
+           `next_trials` if given, until None is queued. After a failure
+           the trials are only passed on, the trials task raises it."""
+        while True:
+            trial = await trials.get()
+            if trial is not None and self._failure is None:
+                try:
+                    await handle(*trial)
+                except Exception as exception:
+                    logger.exception(f'Trial {trial[0]} could not be '
+                                     f'handled')
+                    self._failure = exception
+            if next_trials is not None:
+                await next_trials.put(None if trial is None else trial[:1])
+            if trial is None:
+                return
+
+    async def _sync_parameters(self):
+        task_parameters = self._protocol.task_parameters
+        timer = self._protocol.data.timer
+        while True:
+            parameters = await self._updates.get()
+            start = time.perf_counter_ns()
+            task_parameters.update(parameters)
+            timer.record('sync_gui', self._i_trial,
+                         time.perf_counter_ns() - start)
+            logger.info(f'Task parameters updated before trial '
+                        f'{self._i_trial}: {parameters}')
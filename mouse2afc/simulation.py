@@ -0,0 +1,484 @@
+"""Headless simulation of Mouse2AFC sessions in virtual time.
+
+`VirtualBpod` stands in for `pybpodapi.protocol.Bpod`: every `StateMatrix`
+sent to it is executed from its transition tables against a synthetic
+`MouseModel`, with the state timers, global timers and the mouse's pokes
+scheduled in virtual time instead of waiting for them. `simulate` runs a
+whole session of the protocol this way and returns its `Data`,
+`virtual_protocol` returns the protocol of such a session to run it."""
+import heapq
+import logging
+import math
+
+import numpy as np
+
+from pybpodapi.bpod.hardware.hardware import Hardware
+
+from mouse2afc.definitions.matrix_state import MatrixState
+from mouse2afc.mouse2afc import Mouse2AFC
+
+logger = logging.getLogger(__name__)
+
+# Guards against trials that never exit, e.g. a flashing loop of states
+DEFAULT_MAX_TRIAL_DURATION = 3600
+
+_LEFT = 'left'
+_CENTER = 'center'
+_RIGHT = 'right'
+
+
+class SimulationError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SimulationError(message)
+
+
+def bpod_hardware():
+    "Returns the hardware description of a Bpod 2, without connecting to one"
+    hardware = Hardware()
+    hardware.inputs = 'XBBWWWWPPPPPPPP'
+    hardware.outputs = 'XBBWWWWPPPPPPPPVVVVVVVV'
+    hardware.max_states = 256
+    hardware.max_serial_events = 15
+    hardware.n_global_timers = 5
+    hardware.n_global_counters = 5
+    hardware.n_conditions = 5
+    hardware.cycle_period = 100
+    hardware.inputs_enabled = [1] * len(hardware.inputs)
+    hardware.setup([])
+    return hardware
+
+
+class StateOccurrence:
+    "Duck-types the state occurrences of a `pybpodapi` trial"
+    __slots__ = ('state_name', 'host_timestamp', 'start_timestamp',
+                 'end_timestamp')
+
+    def __init__(self, state_name, host_timestamp, end_timestamp=None):
+        self.state_name = state_name
+        self.host_timestamp = host_timestamp
+        self.start_timestamp = host_timestamp
+        self.end_timestamp = end_timestamp
+
+
+class EventOccurrence:
+    "Duck-types the event occurrences of a `pybpodapi` trial"
+    __slots__ = ('event_id', 'event_name', 'host_timestamp')
+
+    def __init__(self, event_id, event_name, host_timestamp):
+        self.event_id = event_id
+        self.event_name = event_name
+        self.host_timestamp = host_timestamp
+
+
+class SimulatedTrial:
+    "Duck-types `pybpodapi.com.messaging.trial.Trial`"
+    def __init__(self, sma, trial_start_timestamp):
+        self.sma = sma
+        self.trial_start_timestamp = trial_start_timestamp
+        self.states_occurrences = []
+        self.events_occurrences = []
+        self.states = []
+        # Relative to the trial's start, as the Bpod's trial timer
+        self.state_timestamps = [0]
+        self.event_timestamps = []
+        self.states_durations = {}
+
+
+class VirtualSession:
+    def __init__(self):
+        self.trials = []
+
+
+def _lognormal(rng, mean_cv):
+    "Draws from a log-normal distribution given as (mean, coef. of variation)"
+    mean, cv = mean_cv
+    sigma = math.sqrt(math.log(1 + cv ** 2))
+    return rng.lognormal(math.log(mean) - sigma ** 2 / 2, sigma)
+
+
+class MouseModel:
+    """A synthetic mouse. The probability of choosing left is a psychometric
+       function of the trial's evidence (2 * stimulus_omega - 1, i.e. from -1
+       for full right to 1 for full left):
+           lapse_left + (1 - lapse_left - lapse_right) /
+               (1 + exp(-(evidence - bias) / sensitivity))
+       Timings are log-normal, given as (mean, coefficient of variation) in
+       seconds: `initiation_time` until poking the center port,
+       `fixation_time` spent in it, `movement_time` from the choice state to
+       a lateral port, `feedback_patience` before giving up waiting for the
+       feedback and `leave_time` to leave a port once the feedback is over.
+       A choice is missed altogether with `miss_prob`."""
+    def __init__(self, bias=0, sensitivity=0.2, lapse_left=0.05,
+                 lapse_right=0.05, miss_prob=0.02, initiation_time=(1, 0.5),
+                 fixation_time=(1.2, 0.4), movement_time=(0.35, 0.3),
+                 feedback_patience=(4, 0.5), leave_time=(0.3, 0.3)):
+        self.bias = bias
+        self.sensitivity = sensitivity
+        self.lapse_left = lapse_left
+        self.lapse_right = lapse_right
+        self.miss_prob = miss_prob
+        self.initiation_time = initiation_time
+        self.fixation_time = fixation_time
+        self.movement_time = movement_time
+        self.feedback_patience = feedback_patience
+        self.leave_time = leave_time
+
+    def left_prob(self, evidence):
+        "The psychometric function"
+        return self.lapse_left + (1 - self.lapse_left - self.lapse_right) / (
+            1 + math.exp(-(evidence - self.bias) / self.sensitivity))
+
+    def trial(self, evidence, rng):
+        "Returns the behaviour of the mouse in a trial with `evidence`"
+        return _MouseTrial(self, evidence, rng)
+
+
+class _MouseTrial:
+    "Maps the states a trial enters to the pokes the mouse makes in response"
+    def __init__(self, model, evidence, rng):
+        self._model = model
+        self._rng = rng
+        self._choice = _LEFT if rng.random() < model.left_prob(evidence) \
+            else _RIGHT
+        self._misses = rng.random() < model.miss_prob
+        self._tried = set()
+
+    def actions(self, state_name):
+        "Returns the (delay, port side, poke in) of the pokes to make"
+        model = self._model
+        rng = self._rng
+        if state_name == _WAIT_FOR_CENTER_POKE:
+            return [(_lognormal(rng, model.initiation_time), _CENTER, True)]
+        if state_name == _PRE_STIM_REWARD:
+            return [(_lognormal(rng, model.fixation_time), _CENTER, False)]
+        if state_name == _WAIT_FOR_CHOICE:
+            if self._misses:
+                return []
+            # Go for the other port if the first choice didn't pay off
+            if self._choice in self._tried:
+                self._choice = _RIGHT if self._choice == _LEFT else _LEFT
+            self._tried.add(self._choice)
+            return [(_lognormal(rng, model.movement_time), self._choice,
+                     True)]
+        if state_name in _WAIT_FOR_FEEDBACK:
+            return [(_lognormal(rng, model.feedback_patience), self._choice,
+                     False)]
+        if state_name in _FEEDBACK_DONE:
+            return [(_lognormal(rng, model.leave_time), self._choice, False)]
+        return []
+
+
+_WAIT_FOR_CENTER_POKE = str(MatrixState.WaitForCenterPoke)
+_PRE_STIM_REWARD = str(MatrixState.PreStimReward)
+_WAIT_FOR_CHOICE = str(MatrixState.WaitForChoice)
+_WAIT_FOR_FEEDBACK = (str(MatrixState.WaitForReward),
+                      str(MatrixState.WaitForPunish))
+_FEEDBACK_DONE = (str(MatrixState.WaitRewardOut),
+                  str(MatrixState.Punishment))
+
+
+class _TrialRun:
+    """Executes a single state matrix. Pending events are kept in a heap of
+       (time, sequence number, kind, argument) and processed in order, the
+       running state's `Tup` being handled before events at the same time"""
+    _EVENT = 0
+    _POKE = 1
+    _TIMER_START = 2
+    _TIMER_END = 3
+
+    def __init__(self, bpod, sma, mouse_trial, start_time):
+        self._bpod = bpod
+        self._sma = sma
+        self._mouse_trial = mouse_trial
+        self._events = bpod.hardware.channels.event_names
+        self._event_codes = bpod.event_codes
+        self._ports = {_LEFT: sma.left_port, _CENTER: sma.center_port,
+                       _RIGHT: sma.right_port}
+        self._poked = set()
+        self._timers_running = set()
+        self._timers_versions = [0] * len(sma.global_timers.timers)
+        self._pending = []
+        self._sequence = 0
+        self._time = start_time
+        self._start_time = start_time
+        self._state = None
+        self._previous_state = None
+        self._tup_time = math.inf
+        self._exited = False
+        self.trial = SimulatedTrial(sma, start_time)
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def trial_time(self):
+        "The time since the start of the trial, the Bpod's timestamps"
+        return self._time - self._start_time
+
+    def _push(self, time, kind, argument):
+        self._sequence += 1
+        heapq.heappush(self._pending, (time, self._sequence, kind, argument))
+
+    def trigger_event(self, event_name):
+        self._push(self._time, self._EVENT, event_name)
+
+    def run(self, max_duration):
+        self._enter(0)
+        deadline = self._time + max_duration
+        while not self._exited:
+            next_time = self._pending[0][0] if self._pending else math.inf
+            if self._tup_time == next_time == math.inf:
+                self._deadlock()
+            elif self._tup_time <= next_time:
+                self._time = self._tup_time
+                self._log_event('Tup')
+                self._transition(self._sma.state_timer_matrix[self._state])
+            else:
+                self._time, _, kind, argument = heapq.heappop(self._pending)
+                self._process(kind, argument)
+            if self._time > deadline and not self._exited:
+                logger.warning(f'Trial exceeded {max_duration}s of virtual '
+                               'time, ending it.')
+                self._close_state()
+                self._exited = True
+        return self.trial
+
+    def _unset_conditions(self):
+        "The names of the conditions never set the running state waits on"
+        conditions = self._sma.conditions
+        return [self._events[event_code] for event_code, _
+                in conditions.matrix[self._state]
+                if not conditions.channels[
+                    int(self._events[event_code][len('Condition'):]) - 1]]
+
+    def _deadlock(self):
+        state_name = self._sma.state_names[self._state]
+        if state_name not in self._bpod.deadlocked_states:
+            self._bpod.deadlocked_states.add(state_name)
+            unset_conditions = self._unset_conditions()
+            # e.g. TimeoutIncorrectChoice only exits on Condition4, which
+            # the protocol never sets. A Bpod would wait there for good.
+            if unset_conditions:
+                logger.debug(f"State '{state_name}' waits on "
+                             f"{', '.join(unset_conditions)}, never set, "
+                             "ending the trial instead.")
+            else:
+                logger.warning(f"State '{state_name}' has no pending "
+                               "transition left, ending the trial instead.")
+        self._close_state()
+        self._exited = True
+
+    def _process(self, kind, argument):
+        if kind == self._POKE:
+            port, poke_in = argument
+            if poke_in == (port in self._poked):
+                return
+            if poke_in:
+                self._poked.add(port)
+            else:
+                self._poked.discard(port)
+            self._handle_event(f'Port{port}{"In" if poke_in else "Out"}')
+        elif kind == self._EVENT:
+            self._handle_event(argument)
+        else:
+            timer_id, version = argument
+            if version != self._timers_versions[timer_id - 1]:
+                return
+            if kind == self._TIMER_START:
+                self._timers_running.add(timer_id)
+                self._handle_event(f'GlobalTimer{timer_id}_Start')
+            else:
+                self._timers_running.discard(timer_id)
+                self._handle_event(f'GlobalTimer{timer_id}_End')
+        if not self._exited:
+            self._check_conditions()
+
+    def _log_event(self, event_name):
+        event_code = self._event_codes[event_name]
+        self.trial.events_occurrences.append(
+            EventOccurrence(event_code, event_name, self.trial_time))
+        self.trial.event_timestamps.append(self.trial_time)
+        return event_code
+
+    def _handle_event(self, event_name):
+        event_code = self._log_event(event_name)
+        sma = self._sma
+        for transitions in (sma.input_matrix[self._state],
+                            sma.global_timers.end_matrix[self._state],
+                            sma.global_timers.start_matrix[self._state]):
+            for code, destination in transitions:
+                if code == event_code:
+                    self._transition(destination)
+                    return
+
+    def _check_conditions(self):
+        conditions = self._sma.conditions
+        for event_code, destination in conditions.matrix[self._state]:
+            condition = int(self._events[event_code][len('Condition'):]) - 1
+            channel = conditions.channels[condition]
+            # Channel 0 means the condition was never set
+            if channel and self._channel_value(channel) == \
+                    conditions.values[condition]:
+                self._log_event(self._events[event_code])
+                self._transition(destination)
+                return
+
+    def _channel_value(self, channel):
+        channel_name = \
+            self._bpod.hardware.channels.input_channel_names[channel]
+        if channel_name.startswith('Port'):
+            return int(int(channel_name[len('Port'):]) in self._poked)
+        if channel_name.startswith('GlobalTimer'):
+            return int(int(channel_name[len('GlobalTimer'):]) in
+                       self._timers_running)
+        return 0
+
+    def _close_state(self):
+        self.trial.states_occurrences[-1].end_timestamp = self.trial_time
+        self.trial.state_timestamps.append(self.trial_time)
+
+    def _transition(self, destination):
+        self._close_state()
+        if math.isnan(destination):
+            self._exited = True
+        elif destination == 255 and self._sma.use_255_back_signal:
+            self._enter(self._previous_state)
+        else:
+            self._enter(destination)
+
+    def _enter(self, state):
+        sma = self._sma
+        self._previous_state = self._state
+        self._state = state
+        state_name = sma.state_names[state]
+        self.trial.states_occurrences.append(
+            StateOccurrence(state_name, self.trial_time))
+        self.trial.states.append(state + 1)
+        self._tup_time = self._time + sma.state_timers[state] \
+            if sma.state_timer_matrix[state] != state else math.inf
+        self._apply_outputs(state)
+        for delay, side, poke_in in self._mouse_trial.actions(state_name):
+            self._push(self._time + delay, self._POKE,
+                       (self._ports[side], poke_in))
+        self._check_conditions()
+
+    def _apply_outputs(self, state):
+        global_timers = self._sma.global_timers
+        for timer_id in range(1, len(global_timers.timers) + 1):
+            bit = 1 << (timer_id - 1)
+            if global_timers.cancels_matrix[state] & bit:
+                self._timers_versions[timer_id - 1] += 1
+                self._timers_running.discard(timer_id)
+            if global_timers.triggers_matrix[state] & bit:
+                self._timers_versions[timer_id - 1] += 1
+                version = self._timers_versions[timer_id - 1]
+                start = self._time + global_timers.on_set_delays[timer_id - 1]
+                self._push(start, self._TIMER_START, (timer_id, version))
+                self._push(start + global_timers.timers[timer_id - 1],
+                           self._TIMER_END, (timer_id, version))
+        softcode_handler = self._bpod.softcode_handler_function
+        for output_code, value in self._sma.output_matrix[state]:
+            if output_code == self._bpod.softcode_output_code and \
+                    softcode_handler is not None:
+                softcode_handler(value)
+
+
+class VirtualBpod:
+    """Stands in for `pybpodapi.protocol.Bpod`, running every trial in
+       virtual time against `mouse`. `evidence` maps a trial number to the
+       evidence the mouse gets in it, see `MouseModel`. `run_state_machine`
+       returns False once `num_trials` trials ran, which ends the protocol"""
+    def __init__(self, num_trials, mouse, seed=None, evidence=None,
+                 max_trial_duration=DEFAULT_MAX_TRIAL_DURATION):
+        self.hardware = bpod_hardware()
+        self.session = VirtualSession()
+        self.softcode_handler_function = None
+        self.evidence = evidence or (lambda i_trial: 0)
+        self.event_codes = {event_name: event_code for event_code, event_name
+                            in enumerate(self.hardware.channels.event_names)}
+        self.softcode_output_code = \
+            self.hardware.channels.output_channel_names.index('SoftCode')
+        self.deadlocked_states = set()
+        self._num_trials = num_trials
+        self._mouse = mouse
+        self._rng = np.random.default_rng(seed)
+        self._max_trial_duration = max_trial_duration
+        self._time = 0
+        self._run = None
+        self._sma = None
+
+    def clock(self):
+        "The virtual time in seconds since the session started"
+        return self._run.time if self._run is not None else self._time
+
+    def send_state_machine(self, sma):
+        sma.update_state_numbers()
+        self._sma = sma
+
+    def run_state_machine(self, sma):
+        if len(self.session.trials) >= self._num_trials:
+            return False
+        if sma is not self._sma:
+            error('The state machine must be sent before running it.')
+        mouse_trial = self._mouse.trial(
+            self.evidence(len(self.session.trials)), self._rng)
+        self._run = _TrialRun(self, sma, mouse_trial, self._time)
+        sma.is_running = True
+        try:
+            trial = self._run.run(self._max_trial_duration)
+        finally:
+            sma.is_running = False
+            self._time = self._run.time
+            self._run = None
+        self.session.trials.append(trial)
+        return True
+
+    def trigger_event_by_name(self, event_name, event_data):
+        if self._run is None:
+            error('No trial is running.')
+        self._run.trigger_event(event_name)
+
+
+def virtual_protocol(num_trials, mouse=None, seed=None, config_file=None,
+                     session_path=None, snapshot=None, **task_parameters):
+    """Returns the `Mouse2AFC` protocol of a session of `num_trials` trials
+       against `mouse` on a `VirtualBpod`, ready to run, its task parameters
+       copied from `snapshot` if given. See `simulate`."""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    protocol_seed, mouse_seed = seed.spawn(2)
+    bpod = VirtualBpod(num_trials, mouse or MouseModel(), mouse_seed)
+    protocol = Mouse2AFC(bpod, config_file, seed=protocol_seed,
+                         open_gui=False, clock=bpod.clock,
+                         session_path=session_path, softcode_worker=False,
+                         snapshot=snapshot)
+    unknown_parameters = set(task_parameters) - set(protocol.task_parameters)
+    if unknown_parameters:
+        error(f'Unknown task parameters: {sorted(unknown_parameters)}')
+    for name, value in task_parameters.items():
+        if isinstance(value, dict):
+            protocol.task_parameters[name].columns.update(value)
+        else:
+            protocol.task_parameters[name] = value
+    trials = protocol.data.custom.trials
+    bpod.evidence = lambda i_trial: 2 * trials.stimulus_omega[i_trial] - 1
+    return protocol
+
+
+def simulate(num_trials, mouse=None, seed=None, config_file=None,
+             session_path=None, **task_parameters):
+    """Runs a session of `num_trials` trials against `mouse` (a default
+       `MouseModel` if None) in virtual time and returns its `Data`. The
+       keyword arguments override the task parameters of `config_file`, a
+       dict overrides the given columns of a table, e.g.
+       `omega_table={'omega_prob': [...]}`. The session is saved to
+       `session_path` if given."""
+    protocol = virtual_protocol(num_trials, mouse, seed, config_file,
+                                session_path, **task_parameters)
+    protocol.run()
+    return protocol.data
@@ -0,0 +1,122 @@
+"""Dispatch of the softcodes the state machine sends to the PC.
+
+pybpod calls its `softcode_handler_function` from the thread that reads the
+Bpod's serial port, so anything slow done there delays the events of the
+trial. `SoftcodeDispatcher` is installed as that function instead: it only
+queues the softcode and returns, the handlers registered for it then run
+in order on a dedicated worker thread."""
+import logging
+import queue
+import threading
+import time
+
+from mouse2afc.latency import PhaseLatencies
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 64
+# How long `stop` waits for the queued softcodes to be handled
+STOP_TIMEOUT = 5
+
+_STOP = object()
+
+
+class SoftcodeError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SoftcodeError(message)
+
+
+class SoftcodeDispatcher:
+    """Runs the handlers registered for every softcode received. Handlers
+       take no argument. With `worker` (the default) they run on a worker
+       thread fed by a queue of `queue_size` softcodes, the softcodes
+       received while it's full are dropped and counted in `dropped`.
+       Without, they run inline, e.g. when the Bpod is simulated in virtual
+       time. How long softcodes wait in the queue and how long their
+       handlers take are recorded in `latencies` as 'softcode<code>_wait'
+       and 'softcode<code>_run'."""
+
+    def __init__(self, worker=True, queue_size=DEFAULT_QUEUE_SIZE,
+                 latencies=None):
+        self._worker = worker
+        self._handlers = {}
+        self._inline_handlers = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self.latencies = latencies if latencies is not None \
+            else PhaseLatencies()
+        self.dropped = 0
+
+    def register(self, softcode, handler, inline=False):
+        """Adds `handler` to the handlers of `softcode`. An `inline` handler
+           always runs in the Bpod's reading thread, before the softcode is
+           queued: only for the few that are both trivial and time-critical"""
+        if not callable(handler):
+            error(f'The handler of SoftCode {softcode} is not callable: '
+                  f'{handler!r}.')
+        handlers = self._inline_handlers if inline else self._handlers
+        handlers.setdefault(softcode, []).append(handler)
+
+    def start(self):
+        if not self._worker or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='softcodes', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        "Handles the softcodes still queued and stops the worker"
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(STOP_TIMEOUT)
+        if self._thread.is_alive():
+            logger.warning('Softcode handlers still running after '
+                           f'{STOP_TIMEOUT} s, leaving them behind')
+        self._thread = None
+        if self.dropped:
+            logger.warning(f'{self.dropped} softcodes were dropped as the '
+                           f'queue was full')
+
+    def __call__(self, softcode):
+        "To be set as the Bpod's `softcode_handler_function`"
+        received = time.perf_counter_ns()
+        for handler in self._inline_handlers.get(softcode, ()):
+            self._handle(softcode, handler)
+        if softcode not in self._handlers:
+            return
+        if self._thread is None:
+            self._dispatch(softcode, received)
+            return
+        try:
+            self._queue.put_nowait((softcode, received))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            self._dispatch(*item)
+
+    def _dispatch(self, softcode, received):
+        self.latencies.record(f'softcode{softcode}_wait',
+                              time.perf_counter_ns() - received)
+        for handler in self._handlers[softcode]:
+            self._handle(softcode, handler)
+
+    def _handle(self, softcode, handler):
+        start = time.perf_counter_ns()
+        try:
+            handler()
+        except Exception:
+            # Leaves the session running, as an unhandled softcode would
+            logger.exception(f'Handler {handler} of SoftCode {softcode} '
+                             f'failed')
+        self.latencies.record(f'softcode{softcode}_run',
+                              time.perf_counter_ns() - start)
@@ -1,12 +1,16 @@
+import copy
 import logging
 import math
 import numpy as np
 import itertools
 
+from collections import OrderedDict
+
 from pybpodapi.protocol import Bpod
 from pybpodapi.protocol import StateMachine
 from pybpodapi.state_machine.state_machine_base import SMAError
 
+from  mouse2afc.data import DrawParams
 from  mouse2afc.definitions.constant import Constant as Const
 from  mouse2afc.definitions.draw_stim_type import DrawStimType
 from  mouse2afc.definitions.experiment import ExperimentType
@@ -17,8 +21,8 @@ from  mouse2afc.definitions.visual_stim_angle import VisualStimAngle
 from  mouse2afc.definitions.stim_after_poke_out import StimAfterPokeOut
 
 from  mouse2afc.utils import enc_trig
-from  mouse2afc.utils import get_valve_times
 from  mouse2afc.utils import floor
+from  mouse2afc.utils import get_ports
 from  mouse2afc.utils import iff
 from  mouse2afc.utils import mod
 from  mouse2afc.utils import round
@@ -35,6 +39,62 @@ IN_STR = 'In'
 DEFAULT_WIRE_TTL_DURATION = 0.02
 DEFAULT_LED_ERROR_RATE = 0.1
 
+# Task parameters read while building the state matrix
+STATE_MATRIX_PARAMETERS = (
+    'aperture_size_height',
+    'aperture_size_width',
+    'beep_after_min_sampling',
+    'catch_error',
+    'center_poke_atten_prcnt',
+    'center_x',
+    'center_y',
+    'choice_deadline',
+    'circle_area',
+    'cycles_per_second_drift',
+    'dot_lifetime_secs',
+    'dot_size_in_degs',
+    'dot_speed_degs_per_sec',
+    'draw_ratio',
+    'feedback_delay',
+    'feedback_delay_grace',
+    'gabor_size_factor',
+    'gaussian_filter_ratio',
+    'habituate_ignore_incorrect',
+    'incorrect_choice_signal_type',
+    'iti',
+    'iti_signal_type',
+    'left_poke_atten_prcnt',
+    'min_sample',
+    'num_cycles',
+    'opto_end_state_1',
+    'opto_end_state_2',
+    'opto_max_time',
+    'opto_start_delay',
+    'opto_start_state_1',
+    'pc_timeout',
+    'phase',
+    'play_noise_for_error',
+    'ports_lmr_air',
+    'pre_stim_delay_cntr_reward',
+    'primary_experiment_type',
+    'reward_after_min_sampling',
+    'right_poke_atten_prcnt',
+    'screen_dist_cm',
+    'screen_width_cm',
+    'secondary_experiment_type',
+    'stim_after_poke_out',
+    'stim_delay',
+    'stim_delay_grace',
+    'stimulus_time',
+    'timeout_broke_fixation',
+    'timeout_incorrect_choice',
+    'timeout_missed_choice',
+    'timeout_skipped_feedback',
+    'visual_stim_angle_port_left',
+    'visual_stim_angle_port_right',
+    'wire1_video_trigger',
+)
+
 
 class PluginSerialPorts:
     pass
@@ -109,19 +169,19 @@ def single_experiment_stimulus(self,task_parameters,data,i_trial,experiment_leve
         #   MaxAngle - MinANgle)) + MinAngle
         grating_orientation = ((1 - final_DV) * angle_diff / 2) + min_angle
         grating_orientation = mod(grating_orientation, 360)
-        data.custom.draw_params.stim_type = DrawStimType.static_gratings
-        data.custom.draw_params.grating_orientation = grating_orientation
-        data.custom.draw_params.num_cycles = task_parameters.num_cycles
-        data.custom.draw_params.cycles_per_second_drift = \
+        self.draw_params.stim_type = DrawStimType.static_gratings
+        self.draw_params.grating_orientation = grating_orientation
+        self.draw_params.num_cycles = task_parameters.num_cycles
+        self.draw_params.cycles_per_second_drift = \
             task_parameters.cycles_per_second_drift
-        data.custom.draw_params.phase = task_parameters.phase
-        data.custom.draw_params.gabor_size_factor = \
+        self.draw_params.phase = task_parameters.phase
+        self.draw_params.gabor_size_factor = \
             task_parameters.gabor_size_factor
-        data.custom.draw_params.gaussian_filter_ratio = \
+        self.draw_params.gaussian_filter_ratio = \
             task_parameters.gaussian_filter_ratio
         # Start from the 5th byte
         # serializeAndWrite(data.dotsMapped_file, 5,
-        #                   data.custom.draw_params)
+        #                   self.draw_params)
         # data.dotsMapped_file.data(1: 4) = typecast(uint32(1), 'uint8');
 
         _deliver_stimulus = [('SoftCode', 5)]
@@ -135,35 +195,35 @@ def single_experiment_stimulus(self,task_parameters,data,i_trial,experiment_leve
         task_parameters.n_dots = round(
             task_parameters.circle_area * task_parameters.draw_ratio)
 
-        data.custom.draw_params.stimType = DrawStimType.rdk
-        data.custom.draw_params.center_x = task_parameters.center_x
-        data.custom.draw_params.center_y = task_parameters.center_y
-        data.custom.draw_params.aperture_size_width = \
+        self.draw_params.stim_type = DrawStimType.rdk
+        self.draw_params.center_x = task_parameters.center_x
+        self.draw_params.center_y = task_parameters.center_y
+        self.draw_params.aperture_size_width = \
             task_parameters.aperture_size_width
-        data.custom.draw_params.aperture_size_height = \
+        self.draw_params.aperture_size_height = \
             task_parameters.aperture_size_height
-        data.custom.draw_params.draw_ratio = task_parameters.draw_ratio
-        data.custom.draw_params.main_direction = floor(
+        self.draw_params.draw_ratio = task_parameters.draw_ratio
+        self.draw_params.main_direction = floor(
             VisualStimAngle.get_degrees(
                 iff(self.is_left_rewarded,
                     task_parameters.visual_stim_angle_port_left.value,
                     task_parameters.visual_stim_angle_port_right.value)))
-        data.custom.draw_params.dot_speed = \
+        self.draw_params.dot_speed = \
             task_parameters.dot_speed_degs_per_sec
-        data.custom.draw_params.dot_lifetime_secs = \
+        self.draw_params.dot_lifetime_secs = \
             task_parameters.dot_lifetime_secs
-        data.custom.draw_params.coherence = data.custom.trials.dots_coherence[
+        self.draw_params.coherence = data.custom.trials.dots_coherence[
             i_trial]
-        data.custom.draw_params.screen_width_cm = \
+        self.draw_params.screen_width_cm = \
             task_parameters.screen_width_cm
-        data.custom.draw_params.screen_dist_cm = \
+        self.draw_params.screen_dist_cm = \
             task_parameters.screen_dist_cm
-        data.custom.draw_params.dot_size_in_degs = \
+        self.draw_params.dot_size_in_degs = \
             task_parameters.dot_size_in_degs
 
         # Start from the 5th byte
         # serializeAndWrite(data.dotsMapped_file, 5,
-        #                   data.custom.draw_params)
+        #                   self.draw_params)
         # data.dotsMapped_file.data(1: 4) = \
         #   typecast(uint32(1), 'uint8');
 
@@ -194,22 +254,85 @@ def handle_state_matrix_stim(self,task_parameters,data,i_trial):
 
     return deliver_stimulus,cont_deliver_stimulus,stop_stimulus
 
+class _Slot:
+    "Stands for a per-trial value while compiling a `StateMatrixTemplate`"
+    __slots__ = ('key', 'index')
+
+    def __init__(self, key, index=None):
+        self.key = key
+        self.index = index
+
+    def resolve(self, values):
+        value = values[self.key]
+        return value if self.index is None else value[self.index][1]
+
+
+def _slot_values(values):
+    "Replaces the per-trial values with slots to be patched per trial"
+    slots = {}
+    for key, value in values.items():
+        if key in _STIMULUS_VALUES:
+            slots[key] = [(name, _Slot(key, i))
+                          for i, (name, _) in enumerate(value)]
+        else:
+            slots[key] = _Slot(key)
+    return slots
+
+
+# The per-trial values are either state timers, global timers or the output
+# values of the stimulus actions
+_STIMULUS_VALUES = ('deliver_stimulus', 'cont_deliver_stimulus',
+                    'stop_stimulus')
+# Task parameters that only change the per-trial values and thus don't
+# require a new template
+_PATCHED_PARAMETERS = ('feedback_delay', 'min_sample', 'stim_delay')
+_TEMPLATE_PARAMETERS = tuple(name for name in STATE_MATRIX_PARAMETERS
+                             if name not in _PATCHED_PARAMETERS)
+
+
+def template_key(task_parameters, data, i_trial):
+    "Returns the values that determine the topology of the state matrix"
+    trials = data.custom.trials
+    return (
+        tuple(task_parameters.get(name) for name in _TEMPLATE_PARAMETERS),
+        bool(trials.left_rewarded[i_trial]),
+        bool(trials.catch_trial[i_trial]),
+        bool(trials.forced_led_trial[i_trial]),
+        bool(trials.opto_enabled[i_trial]),
+    )
+
+
+def state_matrix_signature(task_parameters, data, i_trial):
+    """Returns the values that the state matrix of `i_trial` is built from,
+       but the `_PATCHED_PARAMETERS` that `StateMatrixCache.patch()` sets
+       on a built state matrix"""
+    trials = data.custom.trials
+    return template_key(task_parameters, data, i_trial) + (
+        trials.light_intensity_left[i_trial],
+        trials.light_intensity_right[i_trial],
+        trials.DV[i_trial],
+        trials.dots_coherence[i_trial],
+        tuple(trials.reward_magnitude[i_trial]),
+        trials.center_port_rew_amount[i_trial],
+    )
+
+
 class StateMatrix(StateMachine):
     def __init__(self, bpod, task_parameters, data, i_trial):
         super().__init__(bpod)
+        self._setup(task_parameters, data, i_trial)
+        values = self._trial_values(task_parameters, data, i_trial)
+        self._add_states(task_parameters, data, i_trial, values)
+        self._add_opto(task_parameters, data, i_trial)
+        self._send_opto_times(task_parameters, data, i_trial)
+
+    def _setup(self, task_parameters, data, i_trial):
+        # Filled by `handle_state_matrix_stim` for visual stimuli and
+        # published once the state matrix is sent
+        self.draw_params = DrawParams()
         # Define ports
-        left_port = floor(mod(task_parameters.ports_lmr_air / 100000, 10))
-        center_port = floor(mod(task_parameters.ports_lmr_air / 10000, 10))
-        right_port = floor(mod(task_parameters.ports_lmr_air / 1000, 10))
-        left_port_out = port_str(left_port, out=True)
-        center_port_out = port_str(center_port, out=True)
-        right_port_out = port_str(right_port, out=True)
-        left_port_in = port_str(left_port)
-        center_port_in = port_str(center_port)
-        right_port_in = port_str(right_port)
-
-        # Duration of the TTL signal to denote start and end of trial for 2P
-        wire_ttl_duration = DEFAULT_WIRE_TTL_DURATION
+        left_port, center_port, right_port = get_ports(
+            task_parameters.ports_lmr_air)
 
         # PWM = (255 * (100-Attenuation))/100
         left_pwm = round((100 - task_parameters.left_poke_atten_prcnt) * 2.55)
@@ -218,10 +341,6 @@ class StateMatrix(StateMachine):
         right_pwm = round(
             (100 - task_parameters.right_poke_atten_prcnt) * 2.55)
 
-        led_error_rate = DEFAULT_LED_ERROR_RATE
-
-        is_left_rewarded = data.custom.trials.left_rewarded[i_trial]
-
         #created to be used by `handle_state_matrix_stim`
         self.left_port = left_port
         self.center_port = center_port
@@ -229,12 +348,95 @@ class StateMatrix(StateMachine):
         self.left_pwm = left_pwm
         self.center_pwm = center_pwm
         self.right_pwm = right_pwm
-        self.is_left_rewarded = is_left_rewarded
+        self.is_left_rewarded = data.custom.trials.left_rewarded[i_trial]
 
+    def _trial_values(self, task_parameters, data, i_trial):
+        "Calculates the timers and stimulus outputs that vary every trial"
         stimuli = handle_state_matrix_stim(self,task_parameters,data,i_trial)
-        deliver_stimulus = list(itertools.chain.from_iterable(stimuli[0]))
-        cont_deliver_stimulus = list(itertools.chain.from_iterable(stimuli[1]))
-        stop_stimulus = list(itertools.chain.from_iterable(stimuli[2]))
+        values = {
+            'deliver_stimulus': list(
+                itertools.chain.from_iterable(stimuli[0])),
+            'cont_deliver_stimulus': list(
+                itertools.chain.from_iterable(stimuli[1])),
+            'stop_stimulus': list(itertools.chain.from_iterable(stimuli[2])),
+        }
+        values.update(self._timer_values(task_parameters, data, i_trial))
+        return values
+
+    def _timer_values(self, task_parameters, data, i_trial):
+        "Calculates the state and global timers that vary every trial"
+        # Duration of the TTL signal to denote start and end of trial for 2P
+        wire_ttl_duration = DEFAULT_WIRE_TTL_DURATION
+
+        calibration = data.calibration
+        center_valve_time = calibration.valve_time(
+            data.custom.trials.center_port_rew_amount[i_trial],
+            self.center_port)
+        left_valve_time = calibration.valve_time(
+            data.custom.trials.reward_magnitude[i_trial][0], self.left_port)
+        right_valve_time = calibration.valve_time(
+            data.custom.trials.reward_magnitude[i_trial][1], self.right_port)
+        valve_time = iff(self.is_left_rewarded, left_valve_time,
+                         right_valve_time)
+
+        min_sample_beep_duration = iff(
+            task_parameters.beep_after_min_sampling, 0.01, 0)
+        timer_cprd = iff(
+            task_parameters.reward_after_min_sampling, center_valve_time,
+            task_parameters.stimulus_time - task_parameters.min_sample)
+
+        # CatchTrial
+        feedback_delay_correct = iff(data.custom.trials.catch_trial[
+            i_trial], Const.FEEDBACK_CATCH_MAX_SEC,
+            max(task_parameters.feedback_delay,0.01))
+
+        # GUI option CatchError
+        feedback_delay_punish = iff(task_parameters.catch_error,
+                                  Const.FEEDBACK_CATCH_MAX_SEC,
+                                  max(task_parameters.feedback_delay,0.01))
+
+        return {
+            'wait_for_stimulus_timer': max(0,
+                                           task_parameters.stim_delay
+                                           - wire_ttl_duration),
+            'stimulus_delivery_timer': task_parameters.min_sample
+                                       - min_sample_beep_duration
+                                       - timer_cprd,
+            'center_port_reward_timer': timer_cprd,
+            'stimulus_time_timer': max(0,task_parameters.stimulus_time
+                                       - task_parameters.min_sample
+                                       - timer_cprd
+                                       - min_sample_beep_duration),
+            'reward_timer': valve_time,
+            'feedback_delay_correct': feedback_delay_correct,
+            'feedback_delay_punish': feedback_delay_punish,
+        }
+
+    def _add_states(self, task_parameters, data, i_trial, values):
+        left_port = self.left_port
+        center_port = self.center_port
+        right_port = self.right_port
+        left_port_out = port_str(left_port, out=True)
+        center_port_out = port_str(center_port, out=True)
+        right_port_out = port_str(right_port, out=True)
+        left_port_in = port_str(left_port)
+        center_port_in = port_str(center_port)
+        right_port_in = port_str(right_port)
+
+        # Duration of the TTL signal to denote start and end of trial for 2P
+        wire_ttl_duration = DEFAULT_WIRE_TTL_DURATION
+
+        left_pwm = self.left_pwm
+        center_pwm = self.center_pwm
+        right_pwm = self.right_pwm
+
+        led_error_rate = DEFAULT_LED_ERROR_RATE
+
+        is_left_rewarded = self.is_left_rewarded
+
+        deliver_stimulus = values['deliver_stimulus']
+        cont_deliver_stimulus = values['cont_deliver_stimulus']
+        stop_stimulus = values['stop_stimulus']
 
         if task_parameters.stim_after_poke_out == StimAfterPokeOut.not_used:
             wait_for_decision_stim = stop_stimulus
@@ -264,13 +466,6 @@ class StateMatrix(StateMachine):
         center_valve = center_port
         right_valve = right_port
 
-        right_valve_time = get_valve_times(
-            data.custom.trials.reward_magnitude[i_trial][0], left_port)
-        center_valve_time = get_valve_times(
-            data.custom.trials.center_port_rew_amount[i_trial], center_port)
-        right_valve_time = get_valve_times(
-            data.custom.trials.reward_magnitude[i_trial][1], right_port)
-
         incorrect_consequence = iff(
             not task_parameters.habituate_ignore_incorrect,
             str(MatrixState.WaitForPunishStart),
@@ -283,7 +478,6 @@ class StateMatrix(StateMachine):
         reward_out = iff(is_left_rewarded, left_port_out, right_port_out)
         punish_in = iff(is_left_rewarded, right_port_in, left_port_in)
         punish_out = iff(is_left_rewarded, right_port_out, left_port_out)
-        valve_time = iff(is_left_rewarded, right_valve_time, right_valve_time)
         valve_code = iff(is_left_rewarded, left_valve, right_valve)
 
         # Check if to play beep at end of minimum sampling
@@ -297,23 +491,11 @@ class StateMatrix(StateMachine):
         reward_center_port = iff(task_parameters.reward_after_min_sampling,
                                [('Valve', center_valve)] + stop_stimulus,
                                cont_deliver_stimulus)
-        timer_cprd = iff(
-            task_parameters.reward_after_min_sampling, center_valve_time,
-            task_parameters.stimulus_time - task_parameters.min_sample)
 
         # White Noise played as Error Feedback
         error_feedback = iff(task_parameters.play_noise_for_error, [(
             'SoftCode', 11)], [])
 
-        # CatchTrial
-        feedback_delay_correct = iff(data.custom.trials.catch_trial[
-            i_trial], Const.FEEDBACK_CATCH_MAX_SEC,
-            max(task_parameters.feedback_delay,0.01))
-
-        # GUI option CatchError
-        feedback_delay_punish = iff(task_parameters.catch_error,
-                                  Const.FEEDBACK_CATCH_MAX_SEC,
-                                  max(task_parameters.feedback_delay,0.01))
         skipped_feeback_signal = iff(
             task_parameters.catch_error, [], error_feedback)
 
@@ -390,8 +572,8 @@ class StateMatrix(StateMachine):
         pc_timeout = task_parameters.pc_timeout
         # Build state matrix
         self.set_global_timer(1, task_parameters.choice_deadline)
-        self.set_global_timer(2, feedback_delay_correct)
-        self.set_global_timer(3, feedback_delay_punish)
+        self.set_global_timer(2, values['feedback_delay_correct'])
+        self.set_global_timer(3, values['feedback_delay_punish'])
         self.set_global_timer(4, incorrect_timeout)
         self.add_state(state_name=str(MatrixState.ITI_Signal),
                        state_timer=iti_signal_duration,
@@ -405,8 +587,9 @@ class StateMatrix(StateMachine):
                        output_actions=[(pwm_str(center_port), center_pwm)])
         self.add_state(state_name=str(MatrixState.PreStimReward),
                        state_timer=iff(task_parameters.pre_stim_delay_cntr_reward,
-                                       get_valve_times(task_parameters.pre_stim_delay_cntr_reward,
-                                       center_port), 0.01),
+                                       data.calibration.valve_time(
+                                           task_parameters.pre_stim_delay_cntr_reward,
+                                           center_port), 0.01),
                        state_change_conditions={
                            Bpod.Events.Tup:str(MatrixState.TriggerWaitForStimulus)},
                        output_actions=iff(task_parameters.pre_stim_delay_cntr_reward,
@@ -421,9 +604,7 @@ class StateMatrix(StateMachine):
                            Bpod.Events.Tup: str(MatrixState.WaitForStimulus)},
                        output_actions=[])
         self.add_state(state_name=str(MatrixState.WaitForStimulus),
-                       state_timer=max(0,
-                                       task_parameters.stim_delay
-                                       - wire_ttl_duration),
+                       state_timer=values['wait_for_stimulus_timer'],
                        state_change_conditions={
                            center_port_out: str(MatrixState.StimDelayGrace),
                            Bpod.Events.Tup: str(MatrixState.StimulusDelivery)},
@@ -442,9 +623,7 @@ class StateMatrix(StateMachine):
                            Bpod.Events.Tup: str(MatrixState.ITI)},
                        output_actions=error_feedback)
         self.add_state(state_name=str(MatrixState.StimulusDelivery),
-                       state_timer=task_parameters.min_sample
-                                    - min_sample_beep_duration
-                                    - timer_cprd,
+                       state_timer=values['stimulus_delivery_timer'],
                        state_change_conditions={
                            center_port_out: str(MatrixState.EarlyWithdrawal),
                            Bpod.Events.Tup: str(MatrixState.BeepMinSampling)},
@@ -461,16 +640,13 @@ class StateMatrix(StateMachine):
                            Bpod.Events.Tup: str(MatrixState.CenterPortRewardDelivery)},
                        output_actions=(cont_deliver_stimulus + min_sample_beep))
         self.add_state(state_name=str(MatrixState.CenterPortRewardDelivery),
-                       state_timer=timer_cprd,
+                       state_timer=values['center_port_reward_timer'],
                        state_change_conditions={
                            center_port_out: str(MatrixState.TriggerWaitChoiceTimer),
                            Bpod.Events.Tup: str(MatrixState.StimulusTime)},
                        output_actions=(cont_deliver_stimulus + reward_center_port))
         self.add_state(state_name=str(MatrixState.StimulusTime),
-                       state_timer= max(0,task_parameters.stimulus_time
-                                        - task_parameters.min_sample
-                                        - timer_cprd
-                                        - min_sample_beep_duration),
+                       state_timer=values['stimulus_time_timer'],
                        state_change_conditions={
                            center_port_out: str(MatrixState.TriggerWaitChoiceTimer),
                            Bpod.Events.Tup: str(MatrixState.WaitCenterPortOut)},
@@ -520,7 +696,7 @@ class StateMatrix(StateMachine):
                            punish_in: str(MatrixState.TimeoutSkippedFeedback)},
                        output_actions=wait_feedback_stim)
         self.add_state(state_name=str(MatrixState.Reward),
-                       state_timer=valve_time,
+                       state_timer=values['reward_timer'],
                        state_change_conditions={
                            Bpod.Events.Tup: str(MatrixState.WaitRewardOut)},
                        output_actions=(wait_feedback_stim + [('Valve', valve_code)]))
@@ -617,6 +793,7 @@ class StateMatrix(StateMachine):
                            'Condition5': 'exit'},
                        output_actions= stop_stimulus)
 
+    def _add_opto(self, task_parameters, data, i_trial):
         # If Optogenetics/2-Photon is enabled for a particular state, then we
         # modify that gien state such that it would send a signal to arduino
         # with the required offset delay to trigger the optogentics box.
@@ -627,16 +804,6 @@ class StateMatrix(StateMachine):
         # Bpod main config.
 
         if data.custom.trials.opto_enabled[i_trial]:
-            # Convert seconds to millis as we will send ints to Arduino
-            opto_delay = np.array(
-                [task_parameters.opto_start_delay * 1000], dtype=np.uint32)
-            opto_delay = opto_delay.view(np.uint8)
-            opto_time = np.array(
-                [task_parameters.opto_max_time * 1000], dtype=np.uint32)
-            opto_time = opto_time.view(np.uint8)
-            if not EMULATOR_MODE or hasattr(PluginSerialPorts, 'OptoSerial'):
-                fwrite(PluginSerialPorts.OptoSerial, opto_delay, 'int8')
-                fwrite(PluginSerialPorts.OptoSerial, opto_time, 'int8')
             opto_start_event_idx = \
                 self.hardware.channels.output_channel_names.index('Wire3')
             opto_stop_event_idx = \
@@ -649,4 +816,115 @@ class StateMatrix(StateMachine):
             ]
             for state_name, event_idx in tuples:
                 trgt_state_num = self.state_names.index(state_name)
-                self.output_matrix[trgt_state_num][event_idx] = 1
+                # The rows hold the (output channel, value) of the state's
+                # output actions
+                self.output_matrix[trgt_state_num].append((event_idx, 1))
+
+    def _send_opto_times(self, task_parameters, data, i_trial):
+        "Sends the optogenetics delay and duration of this trial to Arduino"
+        if data.custom.trials.opto_enabled[i_trial]:
+            # Convert seconds to millis as we will send ints to Arduino
+            opto_delay = np.array(
+                [task_parameters.opto_start_delay * 1000], dtype=np.uint32)
+            opto_delay = opto_delay.view(np.uint8)
+            opto_time = np.array(
+                [task_parameters.opto_max_time * 1000], dtype=np.uint32)
+            opto_time = opto_time.view(np.uint8)
+            if not EMULATOR_MODE or hasattr(PluginSerialPorts, 'OptoSerial'):
+                fwrite(PluginSerialPorts.OptoSerial, opto_delay, 'int8')
+                fwrite(PluginSerialPorts.OptoSerial, opto_time, 'int8')
+
+
+class StateMatrixTemplate:
+    """A state matrix compiled once per topology. The state timers, global
+       timers and stimulus outputs that change every trial are left as slots
+       and patched into a shallow copy of the compiled matrix per trial."""
+    def __init__(self, bpod, task_parameters, data, i_trial):
+        sma = StateMatrix.__new__(StateMatrix)
+        StateMachine.__init__(sma, bpod)
+        sma._setup(task_parameters, data, i_trial)
+        values = sma._trial_values(task_parameters, data, i_trial)
+        sma._add_states(task_parameters, data, i_trial, _slot_values(values))
+        sma._add_opto(task_parameters, data, i_trial)
+        # Undeclared states are resolved once here. Forgetting them makes
+        # `update_state_numbers()` skip its scan of every transition when
+        # a copy of the template is sent, which leaves the matrices untouched
+        # anyway
+        sma.update_state_numbers()
+        sma.undeclared = []
+        self._sma = sma
+        self._state_timer_slots = [
+            (idx, timer) for idx, timer in enumerate(sma.state_timers)
+            if isinstance(timer, _Slot)]
+        self._global_timer_slots = [
+            (idx, timer) for idx, timer in enumerate(sma.global_timers.timers)
+            if isinstance(timer, _Slot)]
+        self._output_slot_rows = [
+            idx for idx, outputs in enumerate(sma.output_matrix)
+            if any(isinstance(value, _Slot) for _, value in outputs)]
+
+    def instantiate(self, task_parameters, data, i_trial):
+        "Returns a state matrix for `i_trial` with its values patched in"
+        sma = copy.copy(self._sma)
+        sma.draw_params = DrawParams()
+        values = sma._trial_values(task_parameters, data, i_trial)
+        sma.state_timers = list(sma.state_timers)
+        sma.global_timers = copy.copy(sma.global_timers)
+        sma.global_timers.timers = list(sma.global_timers.timers)
+        self._patch_timers(sma, values)
+        sma.output_matrix = list(sma.output_matrix)
+        for idx in self._output_slot_rows:
+            sma.output_matrix[idx] = [
+                (code, value.resolve(values) if isinstance(value, _Slot)
+                 else value)
+                for code, value in sma.output_matrix[idx]]
+        sma._send_opto_times(task_parameters, data, i_trial)
+        return sma
+
+    def _patch_timers(self, sma, values):
+        for idx, slot in self._state_timer_slots:
+            sma.state_timers[idx] = slot.resolve(values)
+        for idx, slot in self._global_timer_slots:
+            sma.global_timers.timers[idx] = slot.resolve(values)
+
+    def patch(self, sma, task_parameters, data, i_trial):
+        """Sets the timers of `sma`, instantiated from this template for
+           `i_trial` and not sent yet, from the current `task_parameters`,
+           e.g. once the staircases moved the `_PATCHED_PARAMETERS`"""
+        self._patch_timers(
+            sma, sma._timer_values(task_parameters, data, i_trial))
+        return sma
+
+
+class StateMatrixCache:
+    "Keeps the most recently used templates keyed by `template_key`"
+    MAX_TEMPLATES = 32
+
+    def __init__(self, bpod):
+        self._bpod = bpod
+        self._templates = OrderedDict()
+
+    def state_matrix(self, task_parameters, data, i_trial):
+        "Returns the state matrix of `i_trial`, compiling its template once"
+        key = template_key(task_parameters, data, i_trial)
+        template = self._templates.get(key)
+        if template is None:
+            template = StateMatrixTemplate(
+                self._bpod, task_parameters, data, i_trial)
+            self._templates[key] = template
+            if len(self._templates) > self.MAX_TEMPLATES:
+                self._templates.popitem(last=False)
+        else:
+            self._templates.move_to_end(key)
+        return template.instantiate(task_parameters, data, i_trial)
+
+    def patch(self, sma, task_parameters, data, i_trial):
+        """Returns the state matrix of `i_trial` built ahead, `sma`, with
+           the values the `_PATCHED_PARAMETERS` changed since patched in.
+           Its `state_matrix_signature` must be unchanged."""
+        template = self._templates.get(
+            template_key(task_parameters, data, i_trial))
+        if template is None:
+            # Dropped since, building it again is as fast
+            return self.state_matrix(task_parameters, data, i_trial)
+        return template.patch(sma, task_parameters, data, i_trial)
@@ -0,0 +1,384 @@
+"""Runs the sessions of several rigs from one control PC.
+
+Every rig runs its own `Mouse2AFC` session, without the parameters GUI, in
+a process of its own, so rigs neither share the GIL nor take each other
+down when one fails. The rigs are described in a json file:
+
+    {"log_dir": "logs",
+     "health_port": 8080,
+     "max_restarts": 2,
+     "defaults": {"config_file": "/path/to/parameters.py"},
+     "rigs": [{"name": "box1", "serial_port": "/dev/ttyACM0",
+               "session_path": "/data/box1/session1"},
+              {"name": "box2", "virtual_trials": 500}]}
+
+The "defaults" apply to every rig that doesn't set them. A rig with
+"virtual_trials" runs a session of that many simulated trials (see
+`simulation`) rather than connecting to a Bpod. The parameters files are
+loaded and validated once, before any rig starts, and the rigs' processes
+are given the validated parameters rather than loading them again.
+
+A rig whose process crashes, or whose session fails, is started again up
+to "max_restarts" times. The restarted session is saved to
+`<session_path>-restart<n>`, and counts the water delivered in the
+sessions before towards the rig's "water_budget". Every rig logs to
+`<log_dir>/<name>.log`, and the supervisor serves the state of the rigs as
+json at http://<host>:<health_port>/health, with status 503 as soon as a
+rig failed for good or stalled."""
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from mouse2afc.mouse2afc import Mouse2AFC
+from mouse2afc.task_parameters import TaskParameters
+from mouse2afc.task_parameters import load_snapshot
+
+logger = logging.getLogger(__name__)
+
+RIG_OPTIONS = ('serial_port', 'config_file', 'session_path',
+               'draw_params_path', 'calibration_file', 'water_budget',
+               'water_received', 'plot_feed_path', 'subject', 'seed',
+               'virtual_trials')
+# Only these options apply to the rigs with "virtual_trials"
+VIRTUAL_RIG_OPTIONS = ('config_file', 'session_path', 'seed',
+                       'virtual_trials')
+# How often, in seconds, the rigs report their number of trials
+DEFAULT_REPORT_INTERVAL = 1
+# A running rig without a new trial for this long, in seconds, is stalled
+DEFAULT_STALL_TIMEOUT = 300
+# Of the process of every rig
+DEFAULT_MAX_RESTARTS = 2
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+
+STARTING = 'starting'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class SupervisorError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SupervisorError(message)
+
+
+def _configure_logging(name, log_dir):
+    "Sends all the logs of the rig's process to its own file"
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    handler = logging.FileHandler(os.path.join(log_dir, f'{name}.log'))
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+
+
+def _protocol(rig, snapshot):
+    """Returns the rig's protocol, its task parameters copied from
+       `snapshot`, and its Bpod, None if virtual"""
+    if 'virtual_trials' in rig:
+        # Only imported by the processes of virtual rigs
+        from mouse2afc.simulation import virtual_protocol
+        return virtual_protocol(
+            rig['virtual_trials'], seed=rig.get('seed'),
+            config_file=rig.get('config_file'),
+            session_path=rig.get('session_path'), snapshot=snapshot), None
+    from pybpodapi.protocol import Bpod
+    bpod = Bpod(serial_port=rig.get('serial_port'))
+    options = {option: rig[option] for option in RIG_OPTIONS
+               if option in rig and option != 'serial_port'}
+    return Mouse2AFC(bpod, open_gui=False, snapshot=snapshot,
+                     **options), bpod
+
+
+def _progress(protocol):
+    return {'num_trials': protocol.num_trials,
+            'water_delivered': protocol.data.custom.reward_ledger.total}
+
+
+def _report_progress(protocol, report, stop, interval):
+    while not stop.wait(interval):
+        report(RUNNING, **_progress(protocol))
+
+
+def _run_rig(rig, snapshot, log_dir, statuses, report_interval):
+    "Runs the session of `rig` in its process"
+    _configure_logging(rig['name'], log_dir)
+
+    def report(state, **values):
+        statuses.put(dict(values, rig=rig['name'], pid=os.getpid(),
+                          state=state, time=time.time()))
+
+    try:
+        protocol, bpod = _protocol(rig, snapshot)
+        report(RUNNING, num_trials=0)
+        stop = threading.Event()
+        reporter = threading.Thread(
+            target=_report_progress,
+            args=(protocol, report, stop, report_interval), daemon=True)
+        reporter.start()
+        try:
+            protocol.run()
+        finally:
+            stop.set()
+            reporter.join()
+            if bpod is not None:
+                bpod.close()
+        report(FINISHED, **_progress(protocol))
+    except Exception as exception:
+        logger.exception(f'Session of rig {rig["name"]} failed')
+        report(FAILED, error=repr(exception))
+        sys.exit(1)
+
+
+class Supervisor:
+    """Runs the sessions of `rigs`, a list of dicts of `RIG_OPTIONS` and a
+       unique "name", each in its own process, started again up to
+       `max_restarts` times if it fails. See the module's documentation for
+       the options and the health endpoint, served on `health_port` if
+       given."""
+
+    def __init__(self, rigs, log_dir='.', health_port=None,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT,
+                 report_interval=DEFAULT_REPORT_INTERVAL,
+                 max_restarts=DEFAULT_MAX_RESTARTS):
+        self._rigs = {rig.get('name'): dict(rig) for rig in rigs}
+        self._log_dir = log_dir
+        self._health_port = health_port
+        self._stall_timeout = stall_timeout
+        self._report_interval = report_interval
+        self._max_restarts = max_restarts
+        # The validated task parameters, by parameters file
+        self._snapshots = {}
+        self._validate(rigs)
+        self._context = multiprocessing.get_context('spawn')
+        self._statuses = self._context.Queue()
+        self._processes = {}
+        self._health = {}
+        # Of the sessions of every rig that failed, in ul
+        self._water_before = {}
+        # The rigs that failed for good
+        self._ended = set()
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._server = None
+
+    @classmethod
+    def load(cls, file_, **kwargs):
+        "Returns the supervisor of the rigs of the json file `file_`"
+        try:
+            with open(file_) as json_file:
+                config = json.load(json_file)
+        except (OSError, ValueError) as exception:
+            error(f'Could not read the rigs of {file_}: {exception}')
+        defaults = config.get('defaults', {})
+        rigs = [dict(defaults, **rig) for rig in config.get('rigs', [])]
+        kwargs.setdefault('log_dir', config.get('log_dir', '.'))
+        kwargs.setdefault('health_port', config.get('health_port'))
+        kwargs.setdefault('max_restarts', config.get(
+            'max_restarts', DEFAULT_MAX_RESTARTS))
+        return cls(rigs, **kwargs)
+
+    def _validate(self, rigs):
+        if not rigs:
+            error('No rigs to run.')
+        names = [rig.get('name') for rig in rigs]
+        if None in names or len(set(names)) != len(names):
+            error(f'Every rig needs a unique name, got {names}.')
+        for rig in self._rigs.values():
+            options = VIRTUAL_RIG_OPTIONS if 'virtual_trials' in rig \
+                else RIG_OPTIONS
+            unknown_options = set(rig) - set(options) - {'name'}
+            if unknown_options:
+                error(f'Unknown options for rig {rig["name"]}: '
+                      f'{sorted(unknown_options)}.')
+        # Raises on the first invalid parameters file, before any rig starts
+        for config_file in {rig.get('config_file')
+                            for rig in self._rigs.values()}:
+            if config_file is not None and not os.path.exists(config_file):
+                error(f'No parameters file {config_file}.')
+            snapshot = load_snapshot(
+                config_file or TaskParameters._default_file)
+            try:
+                pickle.dumps(snapshot)
+            except Exception as exception:
+                error(f'The parameters of {config_file} cannot be passed to '
+                      f'the rigs: {exception}')
+            self._snapshots[config_file] = snapshot
+
+    def start(self):
+        os.makedirs(self._log_dir, exist_ok=True)
+        for name in self._rigs:
+            self._health[name] = {
+                'state': STARTING, 'num_trials': 0, 'pid': None,
+                'last_trial_time': None, 'error': None, 'restarts': 0,
+                'water_delivered': 0}
+            self._water_before[name] = 0
+            self._start_rig(name, self._rigs[name])
+        if self._health_port is not None:
+            self._serve_health()
+
+    def _start_rig(self, name, rig):
+        process = self._context.Process(
+            target=_run_rig, name=f'mouse2afc-{name}',
+            args=(rig, self._snapshots[rig.get('config_file')],
+                  self._log_dir, self._statuses, self._report_interval))
+        process.start()
+        self._processes[name] = process
+        self._health[name]['pid'] = process.pid
+        logger.info(f'Started rig {name}, pid {process.pid}')
+
+    def _restart_rig(self, name):
+        "Starts the session of rig `name` again, after the one that failed"
+        health = self._health[name]
+        health['restarts'] += 1
+        rig = dict(self._rigs[name])
+        if 'session_path' in rig:
+            rig['session_path'] = \
+                f'{rig["session_path"]}-restart{health["restarts"]}'
+        # As last reported, the water delivered since is unknown
+        self._water_before[name] = health['water_delivered']
+        if 'virtual_trials' not in rig:
+            rig['water_received'] = \
+                rig.get('water_received', 0) + health['water_delivered']
+        logger.warning(f'Restarting rig {name} ({health["error"]}), '
+                       f'restart {health["restarts"]} of '
+                       f'{self._max_restarts}')
+        health.update(state=STARTING, num_trials=0, last_trial_time=None)
+        self._start_rig(name, rig)
+
+    def _collect(self):
+        """Applies the reports received and restarts the processes that
+           failed, or notices they failed for good"""
+        with self._lock:
+            while True:
+                try:
+                    status = self._statuses.get_nowait()
+                except queue.Empty:
+                    break
+                health = self._health[status['rig']]
+                # Reported by the process of a session restarted since
+                if status['pid'] != health['pid']:
+                    continue
+                if status.get('num_trials', 0) > health['num_trials'] or \
+                        health['last_trial_time'] is None:
+                    health['last_trial_time'] = status['time']
+                health['num_trials'] = status.get(
+                    'num_trials', health['num_trials'])
+                health['state'] = status['state']
+                # The last error is kept once the rig is restarted
+                if 'error' in status:
+                    health['error'] = status['error']
+                if 'water_delivered' in status:
+                    health['water_delivered'] = \
+                        self._water_before[status['rig']] + \
+                        status['water_delivered']
+            for name, process in list(self._processes.items()):
+                health = self._health[name]
+                # Exits with 0 once its session finished
+                if process.exitcode in (None, 0) or name in self._ended:
+                    continue
+                if health['state'] != FAILED:
+                    health['error'] = f'Exited with code {process.exitcode}'
+                if health['restarts'] < self._max_restarts and \
+                        not self._stopping:
+                    self._restart_rig(name)
+                else:
+                    health['state'] = FAILED
+                    self._ended.add(name)
+
+    def health(self):
+        """Returns {'healthy': whether no rig failed for good or stalled,
+           'rigs': {name: state, number of trials done, pid, time of the last
+           trial, error, number of restarts, water delivered over its
+           sessions, whether stalled}}"""
+        self._collect()
+        now = time.time()
+        rigs = {}
+        with self._lock:
+            for name, health in self._health.items():
+                rigs[name] = dict(health, stalled=(
+                    health['state'] == RUNNING and
+                    now - health['last_trial_time'] > self._stall_timeout))
+        # A failed rig is restarted unless it's out of restarts
+        return {'healthy': not any(
+                    rig['state'] == FAILED and
+                    rig['restarts'] >= self._max_restarts or rig['stalled']
+                    for rig in rigs.values()),
+                'rigs': rigs}
+
+    def _serve_health(self):
+        supervisor = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/health':
+                    self.send_error(404)
+                    return
+                health = supervisor.health()
+                body = json.dumps(health, indent=1).encode()
+                self.send_response(200 if health['healthy'] else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer(('', self._health_port),
+                                           HealthHandler)
+        threading.Thread(target=self._server.serve_forever,
+                         name='health', daemon=True).start()
+        logger.info(f'Serving the rigs health on port '
+                    f'{self._server.server_address[1]}')
+
+    @property
+    def health_address(self):
+        "The (host, port) of the health endpoint, None if not served"
+        return None if self._server is None else self._server.server_address
+
+    def wait(self, poll_interval=1):
+        """Waits for every session to end, restarted or not, returns the
+           final `health()`"""
+        while True:
+            self._collect()
+            alive = [process for process in self._processes.values()
+                     if process.is_alive()]
+            if not alive:
+                return self.health()
+            multiprocessing.connection.wait(
+                [process.sentinel for process in alive], poll_interval)
+
+    def stop(self):
+        "Terminates the sessions still running and the health endpoint"
+        self._stopping = True
+        for name, process in self._processes.items():
+            if process.is_alive():
+                logger.warning(f'Terminating rig {name}')
+                process.terminate()
+                process.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,194 @@
+"""Parameter sweeps over simulated sessions.
+
+`sweep` runs `simulation.simulate` for every point of a grid (`grid`) or a
+random search (`random_points`) over the task parameters, spreading the
+sessions over a `ProcessPoolExecutor`, and returns one row of learning
+metrics per point. `write_csv` saves these rows as a table."""
+import csv
+import itertools
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mouse2afc.simulation import MouseModel
+from mouse2afc.simulation import simulate
+
+logger = logging.getLogger(__name__)
+
+# Accuracy over the last `DEFAULT_CRITERION_WINDOW` choices for a session to
+# count as having learnt the task
+DEFAULT_CRITERION = 0.8
+DEFAULT_CRITERION_WINDOW = 50
+DEFAULT_BLOCK_SIZE = 100
+
+METRICS = (
+    'trials',
+    'accuracy',
+    'accuracy_first_block',
+    'accuracy_last_block',
+    'trials_to_criterion',
+    'reached_criterion',
+    'early_withdrawal_rate',
+    'missed_choice_rate',
+    'fix_broke_rate',
+    'rewarded',
+    'final_min_sample',
+    'final_feedback_delay',
+    'session_minutes',
+)
+
+
+class SweepError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise SweepError(message)
+
+
+def grid(**values):
+    """Returns every combination of the given parameters values, e.g.
+       `grid(start_easy_trials=[10, 50], percent_catch=[0, 0.1])`"""
+    names = list(values)
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*values.values())]
+
+
+def random_points(num_points, seed=None, **ranges):
+    """Returns `num_points` random points of the parameters space. A tuple
+       `(low, high)` is sampled uniformly (as an int if both bounds are ints,
+       both included) and a list is sampled from its elements"""
+    rng = np.random.default_rng(seed)
+    points = [{} for _ in range(num_points)]
+    for name, range_ in ranges.items():
+        if isinstance(range_, list):
+            indices = rng.integers(len(range_), size=num_points)
+            values = [range_[index] for index in indices]
+        elif isinstance(range_, tuple) and len(range_) == 2:
+            low, high = range_
+            if isinstance(low, int) and isinstance(high, int):
+                values = rng.integers(low, high, size=num_points,
+                                      endpoint=True).tolist()
+            else:
+                values = rng.uniform(low, high, size=num_points).tolist()
+        else:
+            error(f"The range of '{name}' must be a (low, high) tuple or a "
+                  f"list of values, not {range_!r}")
+        for point, value in zip(points, values):
+            point[name] = value
+    return points
+
+
+def _trials_to_criterion(correct, choice_trials, criterion, window):
+    "1-based trial at which the accuracy of the last `window` choices passes"
+    if len(correct) < window:
+        return math.nan
+    window_correct = np.convolve(correct, np.ones(window), mode='valid')
+    passed = np.flatnonzero(window_correct >= criterion * window)
+    if not len(passed):
+        return math.nan
+    return int(choice_trials[passed[0] + window - 1]) + 1
+
+
+def _mean(values):
+    return float(np.mean(values)) if len(values) else math.nan
+
+
+def _last(column, num_trials):
+    value = column[num_trials - 1]
+    return math.nan if value is None else value
+
+
+def session_metrics(data, num_trials, criterion=DEFAULT_CRITERION,
+                    criterion_window=DEFAULT_CRITERION_WINDOW,
+                    block_size=DEFAULT_BLOCK_SIZE):
+    "Returns the learning metrics of the first `num_trials` trials of `data`"
+    trials = data.custom.trials
+    choice_correct = trials.choice_correct.masked(0, num_trials)
+    choice_trials = np.flatnonzero(~np.ma.getmaskarray(choice_correct))
+    correct = choice_correct.compressed().astype(float)
+    first_block = choice_trials < block_size
+    last_block = choice_trials >= num_trials - block_size
+
+    def rate(column):
+        return float(column.masked(0, num_trials).filled(False).mean())
+
+    raw_data = data.raw_data
+    # The states' timestamps are relative to the trial's start
+    end = raw_data.trial_start_timestamp(num_trials - 1) + \
+        raw_data.states(num_trials - 1)['end'][-1]
+    trials_to_criterion = _trials_to_criterion(
+        correct, choice_trials, criterion, criterion_window)
+    return {
+        'trials': num_trials,
+        'accuracy': _mean(correct),
+        'accuracy_first_block': _mean(correct[first_block]),
+        'accuracy_last_block': _mean(correct[last_block]),
+        'trials_to_criterion': trials_to_criterion,
+        'reached_criterion': float(not math.isnan(trials_to_criterion)),
+        'early_withdrawal_rate': rate(trials.early_withdrawal),
+        'missed_choice_rate': rate(trials.missed_choice),
+        'fix_broke_rate': rate(trials.fix_broke),
+        'rewarded': int(trials.rewarded.masked(0, num_trials).filled(
+            False).sum()),
+        'final_min_sample': _last(trials.min_sample, num_trials),
+        'final_feedback_delay': _last(trials.feedback_delay, num_trials),
+        'session_minutes': end / 60,
+    }
+
+
+def _simulate_session(args):
+    "Runs in the worker processes"
+    num_trials, mouse, seed, config_file, point, metrics_kwargs = args
+    data = simulate(num_trials, mouse=mouse, seed=seed,
+                    config_file=config_file, **point)
+    return session_metrics(data, num_trials, **metrics_kwargs)
+
+
+def _summarize(point, sessions_metrics):
+    "Averages the metrics of the sessions of a point, ignoring NaNs"
+    row = dict(point)
+    row['sessions'] = len(sessions_metrics)
+    for metric in METRICS:
+        values = np.array([metrics[metric] for metrics in sessions_metrics],
+                          dtype=float)
+        values = values[~np.isnan(values)]
+        row[metric] = float(values.mean()) if len(values) else math.nan
+    return row
+
+
+def sweep(points, num_trials, sessions=1, mouse=None, seed=None,
+          config_file=None, max_workers=None, **metrics_kwargs):
+    """Simulates `sessions` sessions of `num_trials` trials for each of the
+       `points` (dicts of task parameters overrides) and returns a row per
+       point with the point's parameters and its metrics averaged over the
+       sessions (see `session_metrics`). Every point is run with the same
+       `sessions` seeds, spawned from `seed`, so that the differences
+       between points come from the parameters rather than from chance.
+       Sessions are distributed over `max_workers` processes (all the cores
+       if None)."""
+    mouse = mouse or MouseModel()
+    seeds = np.random.SeedSequence(seed).spawn(sessions)
+    tasks = [(num_trials, mouse, session_seed, config_file, point,
+              metrics_kwargs)
+             for point in points for session_seed in seeds]
+    logger.info(f'Sweeping {len(points)} points, {len(tasks)} sessions')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_simulate_session, tasks))
+    return [_summarize(point, results[i * sessions:(i + 1) * sessions])
+            for i, point in enumerate(points)]
+
+
+def write_csv(rows, file_):
+    """Writes the rows returned by `sweep` to the csv file `file_`, leaving
+       empty the parameters a point doesn't override"""
+    if not rows:
+        error('There are no rows to write.')
+    fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+    with open(file_, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -1,23 +1,20 @@
-import sys
+import copy
+import enum
+import logging
 import os
+import sys
 import types
-import enum
 
-from AnyQt.QtWidgets import QMainWindow
-from AnyQt.QtWidgets import QApplication
-from AnyQt.QtWidgets import QHeaderView
-from AnyQt.QtWidgets import QTableWidget
-from AnyQt.QtWidgets import QTableWidgetItem
-from AnyQt.QtWidgets import QComboBox
-from AnyQt.QtWidgets import QCheckBox
-from AnyQt.QtWidgets import QAbstractSpinBox
-from AnyQt.QtWidgets import QLineEdit
-from AnyQt.QtWidgets import QTextEdit
-from AnyQt.QtWidgets import QDialog
-from AnyQt.QtWidgets import QDialogButtonBox
-from AnyQt.QtWidgets import QLabel
-from AnyQt.QtWidgets import QVBoxLayout
-from AnyQt import uic
+logger = logging.getLogger(__name__)
+
+
+class TaskParametersError(Exception):
+    pass
+
+
+def error(message):
+    logger.error(message)
+    raise TaskParametersError(message)
 
 
 def fullpath(file):
@@ -30,6 +27,11 @@ class AttrDict(dict):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
 
+    def __reduce__(self):
+        # `__dict__` is the dict itself, so copies and pickles must be rebuilt
+        # from the items for the attributes to keep working
+        return AttrDict, (dict(self),)
+
     @staticmethod
     def from_nested_dict(data):
         if not isinstance(data, dict):
@@ -48,132 +50,96 @@ class TaskParametersGUITable:
         self.columns = AttrDict.from_nested_dict(columns)
 
 
-class TaskParametersGUIConfirmDialog(QDialog):
-
-    def __init__(self, parent, label):
-        super().__init__(parent)
-        self.setWindowTitle('Confirmation')
-        q_button = QDialogButtonBox.Yes | QDialogButtonBox.No
-        self.buttonBox = QDialogButtonBox(q_button)
-        self.buttonBox.accepted.connect(self.accept)
-        self.buttonBox.rejected.connect(self.reject)
-        self.layout = QVBoxLayout()
-        message = QLabel(label)
-        self.layout.addWidget(message)
-        self.layout.addWidget(self.buttonBox)
-        self.setLayout(self.layout)
-
-class TaskParametersGUI(QMainWindow):
-
-    _file = fullpath('task_parameters.ui')
-
-    def __init__(self, task_parameters):
-        super().__init__()
-        uic.loadUi(self._file, self)
-        self._buttonBox_accepted = False
-        self._task_parameters = task_parameters
-        self.actionReload_defaults.triggered.connect(
-            self._load_task_parameters)
-        self.buttonBox.accepted.connect(self._button_accepted_callback)
-        self.buttonBox.rejected.connect(self.close)
-        self._load_task_parameters()
-        self.show()
-
-    def closeEvent(self, event):
-        confirmation_dialog = TaskParametersGUIConfirmDialog(
-            self, "Are you sure you want to exit?")
-        if not self._buttonBox_accepted and not confirmation_dialog.exec_():
-            event.ignore()
-
-    def _button_accepted_callback(self):
-        confirmation_dialog = TaskParametersGUIConfirmDialog(
-            self, "Proceed with selected parameters?")
-        if confirmation_dialog.exec_():
-            self._update_task_parameters()
-            self._buttonBox_accepted = True
-            self.close()
-
-    def _field(self, name):
-        return getattr(self, name, None)
-
-    def _load_task_parameter(self, parameter, value):
-        ui_field = self._field(parameter)
-        if ui_field is None:
-            return
-        if isinstance(ui_field, QTableWidget):
-            assert isinstance(value, TaskParametersGUITable)
-            ui_field.setEditTriggers(QTableWidget.NoEditTriggers)
-            ui_field.setColumnCount(len(value.headers))
-            ui_field.setRowCount(len(next(iter(value.columns.items()))[1]))
-            ui_field.horizontalHeader().setSectionResizeMode(
-                QHeaderView.Stretch)
-            ui_field.setHorizontalHeaderLabels(value.headers)
-            for col, key in enumerate(value.columns.keys()):
-                for row, item in enumerate(value.columns[key]):
-                    ui_field.setItem(row, col, QTableWidgetItem(str(item)))
-            ui_field.resizeColumnsToContents()
-            ui_field.resizeRowsToContents()
-        elif isinstance(ui_field, QComboBox):
-            assert isinstance(value, enum.Enum)
-            ui_field.addItems(value.__class__.members())
-            ui_field.setCurrentIndex(ui_field.findText(value.name))
-        elif isinstance(ui_field, QCheckBox):
-            ui_field.setChecked(bool(value))
-        elif isinstance(ui_field, QAbstractSpinBox):
-            ui_field.setValue(float(value))
-        elif isinstance(ui_field, (QLineEdit, QTextEdit)):
-            ui_field.setText(str(value))
-
-    def _update_task_parameter(self, parameter, value):
-        ui_field = self._field(parameter)
-        if ui_field is None:
-            return
-        if isinstance(ui_field, QComboBox):
-            assert isinstance(value, enum.Enum)
-            enum_class = value.__class__
-            enum_ = enum_class[ui_field.currentText()]
-            self._task_parameters[parameter] = enum_
-        elif isinstance(ui_field, QCheckBox):
-            self._task_parameters[parameter] = ui_field.isChecked()
-        elif isinstance(ui_field, QAbstractSpinBox):
-            self._task_parameters[parameter] = ui_field.value()
-        elif isinstance(ui_field, (QLineEdit, QTextEdit)):
-            self._task_parameters[parameter] = ui_field.text()
-
-    def _load_task_parameters(self):
-        for param, val in self._task_parameters.items():
-            self._load_task_parameter(param, val)
-
-    def _update_task_parameters(self):
-        for param, val in self._task_parameters.items():
-            self._update_task_parameter(param, val)
+def _validate(task_parameters, file_):
+    "Checks the parameters loaded from `file_` against the default ones"
+    for name, value in task_parameters.items():
+        if isinstance(value, TaskParametersGUITable):
+            lengths = {len(column) for column in value.columns.values()}
+            if len(lengths) > 1:
+                error(f"The columns of '{name}' in {file_} have different "
+                      f"lengths: {sorted(lengths)}")
+    omega_table = task_parameters.get('omega_table')
+    if omega_table is not None and (
+            any(prob < 0 for prob in omega_table.columns.omega_prob) or
+            not sum(omega_table.columns.omega_prob)):
+        error(f"The omega_prob of {file_} must be positive and not all zero")
+    if file_ == TaskParameters._default_file:
+        return
+    # Neither the names the defaults file imports (enums, helpers) nor its
+    # private helper values are parameters
+    defaults = {name: value for name, value in
+                load_snapshot(TaskParameters._default_file).items()
+                if not callable(value) and not name.startswith('_')}
+    missing = set(defaults) - set(task_parameters)
+    if missing:
+        error(f'{file_} is missing the task parameters {sorted(missing)}')
+    for name, default in defaults.items():
+        value = task_parameters[name]
+        if isinstance(default, enum.Enum) and \
+                not isinstance(value, default.__class__):
+            error(f"'{name}' in {file_} must be a "
+                  f"{default.__class__.__name__}, not {value!r}")
+
+
+# Validated parameters of every loaded file, by (path, mtime, size)
+_snapshots = {}
+
+
+def load_snapshot(file_):
+    """Returns the validated task parameters defined in `file_`. A file is
+       only executed and validated the first time it's loaded (or after it
+       changed), later loads return a copy of that snapshot, so that
+       sessions can modify their parameters freely"""
+    file_ = os.path.realpath(file_)
+    stat = os.stat(file_)
+    key = (file_, stat.st_mtime_ns, stat.st_size)
+    snapshot = _snapshots.get(key)
+    if snapshot is None:
+        snapshot = _exec_parameters_file(file_)
+        _validate(snapshot, file_)
+        _snapshots[key] = snapshot
+    return copy.deepcopy(snapshot)
+
+
+def _exec_parameters_file(file_):
+    import importlib.util
+    base_filename = os.path.basename(file_)
+    module_name = os.path.splitext(base_filename)[0]
+    spec = importlib.util.spec_from_file_location(module_name, file_)
+    task_parameters = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(task_parameters)
+    parameters = {}
+    for k, v in vars(task_parameters).items():
+        if getattr(task_parameters, k, object()) is v and \
+                not isinstance(v, types.ModuleType) and \
+                not k.startswith('__'):
+            parameters[k] = v
+    return parameters
 
 
 class TaskParameters:
 
-    _default_file = fullpath('config.py')
+    _default_file = os.path.realpath(fullpath('config.py'))
 
-    def __init__(self, file_=None, open_gui=True):
+    def __init__(self, file_=None, open_gui=True, snapshot=None):
+        """`snapshot`, the parameters of `file_` as `load_snapshot()`
+           returns them, is used rather than loading `file_` again, e.g. in
+           another process"""
         self._file = file_ or self._default_file
         self.task_parameters = None
-        self._load()
+        self._load(snapshot)
         if open_gui:
+            # Qt is only imported when the GUI is shown, headless sessions
+            # (simulations, automated rigs) don't pay for it
+            from AnyQt.QtWidgets import QApplication
+            from mouse2afc.task_parameters_gui import TaskParametersGUI
             app = QApplication(sys.argv)
             self.GUI = TaskParametersGUI(self.task_parameters)
             app.exec_()
         self.task_parameters = AttrDict(**self.task_parameters)
 
-    def _load(self):
-        import importlib.util
-        base_filename = os.path.basename(self._file)
-        module_name = os.path.splitext(base_filename)[0]
-        spec = importlib.util.spec_from_file_location(
-            module_name, self._file)
-        task_parameters = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(task_parameters)
-        self.task_parameters = {}
-        for k, v in vars(task_parameters).items():
-            if getattr(task_parameters, k, object()) is v and \
-                    not isinstance(v, types.ModuleType) and \
-                    not k.startswith('__'):
-                self.task_parameters[k] = v
+    def _load(self, snapshot=None):
+        if snapshot is None:
+            self.task_parameters = load_snapshot(self._file)
+        else:
+            self.task_parameters = copy.deepcopy(snapshot)
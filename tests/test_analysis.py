@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from mouse2afc.analysis import AnalysisError
+from mouse2afc.analysis import COLUMNS
+from mouse2afc.analysis import concatenate
+from mouse2afc.analysis import load_trials
+from mouse2afc.analysis import psychometric
+from mouse2afc.analysis import trial_rate
+from mouse2afc.analysis import vevaiometric
+from mouse2afc.simulation import simulate
+
+NAN = np.nan
+NUM_TRIALS = 30
+
+
+def _trials(**columns):
+    "The trials of `columns`, the other `COLUMNS` NaN"
+    num_trials = len(next(iter(columns.values())))
+    trials = {name: np.full(num_trials, NAN) for name in COLUMNS}
+    trials.update({name: np.array(values, dtype=float)
+                   for name, values in columns.items()})
+    trials['trial_start_timestamp'] = np.full(num_trials, NAN)
+    return trials
+
+
+def test_psychometric_curve_of_hand_built_trials():
+    trials = _trials(DV=[-0.8, -0.6, -0.6, 0.2, 0.6, 0.6, 0.6, 1, NAN],
+                     choice_left=[0, 0, 1, 1, 1, 1, NAN, 1, 1])
+    curve = psychometric(trials, bins=2)
+    assert np.allclose(curve['x'], [-2 / 3, 0.6])
+    assert np.allclose(curve['p_left'], [1 / 3, 1])
+    assert curve['n'].tolist() == [3, 4]
+    assert np.allclose(curve['sem'], [np.sqrt(1 / 3 * 2 / 3 / 3), 0])
+    # A point per DV, the trials without a choice or a DV left out
+    curve = psychometric(trials, bins=None)
+    assert np.allclose(curve['x'], [-0.8, -0.6, 0.2, 0.6, 1])
+    assert np.allclose(curve['p_left'], [0, 0.5, 1, 1, 1])
+    assert curve['n'].tolist() == [1, 2, 1, 2, 1]
+    with pytest.raises(AnalysisError):
+        psychometric(trials, by='choice_left')
+
+
+def test_vevaiometric_curve_of_hand_built_trials():
+    trials = _trials(
+        DV=[-0.75, -0.75, -0.25, 0.75, 0.75, 0.75, 0.25, 0.25],
+        catch_trial=[1, 1, 0, 1, 0, 0, 1, 0],
+        choice_correct=[1, 1, 0, 1, 0, 0, 0, 0],
+        early_withdrawal=[0, 0, 0, 0, 0, 0, 0, 1],
+        feedback_time=[2, 4, 3, 0.2, 5, 7, 6, 8])
+    curve = vevaiometric(trials, num_bins=4, min_wt=0.5)
+    assert np.allclose(curve['x'], [-0.75, -0.25, 0.25, 0.75])
+    # The wait under `min_wt` is left out
+    assert curve['catch_n'].tolist() == [2, 0, 0, 0]
+    assert np.allclose(curve['catch_wt'], [3, NAN, NAN, NAN],
+                       equal_nan=True)
+    # So is the early withdrawal, the wrong catch trial is an error
+    assert curve['error_n'].tolist() == [0, 1, 1, 2]
+    assert np.allclose(curve['error_wt'], [NAN, 3, 6, 6], equal_nan=True)
+
+
+def test_sessions_are_loaded_and_concatenated():
+    data = simulate(NUM_TRIALS, seed=5)
+    trials = load_trials(data)
+    assert set(trials) == set(COLUMNS) | {'trial_start_timestamp'}
+    assert all(len(column) == NUM_TRIALS for column in trials.values())
+    assert np.array_equal(trials['choice_left'], np.array(
+        data.custom.trials.choice_left[:NUM_TRIALS], dtype=float),
+        equal_nan=True)
+    # Without timestamps, the Trials alone
+    assert np.isnan(load_trials(data.custom.trials)[
+        'trial_start_timestamp']).all()
+    both = concatenate([trials, load_trials(data, num_trials=10)])
+    assert both['session'].tolist() == [0] * NUM_TRIALS + [1] * 10
+    rate = trial_rate(both, bin_size=1)
+    assert rate['cumulative'][-1] == (NUM_TRIALS + 10) / 2
+    with pytest.raises(AnalysisError):
+        trial_rate(load_trials(data.custom.trials))
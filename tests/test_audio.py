@@ -0,0 +1,93 @@
+import sys
+
+import numpy as np
+import pytest
+
+from mouse2afc import audio
+from mouse2afc.audio import AudioPlayer
+from mouse2afc.audio import BEEP_SOFTCODE
+from mouse2afc.audio import ERROR_NOISE_SOFTCODE
+from mouse2afc.audio import NullSink
+from mouse2afc.audio import SoundDeviceSink
+from mouse2afc.softcodes import SoftcodeDispatcher
+
+BLOCK = 64
+
+
+class _NoDevice:
+    "Stands for `sounddevice`, failing if a stream is opened"
+    def OutputStream(self, *args, **kwargs):
+        raise AssertionError('An audio device was opened')
+
+
+@pytest.fixture
+def no_device(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'sounddevice', _NoDevice())
+
+
+def test_buffers_are_synthesized_once():
+    sounds = audio.default_sounds()
+    for softcode, buffer in sounds.items():
+        assert audio.default_sounds()[softcode] is buffer
+        assert buffer.dtype == np.float32
+        assert not buffer.flags.writeable
+    assert audio.tone(0.02, 1000) is audio.tone(0.02, 1000)
+    assert audio.tone(0.02, 1000) is not audio.tone(0.02, 2000)
+    # Another sample rate is another buffer
+    assert len(audio.default_sounds(22050)[BEEP_SOFTCODE]) == \
+        len(sounds[BEEP_SOFTCODE]) // 2
+
+
+def test_player_plays_the_softcodes_sounds_on_the_null_sink(no_device):
+    times = iter(range(100))
+    sink = NullSink(clock=lambda: next(times))
+    player = AudioPlayer(sink)
+    softcodes = SoftcodeDispatcher()
+    player.register(softcodes)
+    player.open()
+    softcodes.start()
+    for softcode in (BEEP_SOFTCODE, 3, ERROR_NOISE_SOFTCODE, BEEP_SOFTCODE):
+        softcodes(softcode)
+    # Played inline, as they are received
+    sounds = player.sounds
+    expected = [sounds[BEEP_SOFTCODE], sounds[ERROR_NOISE_SOFTCODE],
+                sounds[BEEP_SOFTCODE]]
+    assert [time for time, _ in sink.played] == [0, 1, 2]
+    assert all(buffer is sound
+               for (_, buffer), sound in zip(sink.played, expected))
+    softcodes.stop()
+    player.close()
+
+
+def test_sound_device_sink_plays_whole_buffers_in_blocks():
+    sink = SoundDeviceSink()
+    buffer = np.arange(1, BLOCK * 2 + BLOCK // 2, dtype=np.float32)
+    other = -np.ones(BLOCK // 2, dtype=np.float32)
+    out = np.empty((BLOCK, 1), dtype=np.float32)
+
+    def block():
+        sink._callback(out, BLOCK, None, None)
+        return out[:, 0].copy()
+
+    assert not block().any()
+    sink.play(buffer)
+    assert (block() == buffer[:BLOCK]).all()
+    # A sound interrupts the one playing at the next block
+    sink.play(other)
+    played = block()
+    assert (played[:len(other)] == other).all()
+    assert not played[len(other):].any()
+    assert not block().any()
+    sink.play(buffer)
+    played = np.concatenate([block() for _ in range(3)])
+    assert (played[:len(buffer)] == buffer).all()
+    assert not played[len(buffer):].any()
+
+
+def test_sound_device_sink_is_only_opened_on_open(no_device):
+    sink = SoundDeviceSink()
+    sink.play(audio.default_sounds()[BEEP_SOFTCODE])
+    assert sink.latency is None
+    sink.close()
+    with pytest.raises(AssertionError):
+        sink.open()
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from mouse2afc.calibration import CalibrationError
+from mouse2afc.calibration import LiquidCalibration
+from mouse2afc.calibration import default_calibration
+
+AMOUNTS = [0.5, 1, 2.5, 5]
+# Rows of [open time in ms, ul], the open time growing with the amount
+TABLE = [[10, 0], [20, 0.4], [50, 1.5], [100, 3.6], [150, 6]]
+
+
+@pytest.mark.parametrize('coeffs', [
+    None,
+    # Linear and cubic, inverted without the quadratic formula
+    [20, 10],
+    [0.1, -0.5, 20, 10],
+])
+def test_amounts_are_the_inverse_of_the_valve_times(coeffs):
+    calibration = LiquidCalibration({1: TABLE}, {1: coeffs})
+    valve_times = calibration.valve_times(AMOUNTS, 1)
+    assert np.allclose(calibration.amounts(valve_times, 1), AMOUNTS)
+    assert [calibration.valve_time(amount, 1) for amount in AMOUNTS] == \
+        valve_times.tolist()
+
+
+def test_default_valves_round_trip():
+    calibration = default_calibration()
+    assert calibration.valves == [1, 2, 3]
+    for valve in (1, 2, 3):
+        assert np.allclose(calibration.amounts(
+            calibration.valve_times(AMOUNTS, valve), valve), AMOUNTS)
+    # Too short to deliver any water
+    assert calibration.amounts([0], 1).tolist() == [0]
+
+
+def test_bad_tables_are_rejected():
+    with pytest.raises(CalibrationError, match='decreases'):
+        LiquidCalibration({1: [[150, 0], [100, 1], [50, 2], [10, 3]]})
+    calibration = LiquidCalibration({1: TABLE, 2: [[10, 0]]})
+    with pytest.raises(CalibrationError, match='Not enough'):
+        calibration.valve_time(1, 2)
+    with pytest.raises(CalibrationError, match='No liquid calibration'):
+        calibration.amounts([0.1], 3)
+    assert calibration.valves == [1]
+
+
+def test_calibrations_are_saved_and_loaded(tmp_path):
+    calibration = LiquidCalibration({1: TABLE, 2: [[10, 0]]})
+    calibration.save(tmp_path / 'calibration.json')
+    loaded = LiquidCalibration.load(tmp_path / 'calibration.json')
+    assert loaded.valves == [1]
+    assert np.allclose(loaded.coeffs(1), calibration.coeffs(1))
+    (tmp_path / 'bad.json').write_text('{"tables": {}}')
+    with pytest.raises(CalibrationError):
+        LiquidCalibration.load(tmp_path / 'bad.json')
@@ -0,0 +1,31 @@
+from mouse2afc.simulation import simulate
+from mouse2afc.utils import get_catch_stim_idx
+
+NUM_TRIALS = 300
+# Of the catch counts, one per bin of the stimulus omega
+NUM_CATCH_BINS = 21
+
+
+def test_stimulus_omegas_map_to_the_catch_count_bins():
+    assert get_catch_stim_idx(0) == 0
+    assert get_catch_stim_idx(0.5) == 10
+    assert get_catch_stim_idx(1) == NUM_CATCH_BINS - 1
+    indices = get_catch_stim_idx([0.05, 0.42, 0.96])
+    assert indices == [1, 8, 19]
+    assert all(isinstance(index, int) for index in indices)
+
+
+def test_sessions_with_catch_trials_count_them():
+    data = simulate(NUM_TRIALS, seed=3, percent_catch=0.1,
+                    start_easy_trials=10)
+    trials = data.custom.trials
+    catch_trials = [i_trial for i_trial in range(NUM_TRIALS)
+                    if trials.catch_trial[i_trial]]
+    assert catch_trials
+    # Catch trials are drawn after a rewarded one ends a catch-free stretch
+    assert catch_trials[0] > 10
+    counted = [i_trial for i_trial in catch_trials
+               if trials.choice_correct[i_trial]]
+    assert counted
+    assert len(trials.catch_count) == NUM_CATCH_BINS
+    assert sum(trials.catch_count) > 0
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from mouse2afc.cohort import Cohort
+from mouse2afc.cohort import CohortError
+from mouse2afc.session_file import SessionWriter
+from mouse2afc.simulation import simulate
+
+NUM_TRIALS = 12
+# Of every session, by subject, in the order they are saved
+SESSIONS = [('m2', 'first', 5), ('m1', 'second', 8), ('m1', 'third', 3)]
+
+
+@pytest.fixture(scope='module')
+def data():
+    return simulate(NUM_TRIALS, seed=4)
+
+
+def _write(path, data, num_trials):
+    writer = SessionWriter(str(path), data, fsync_every=1)
+    for i_trial in range(num_trials):
+        writer.append(i_trial)
+    return writer
+
+
+def test_sessions_are_indexed_by_subject_and_start_time(data, tmp_path):
+    for subject, name, num_trials in SESSIONS:
+        _write(tmp_path / subject / name, data, num_trials).close()
+    cohort = Cohort.find(str(tmp_path))
+    assert cohort.subjects == ['m1', 'm2']
+    assert cohort.paths == [str(tmp_path / 'm1' / 'second'),
+                            str(tmp_path / 'm1' / 'third'),
+                            str(tmp_path / 'm2' / 'first')]
+    index = cohort.index
+    assert index['subject'].tolist() == [0, 0, 1]
+    assert index['num_trials'].tolist() == [8, 3, 5]
+    assert index['first_trial'].tolist() == [0, 8, 11]
+    assert cohort.num_trials == 16
+    assert cohort.sessions(subjects=['m1']).tolist() == [0, 1]
+    # The session of m2 was saved first
+    assert cohort.sessions(start=index['start_time'][0]).tolist() == [0, 1]
+    assert cohort.sessions(end=index['start_time'][1]).tolist() == [0, 2]
+    with pytest.raises(CohortError):
+        cohort.sessions(subjects=['m3'])
+    # Only the trials `where` is True on are read
+    rewarded = np.array(data.custom.trials.rewarded[:NUM_TRIALS],
+                        dtype=bool)
+    columns = cohort.columns(['trials.DV'], subjects=['m1'],
+                             where='trials.rewarded')
+    trials = [np.flatnonzero(rewarded[:8]), np.flatnonzero(rewarded[:3])]
+    assert columns['trial'].tolist() == np.concatenate(trials).tolist()
+    assert columns['session'].tolist() == \
+        [0] * len(trials[0]) + [1] * len(trials[1])
+    assert columns['trials.DV'].tolist() == [
+        data.custom.trials.DV[i_trial] for i_trial in columns['trial']]
+
+
+def test_trials_appended_are_found_reopening_the_cohort(data, tmp_path):
+    writer = _write(tmp_path / 'm1' / 'session', data, 4)
+    cohort = Cohort([str(tmp_path / 'm1' / 'session')])
+    assert cohort.num_trials == 4
+    for i_trial in range(4, NUM_TRIALS):
+        writer.append(i_trial)
+    writer.close()
+    cohort = Cohort([str(tmp_path / 'm1' / 'session')], subjects=['m7'])
+    assert cohort.subjects == ['m7']
+    assert cohort.num_trials == NUM_TRIALS
+    trials = cohort.trials()
+    assert np.array_equal(trials['choice_left'], np.array(
+        data.custom.trials.choice_left[:NUM_TRIALS], dtype=float),
+        equal_nan=True)
+    assert trials['session'].tolist() == [0] * NUM_TRIALS
+    with pytest.raises(CohortError):
+        Cohort([str(tmp_path)])
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from mouse2afc.columns import Column
+from mouse2afc.columns import ColumnError
+
+CAPACITY = 4
+
+
+def test_columns_grow_past_their_capacity():
+    column = Column(float, capacity=CAPACITY)
+    column[0] = 0.5
+    column[CAPACITY * 3] = 1.5
+    assert len(column) == CAPACITY * 3 + 1
+    assert column[0] == 0.5
+    assert column[CAPACITY * 3] == 1.5
+    assert column[1:CAPACITY * 3] == [None] * (CAPACITY * 3 - 1)
+    column[CAPACITY * 5:CAPACITY * 5 + 2] = [2, 3]
+    assert len(column) == CAPACITY * 5 + 2
+    assert column[-2:] == [2.0, 3.0]
+
+
+def test_unset_values_are_none_or_the_fill():
+    column = Column(bool, capacity=CAPACITY)
+    column[2] = True
+    column[1] = None
+    assert list(column) == [None, None, True]
+    assert column.mask.tolist() == [True, True, False]
+    assert column.masked().tolist() == [None, None, True]
+    filled = Column(int, fill=7, capacity=CAPACITY)
+    filled[CAPACITY + 1] = 1
+    assert list(filled) == [7] * (CAPACITY + 1) + [1]
+    # Past the capacity, a value is the fill, not an IndexError
+    assert filled[CAPACITY * 10] == 7
+    filled[0] = None
+    assert filled[0] is None
+
+
+def test_values_are_python_values_and_views():
+    column = Column(float, width=2, capacity=CAPACITY)
+    column[0] = (1, 2)
+    assert column[0] == [1.0, 2.0]
+    assert type(Column(int, fill=0)[0]) is int
+    assert np.shares_memory(column.values, column.masked())
+    assert column.masked().mask.shape == (1, 2)
+    with pytest.raises(ColumnError):
+        column[1] = (1, 2, 3)
+    # An empty value is None, as the lists stored `diff` of one time
+    scalar = Column(float, capacity=CAPACITY)
+    scalar[0] = np.diff([1.0])
+    assert scalar[0] is None
+
+
+def test_negative_indices_count_from_the_length():
+    column = Column(int, capacity=CAPACITY * 4)
+    column[0:3] = [1, 2, 3]
+    assert column[-1] == 3
+    assert column[-3] == 1
+    column[-1] = 4
+    assert list(column) == [1, 2, 4]
+    with pytest.raises(IndexError):
+        column[-4]
+    with pytest.raises(IndexError):
+        column[-4] = 0
+
+
+def test_slices_stop_at_the_length():
+    column = Column(int, capacity=CAPACITY * 4)
+    column[0:3] = [1, 2, 3]
+    assert column[:] == [1, 2, 3]
+    assert column[1:100] == [2, 3]
+    assert column[-2:] == [2, 3]
+    assert column[::2] == [1, 3]
+    assert len(column.values) == len(column.mask) == 3
+    assert len(column.masked(1)) == 2
+    with pytest.raises(ColumnError):
+        column[0:4:2] = [0, 0]
@@ -0,0 +1,141 @@
+import math
+import tracemalloc
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from pybpodapi.com.messaging.event_occurrence import EventOccurrence
+from pybpodapi.com.messaging.event_resume import EventResume
+from pybpodapi.com.messaging.trial import Trial
+from pybpodapi.session import Session
+
+from mouse2afc.data import RawData
+from mouse2afc.definitions.matrix_state import MatrixState
+from mouse2afc.simulation import bpod_hardware
+
+NUM_TRIALS = 200
+STATE_NAMES = [matrix_state.name for matrix_state in MatrixState][:30]
+# The states the trials go through, by number, and the events moving them
+PATH = [0, 1, 2, 3, 1, 2, 3, 7, 9, 12]
+EVENTS_PER_STATE = 3
+HARDWARE = bpod_hardware()
+
+
+class _Session(Session):
+    "pybpod's session, without its output streams"
+    def __init__(self):
+        self.history = []
+        self.trials = []
+        self.csvwriter = None
+
+    def __del__(self):
+        pass
+
+
+def _run_trial(session, i_trial):
+    "Adds a trial to `session` the way the Bpod does"
+    sma = SimpleNamespace(state_names=list(STATE_NAMES),
+                          total_states_added=len(STATE_NAMES),
+                          hardware=HARDWARE)
+    session += Trial(sma)
+    trial = session.current_trial
+    trial.bpod_start_timestamp = 0
+    trial.trial_start_timestamp = 10. * i_trial
+    timestamps = []
+    for i_event in range(len(PATH) * EVENTS_PER_STATE):
+        time = i_event / 10
+        session += EventOccurrence(i_event % 8, f'Event{i_event % 8}', time)
+        session += EventResume(i_event % 8, f'Event{i_event % 8}', time)
+        timestamps.append(time)
+    trial.trial_end_timestamp = trial.trial_start_timestamp + time
+    trial.states = list(PATH)
+    trial.event_timestamps = timestamps
+    trial.state_timestamps = [0] + timestamps[EVENTS_PER_STATE::
+                                              EVENTS_PER_STATE] + [time]
+    session.add_trial_events()
+    return trial
+
+
+def test_trial_states_index_the_visited_states():
+    session = _Session()
+    raw_data = RawData(session)
+    for i_trial in range(3):
+        _run_trial(session, i_trial)
+        states = raw_data.trial_states(i_trial)
+        assert raw_data.trial_states(i_trial) is states
+        names = raw_data.states_visited_names(i_trial)
+        times = raw_data.states_visited_times(i_trial)
+        # The states of the matrix the trial didn't go through have times
+        assert set(names) < set(times)
+        for matrix_state in MatrixState:
+            name = str(matrix_state)
+            assert states.visited(matrix_state) == (name in names), name
+            expected = np.array(times.get(name, []), dtype=float).reshape(
+                -1, 2)
+            assert np.array_equal(states.times(matrix_state), expected,
+                                  equal_nan=True), name
+
+
+def _memory_per_trial(session, convert):
+    raw_data = RawData(session)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i_trial in range(NUM_TRIALS):
+            _run_trial(session, i_trial)
+            if convert:
+                raw_data.trial_states(i_trial)
+        raw_data.states()
+        return (tracemalloc.get_traced_memory()[0] - before) / NUM_TRIALS
+    finally:
+        tracemalloc.stop()
+
+
+def test_converted_trials_are_released():
+    kept = _memory_per_trial(_Session(), convert=False)
+    released = _memory_per_trial(_Session(), convert=True)
+    assert released < kept / 4
+
+
+def test_original_data_is_read_from_the_records():
+    session = _Session()
+    raw_data = RawData(session)
+    originals = []
+    for i_trial in range(3):
+        trial = _run_trial(session, i_trial)
+        originals.append((
+            list(trial.sma.state_names), list(trial.states),
+            list(trial.state_timestamps), list(trial.event_timestamps),
+            [(event.event_id, event.host_timestamp)
+             for event in trial.events_occurrences],
+            [(state.state_name, state.start_timestamp, state.end_timestamp)
+             for state in trial.states_occurrences]))
+    raw_data.states(2)
+    for i_trial, (state_names, states, state_timestamps, event_timestamps,
+                  events, state_occurrences) in enumerate(originals):
+        trial = session.trials[i_trial]
+        assert trial.sma is None
+        assert not trial.states_occurrences
+        assert not trial.events_occurrences
+        assert list(raw_data.original_state_names_by_number(i_trial)) == \
+            state_names
+        assert raw_data.original_state_data(i_trial) == states
+        assert raw_data.original_state_timestamps(i_trial) == \
+            state_timestamps
+        assert raw_data.original_event_timestamps(i_trial) == \
+            event_timestamps
+        assert raw_data.orginal_event_data(i_trial).tolist() == events
+        assert raw_data.trial_start_timestamp(i_trial) == 10. * i_trial
+        records = raw_data.states(i_trial)[['state', 'start', 'end']]
+        assert len(records) == len(state_occurrences)
+        for (state_id, start, end), (name, expected_start, expected_end) in \
+                zip(records.tolist(), state_occurrences):
+            assert raw_data.state_name(state_id) == name
+            if math.isnan(expected_start):
+                assert math.isnan(start) and math.isnan(end)
+            else:
+                assert (start, end) == (expected_start, expected_end)
+    assert not [message for message in session.history
+                if message.MESSAGE_TYPE_ALIAS in
+                ('STATE', 'EVENT', 'EVENT-SUMMARY')]
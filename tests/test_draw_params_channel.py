@@ -0,0 +1,119 @@
+import asyncio
+import threading
+
+import pytest
+
+from mouse2afc.data import DrawParams
+from mouse2afc.draw_params_channel import DrawParamsChannel
+from mouse2afc.draw_params_channel import DrawParamsChannelError
+from mouse2afc.draw_params_channel import DrawParamsReceiver
+from mouse2afc.draw_params_channel import FIELDS
+from mouse2afc.mouse2afc import Mouse2AFC
+from mouse2afc.session_runner import SessionRunner
+from mouse2afc.simulation import MouseModel
+from mouse2afc.simulation import VirtualBpod
+
+NUM_TRIALS = 5
+NUM_PUBLISHED = 2000
+
+
+def _draw_params(value):
+    draw_params = DrawParams()
+    for field in FIELDS:
+        setattr(draw_params, field, value)
+    return draw_params
+
+
+def test_handshake_between_the_protocol_and_the_renderer(tmp_path):
+    path = str(tmp_path / 'channel')
+    channel = DrawParamsChannel(path)
+    receiver = DrawParamsReceiver(path)
+    draw_params = DrawParams()
+    draw_params.coherence = 0.25
+    sequence = channel.publish(3, draw_params)
+    assert receiver.sequence == sequence
+    read_sequence, trial, params = receiver.read()
+    assert (read_sequence, trial) == (sequence, 3)
+    assert params['coherence'] == 0.25
+    assert params['stim_type'] is None
+    assert not channel.acknowledged
+    receiver.acknowledge(read_sequence)
+    assert channel.acknowledged
+    assert receiver.start != sequence
+    channel.start()
+    assert receiver.start == sequence
+    stop = receiver.stop
+    channel.stop()
+    assert receiver.stop == stop + 1
+    # Published again, the parameters wait for a new acknowledgement
+    channel.publish(4, draw_params)
+    assert not channel.acknowledged
+    channel.close()
+    receiver.close()
+
+
+def test_reads_are_consistent_while_publishing(tmp_path):
+    path = str(tmp_path / 'channel')
+    channel = DrawParamsChannel(path)
+    receiver = DrawParamsReceiver(path)
+
+    def publish():
+        for i_trial in range(NUM_PUBLISHED):
+            channel.publish(i_trial, _draw_params(i_trial))
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    reads = 0
+    while publisher.is_alive() or not reads:
+        sequence, trial, params = receiver.read()
+        assert sequence % 2 == 0
+        if trial >= 0:
+            assert set(params.values()) == {trial}
+        reads += 1
+    publisher.join()
+    assert receiver.read()[1] == NUM_PUBLISHED - 1
+    channel.close()
+    receiver.close()
+
+
+def test_a_write_never_finished_fails_reads(tmp_path):
+    path = str(tmp_path / 'channel')
+    channel = DrawParamsChannel(path)
+    receiver = DrawParamsReceiver(path)
+    channel._buffer['sequence'] = channel.sequence + 1
+    with pytest.raises(DrawParamsChannelError):
+        receiver.read()
+
+
+def _protocol(path):
+    bpod = VirtualBpod(NUM_TRIALS, MouseModel(), seed=0)
+    return Mouse2AFC(bpod, open_gui=False, clock=bpod.clock,
+                     softcode_worker=False, draw_params_path=path)
+
+
+def test_the_session_closes_the_channel(tmp_path):
+    path = str(tmp_path / 'channel')
+    protocol = _protocol(path)
+    channel = protocol.data.dots_mapped_file
+    protocol.run()
+    assert channel.closed
+    # The renderer still reads the last parameters published, those of the
+    # matrix sent when the rig ran out of trials
+    assert DrawParamsReceiver(path).read()[1] == NUM_TRIALS
+
+
+def test_the_stopped_runner_closes_the_channel(tmp_path):
+    protocol = _protocol(str(tmp_path / 'channel'))
+    channel = protocol.data.dots_mapped_file
+    runner = SessionRunner(protocol)
+    update_trial = protocol.update_trial
+
+    def stopping_update_trial(i_trial):
+        update_trial(i_trial)
+        if i_trial == 1:
+            runner.stop()
+
+    protocol.update_trial = stopping_update_trial
+    asyncio.run(runner.run())
+    assert protocol.num_trials < NUM_TRIALS
+    assert channel.closed
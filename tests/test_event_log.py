@@ -0,0 +1,51 @@
+import io
+import json
+import logging
+
+from mouse2afc.event_log import EventLog
+from mouse2afc.simulation import simulate
+
+NUM_TRIALS = 5
+
+logger = logging.getLogger('mouse2afc.test')
+
+
+def _events(file_):
+    with open(file_) as json_lines:
+        return [json.loads(line) for line in json_lines]
+
+
+def test_records_are_written_as_json_lines(tmp_path):
+    stream = io.StringIO()
+    with EventLog(str(tmp_path / 'events.jsonl'), stream=stream):
+        logger.info('Trial 3 done', extra={'trial': 3, 'rewarded': True,
+                                           'phases_ms': {'send': 1.5}})
+        logger.debug('Sent', extra={'trial': 3})
+        try:
+            raise ValueError('No valve')
+        except ValueError:
+            logger.exception('Failed')
+    info, debug, failed = _events(tmp_path / 'events.jsonl')
+    assert info['level'] == 'INFO'
+    assert info['logger'] == 'mouse2afc.test'
+    assert info['message'] == 'Trial 3 done'
+    assert (info['trial'], info['rewarded'], info['phases_ms']) == \
+        (3, True, {'send': 1.5})
+    assert (debug['level'], debug['trial']) == ('DEBUG', 3)
+    assert 'ValueError: No valve' in failed['exception']
+    # The debug record is below the level of the stream
+    lines = stream.getvalue().splitlines()
+    assert 'mouse2afc.test INFO: Trial 3 done' in lines[0]
+    assert not any('Sent' in line for line in lines)
+    # Stopped, the logger is as it was
+    assert logging.getLogger('mouse2afc').propagate
+    assert not logging.getLogger('mouse2afc').handlers
+
+
+def test_every_trial_done_is_an_event(tmp_path):
+    with EventLog(str(tmp_path / 'events.jsonl'), stream=io.StringIO()):
+        simulate(NUM_TRIALS, seed=1)
+    trials = [event for event in _events(tmp_path / 'events.jsonl')
+              if event['message'].endswith(' done')]
+    assert [event['trial'] for event in trials] == list(range(NUM_TRIALS))
+    assert all(event['phases_ms'] for event in trials)
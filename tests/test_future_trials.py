@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from mouse2afc.data import Data
+from mouse2afc.definitions.stimulus_selection_criteria \
+    import StimulusSelectionCriteria
+from mouse2afc.task_parameters import TaskParameters
+from mouse2afc.task_parameters import TaskParametersGUITable
+
+NUM_TRIALS = 4000
+START_EASY_TRIALS = 10
+PERCENT_50_FIFTY = 0.2
+# Of the omegas of the trials past the easy ones, in %
+OMEGAS = [90, 70, 60]
+OMEGA_PROBS = [0, 0.75, 0.25]
+# Of the fractions drawn, over NUM_TRIALS
+TOLERANCE = 0.03
+
+
+def _future_trials(selection_criteria, seed=0):
+    "Returns the stimulus omegas and left rewarded of generated trials"
+    task_parameters = TaskParameters(open_gui=False).task_parameters
+    task_parameters.stimulus_selection_criteria = selection_criteria
+    task_parameters.start_easy_trials = START_EASY_TRIALS
+    task_parameters.percent_50_fifty = PERCENT_50_FIFTY
+    task_parameters.omega_table = TaskParametersGUITable(
+        headers=['Stim %', 'P(a)'], omega=OMEGAS, omega_prob=OMEGA_PROBS)
+    data = Data(None, task_parameters, seed=seed)
+    # Generated in batches, as the session does
+    data.custom.assign_future_trials(0, NUM_TRIALS - 6)
+    data.custom.assign_future_trials(NUM_TRIALS - 6, 6)
+    assert data.custom.DVs_already_generated == NUM_TRIALS
+    trials = data.custom.trials
+    return (np.array(trials.stimulus_omega[:NUM_TRIALS]),
+            np.array(trials.left_rewarded[:NUM_TRIALS]))
+
+
+@pytest.mark.parametrize('selection_criteria', list(StimulusSelectionCriteria))
+def test_future_trials_follow_the_selection_rules(selection_criteria):
+    stimulus_omega, left_rewarded = _future_trials(selection_criteria)
+    easy = np.arange(NUM_TRIALS) <= START_EASY_TRIALS
+    fifty_fifty = stimulus_omega == 0.5
+    assert not fifty_fifty[easy].any()
+    assert abs(fifty_fifty[~easy].mean() - PERCENT_50_FIFTY) < TOLERANCE
+    # The side of the omega, random for the fifty-fifty trials
+    assert (left_rewarded[~fifty_fifty] ==
+            (stimulus_omega[~fifty_fifty] > 0.5)).all()
+    assert abs(left_rewarded.mean() - 0.5) < TOLERANCE
+    assert 0 < left_rewarded[fifty_fifty].mean() < 1
+    if selection_criteria == StimulusSelectionCriteria.discrete_pairs:
+        # The first omega that has a probability
+        assert np.allclose(abs(stimulus_omega[easy] - 0.5), 0.2)
+        hard = abs(stimulus_omega[~easy & ~fifty_fifty] - 0.5)
+        assert abs((abs(hard - 0.2) < 1e-9).mean() - 0.75) < TOLERANCE
+        assert abs((abs(hard - 0.1) < 1e-9).mean() - 0.25) < TOLERANCE
+    else:
+        # Clipped to [0.1, 0.9] before the flips
+        assert (abs(stimulus_omega - 0.5) < 0.4 + 1e-9).all()
+    # Same seed, same trials
+    assert all(np.array_equal(values, same) for values, same in zip(
+        (stimulus_omega, left_rewarded), _future_trials(selection_criteria)))
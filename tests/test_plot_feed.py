@@ -0,0 +1,88 @@
+import numpy as np
+
+from mouse2afc.plot_feed import LivePlot
+from mouse2afc.plot_feed import PlotFeed
+from mouse2afc.plot_feed import PlotFeedReader
+from mouse2afc.plot_feed import RECORD
+from mouse2afc.plot_feed import downsample
+from mouse2afc.plot_feed import outcomes
+from mouse2afc.simulation import simulate
+
+CAPACITY = 8
+NUM_TRIALS = 20
+MAX_POINTS = 16
+ROLLING_WINDOW = 5
+HISTORY = 40
+NUM_RECORDS = 120
+
+
+def test_reader_skips_the_records_being_overwritten(tmp_path):
+    data = simulate(NUM_TRIALS + 1, seed=0)
+    path = str(tmp_path / 'feed')
+    feed = PlotFeed(path, CAPACITY)
+    reader = PlotFeedReader(path)
+    for i_trial in range(NUM_TRIALS):
+        feed.push(i_trial, data)
+    records = reader.read()
+    # The next push overwrites the oldest record of the ring
+    assert records['trial'].tolist() == list(
+        range(NUM_TRIALS - CAPACITY + 1, NUM_TRIALS))
+    assert reader.lost == NUM_TRIALS - CAPACITY + 1
+    feed.push(NUM_TRIALS, data)
+    assert reader.read()['trial'].tolist() == [NUM_TRIALS]
+    reader.close()
+    feed.close()
+
+
+def _records(num_records, seed):
+    rng = np.random.default_rng(seed)
+    records = np.zeros(num_records, dtype=RECORD)
+    records['trial'] = np.arange(num_records)
+    for field in ('choice_left', 'choice_correct'):
+        values = (rng.random(num_records) < 0.6).astype(float)
+        values[rng.random(num_records) < 0.2] = np.nan
+        records[field] = values
+    for field in ('left_bias', 'min_sample', 'feedback_delay'):
+        records[field] = rng.random(num_records)
+    return records
+
+
+def _expected_series(records):
+    "The series computed again from every record"
+    window = records[-HISTORY:]
+    trial = window['trial'].astype(float)
+    series = {}
+    for name, field in (('performance', 'choice_correct'),
+                        ('left_choices', 'choice_left')):
+        values = records[field]
+        means = []
+        for i_record in range(len(values)):
+            last = values[max(0, i_record - ROLLING_WINDOW + 1):i_record + 1]
+            last = last[~np.isnan(last)]
+            means.append(last.mean() if len(last) else np.nan)
+        series[name] = downsample(trial, np.array(means[-HISTORY:]),
+                                  MAX_POINTS)
+    for name in ('left_bias', 'min_sample', 'feedback_delay'):
+        series[name] = downsample(trial, window[name], MAX_POINTS)
+    return series
+
+
+def test_plot_adds_only_the_new_records():
+    records = _records(NUM_RECORDS, seed=0)
+    plot = LivePlot(MAX_POINTS, ROLLING_WINDOW, HISTORY)
+    start = 0
+    for size in (1, 3, 0, ROLLING_WINDOW + 2, 1, HISTORY, 57):
+        plot.update(records[start:start + size])
+        start += size
+        series = plot.series()
+        expected = _expected_series(records[:start])
+        for name, (x, y) in expected.items():
+            assert np.array_equal(series[name][0], x), name
+            assert np.allclose(series[name][1], y, equal_nan=True), name
+        raster = records[:start][-MAX_POINTS:]
+        assert series['outcome'][0].tolist() == raster['trial'].tolist()
+        assert series['outcome'][1].tolist() == outcomes(raster).tolist()
+        assert all(len(x) <= MAX_POINTS for x, _ in series.values())
+    assert plot.num_records == start
+    # What the plot keeps is bounded however many records it was given
+    assert all(len(values) == HISTORY for values in plot._values.values())
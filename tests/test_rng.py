@@ -0,0 +1,33 @@
+import numpy as np
+
+from mouse2afc.rng import SessionRNG
+from mouse2afc.simulation import simulate
+from mouse2afc.utils import controlled_random
+from mouse2afc.utils import truncated_exponential
+
+NUM_TRIALS = 150
+COLUMNS = ('stimulus_omega', 'left_rewarded', 'catch_trial', 'opto_enabled',
+           'forced_led_trial', 'stim_delay', 'min_sample', 'feedback_delay',
+           'choice_left', 'rewarded', 'st', 'mt')
+
+
+def _trial_sequence(seed):
+    data = simulate(NUM_TRIALS, seed=seed)
+    trials = data.custom.trials
+    columns = {name: getattr(trials, name)[:NUM_TRIALS] for name in COLUMNS}
+    return columns, data.raw_data.states().tolist()
+
+
+def test_seeded_sessions_replay():
+    assert _trial_sequence(5) == _trial_sequence(5)
+    assert _trial_sequence(5) != _trial_sequence(6)
+
+
+def test_streams_draw_from_the_seed_only():
+    first, second = SessionRNG(11), SessionRNG(11)
+    np.random.seed(0)
+    expected = (truncated_exponential(0.1, 1, 5, first.delays),
+                controlled_random(0.3, 10, first.stimulus))
+    np.random.seed(1)
+    assert (truncated_exponential(0.1, 1, 5, second.delays),
+            controlled_random(0.3, 10, second.stimulus)) == expected
@@ -0,0 +1,122 @@
+from mouse2afc.simulation import MouseModel
+from mouse2afc.simulation import virtual_protocol
+from mouse2afc.utils import iff
+
+NUM_TRIALS = 300
+# Of the trial lists of the code the trackers replaced
+NUM_OF_TRIALS = 800
+
+
+def _baseline_statistics(choice_correct, choice_left, left_rewarded, rewarded,
+                         i_trial):
+    """The bias and performance `CustomData.update` computed before the
+       trackers, by re-slicing the trial lists every trial"""
+    LAST_TRIALS = 10
+    indices_rwd = iff(i_trial > LAST_TRIALS, i_trial - LAST_TRIALS, 0)
+    choice_correct_slice = choice_correct[indices_rwd: i_trial + 1]
+    choice_left_slice = choice_left[indices_rwd: i_trial + 1]
+    left_rewarded_slice = left_rewarded[indices_rwd: i_trial + 1]
+    ndx_left_rewd = [choice_c and choice_l for choice_c, choice_l in zip(
+        choice_correct_slice, choice_left_slice)]
+    ndx_left_rew_done = [l_rewarded and choice_l is not None
+                         for l_rewarded, choice_l in zip(
+                             left_rewarded_slice, choice_left_slice)]
+    ndx_right_rewd = [choice_c and not choice_l
+                      for choice_c, choice_l in zip(
+                          choice_correct_slice, choice_left_slice)]
+    ndx_right_rew_done = [not l_rewarded and choice_l is not None
+                          for l_rewarded, choice_l in zip(
+                              left_rewarded_slice, choice_left_slice)]
+    if not any(ndx_left_rew_done):
+        denominator = iff(sum(filter(None, ndx_right_rew_done)),
+                          sum(filter(None, ndx_right_rew_done)) * 2,
+                          1)
+        perf_left = 1 - (sum(filter(None, ndx_right_rewd)) /
+                         (denominator * 2))
+    else:
+        perf_left = (sum(filter(None, ndx_left_rewd)) /
+                     sum(filter(None, ndx_left_rew_done)))
+    if not any(ndx_right_rew_done):
+        denominator = iff(sum(filter(None, ndx_left_rew_done)),
+                          sum(filter(None, ndx_left_rew_done)) * 2,
+                          1)
+        perf_right = 1 - (sum(filter(None, ndx_left_rewd)) /
+                          (denominator * 2))
+    else:
+        perf_right = sum(filter(None, ndx_right_rewd)) / \
+            sum(filter(None, ndx_right_rew_done))
+    calc_left_bias = (perf_left - perf_right) / 2 + 0.5
+
+    performance = all_preformance = None
+    choice_made_trials = [choice_c is not None for choice_c in choice_correct]
+    rewarded_trials_count = sum(r is True for r in rewarded)
+    length_choice_made_trials = sum(x for x in choice_made_trials if True)
+    if length_choice_made_trials >= 1:
+        value = rewarded_trials_count / length_choice_made_trials
+        performance = [f'{value * 100:.2f}', '#/',
+                       str(length_choice_made_trials), 'T']
+        value = rewarded_trials_count / (i_trial + 1)
+        all_preformance = [f'{value * 100:.2f}', '#/', str(i_trial + 1), 'T']
+        NUM_LAST_TRIALS = 20
+        if i_trial > NUM_LAST_TRIALS:
+            if length_choice_made_trials > NUM_LAST_TRIALS:
+                rewarded_trials_ = choice_made_trials[
+                    length_choice_made_trials - NUM_LAST_TRIALS + 1:
+                    length_choice_made_trials + 1]
+                value = sum(rewarded_trials_) / NUM_LAST_TRIALS
+                performance = [performance, ' - ', f'{value * 100:.2f}',
+                               '#/', str(NUM_LAST_TRIALS), 'T']
+            rewarded_trials_count = sum(rewarded[
+                i_trial - NUM_LAST_TRIALS + 1: i_trial + 1])
+            value = rewarded_trials_count / NUM_LAST_TRIALS
+            all_preformance = [all_preformance, ' - ', f'{value * 100:.2f}',
+                               '#/', str(NUM_LAST_TRIALS), 'T']
+    return calc_left_bias, performance, all_preformance
+
+
+def _recorded_statistics(seed, mouse=None, **task_parameters):
+    """Runs a simulated session and returns the trial columns along with
+       the bias and performance `CustomData.update` computed every trial"""
+    protocol = virtual_protocol(NUM_TRIALS, mouse, seed, **task_parameters)
+    custom = protocol.data.custom
+    parameters = protocol.task_parameters
+    statistics = []
+    update = custom.update
+
+    def recording_update(i_trial):
+        update(i_trial)
+        statistics.append((parameters.calc_left_bias,
+                           parameters.performance,
+                           parameters.all_preformance))
+
+    custom.update = recording_update
+    protocol.run()
+    trials = custom.trials
+    columns = [[getattr(trials, name)[i_trial]
+                for i_trial in range(NUM_TRIALS)]
+               for name in ('choice_correct', 'choice_left', 'left_rewarded',
+                            'rewarded')]
+    return columns, statistics
+
+
+def _check_identical(seed, mouse=None, **task_parameters):
+    columns, statistics = _recorded_statistics(seed, mouse, **task_parameters)
+    assert len(statistics) == NUM_TRIALS
+    for i_trial, (calc_left_bias, performance, all_preformance) in \
+            enumerate(statistics):
+        # The trials after `i_trial` weren't done yet
+        done = [column[:i_trial + 1] + [None] * (NUM_OF_TRIALS - i_trial - 1)
+                for column in columns]
+        expected = _baseline_statistics(*done, i_trial)
+        assert calc_left_bias == expected[0], i_trial
+        if expected[1] is not None:
+            assert performance == expected[1], i_trial
+            assert all_preformance == expected[2], i_trial
+
+
+def test_trackers_match_baseline():
+    _check_identical(seed=0)
+
+
+def test_trackers_match_baseline_with_a_biased_mouse():
+    _check_identical(seed=1, mouse=MouseModel(bias=0.8, miss_prob=0.1))
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+from mouse2afc.rng import SessionRNG
+from mouse2afc.session_file import SessionReader
+from mouse2afc.session_file import SessionWriter
+from mouse2afc.simulation import simulate
+
+NUM_TRIALS = 12
+SEED = 7
+
+
+@pytest.fixture(scope='module')
+def data():
+    # One more trial, the one being written when the session dies
+    return simulate(NUM_TRIALS + 1, seed=SEED)
+
+
+def _write(path, data, num_trials):
+    writer = SessionWriter(str(path), data, fsync_every=4)
+    for i_trial in range(num_trials):
+        writer.append(i_trial)
+    return writer
+
+
+def _kill(writer):
+    "Closes the files as the process dying would, without closing the session"
+    for data_file in writer._files.values():
+        data_file.close()
+    writer._commits.close()
+
+
+def _check_committed(path, expected_path):
+    reader = SessionReader(str(path))
+    expected = SessionReader(str(expected_path))
+    assert not reader.complete
+    assert reader.num_trials == expected.num_trials == NUM_TRIALS
+    for name in expected.columns:
+        column, expected_column = reader.column(name), expected.column(name)
+        assert np.array_equal(np.ma.getdata(column),
+                              np.ma.getdata(expected_column)), name
+        assert np.array_equal(np.ma.getmaskarray(column),
+                              np.ma.getmaskarray(expected_column)), name
+    for i_trial in range(NUM_TRIALS):
+        for values, expected_values in zip(reader.trial_states(i_trial),
+                                           expected.trial_states(i_trial)):
+            assert np.array_equal(values, expected_values)
+
+
+@pytest.fixture(scope='module')
+def closed(data, tmp_path_factory):
+    path = tmp_path_factory.mktemp('closed')
+    _write(path, data, NUM_TRIALS).close()
+    return path
+
+
+def test_a_trial_cut_mid_write_is_dropped(data, closed, tmp_path):
+    writer = _write(tmp_path, data, NUM_TRIALS)
+    _, chunks, _, _ = writer.row(NUM_TRIALS)
+    # Dies halfway through the columns of the next trial
+    for name, chunk in list(chunks.items())[:len(chunks) // 2]:
+        writer._files[name].write(chunk[:max(1, len(chunk) // 2)])
+    _kill(writer)
+    with open(tmp_path / 'commits', 'ab') as commits:
+        commits.write(b'\x0c\x00\x00')
+    _check_committed(tmp_path, closed)
+
+
+def test_commits_ahead_of_the_columns_are_dropped(data, closed, tmp_path):
+    # The commit reached the disk, not the last rows of every column
+    writer = _write(tmp_path, data, NUM_TRIALS + 1)
+    _kill(writer)
+    for name in ('trials.choice_left', 'raw.events.time'):
+        file_path = tmp_path / name
+        os.truncate(file_path, os.path.getsize(file_path) - 1)
+    _check_committed(tmp_path, closed)
+
+
+def test_corrupt_commits_are_dropped(data, closed, tmp_path):
+    writer = _write(tmp_path, data, NUM_TRIALS)
+    for data_file in writer._files.values():
+        data_file.write(b'\xff' * 64)
+    _kill(writer)
+    with open(tmp_path / 'commits', 'ab') as commits:
+        commits.write(np.array([NUM_TRIALS + 5], dtype='<i8').tobytes())
+    _check_committed(tmp_path, closed)
+
+
+def test_metadata_replays_the_spawned_seed(tmp_path):
+    path = str(tmp_path / 'session')
+    data = simulate(3, seed=SEED, session_path=path)
+    metadata = SessionReader(path).metadata
+    assert metadata['seed'] == SEED
+    assert tuple(metadata['spawn_key']) == data.spawn_key != ()
+    replayed = SessionRNG(np.random.SeedSequence(
+        metadata['seed'], spawn_key=metadata['spawn_key']))
+    session = SessionRNG(np.random.SeedSequence(SEED).spawn(2)[0])
+    for name in SessionRNG.STREAMS:
+        assert getattr(replayed, name).random() == \
+            getattr(session, name).random()
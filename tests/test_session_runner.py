@@ -0,0 +1,123 @@
+import asyncio
+
+from mouse2afc.definitions.feedback_delay_selection \
+    import FeedbackDelaySelection
+from mouse2afc.definitions.matrix_state import MatrixState
+from mouse2afc.session_runner import PAUSED
+from mouse2afc.session_runner import RUNNING
+from mouse2afc.session_runner import STOPPED
+from mouse2afc.session_runner import SessionRunner
+from mouse2afc.simulation import virtual_protocol
+
+NUM_TRIALS = 60
+# Of a session only a stop ends
+MANY_TRIALS = 10 ** 6
+# The trials run before and after every control of the session
+NUM_CONTROLLED_TRIALS = 5
+TIMEOUT_S = 30
+FEEDBACK_DELAY_GRACE = 0.25
+
+
+def _staircase_protocol(num_trials):
+    "A session whose staircases move every trial"
+    return virtual_protocol(
+        num_trials, seed=3,
+        feedback_delay_selection=FeedbackDelaySelection.auto_incr,
+        stim_delay_auto_increment=1)
+
+
+def _record_sent(protocol):
+    "Returns the list the timers of the state matrices sent are added to"
+    bpod = protocol._bpod
+    send_state_machine = bpod.send_state_machine
+    sent = []
+
+    def recording_send(sma):
+        sent.append((list(sma.state_timers),
+                     list(sma.global_timers.timers)))
+        send_state_machine(sma)
+
+    bpod.send_state_machine = recording_send
+    return sent
+
+
+async def _until(condition):
+    "Lets the session run until `condition()`"
+    for _ in range(TIMEOUT_S * 1000):
+        if condition():
+            return
+        await asyncio.sleep(0.001)
+    raise AssertionError('The session did not get there in time')
+
+
+def test_runner_prepares_the_trials_run_does():
+    protocol = _staircase_protocol(NUM_TRIALS)
+    sent = _record_sent(protocol)
+    protocol.run()
+    runner_protocol = _staircase_protocol(NUM_TRIALS)
+    runner_sent = _record_sent(runner_protocol)
+    asyncio.run(SessionRunner(runner_protocol).run())
+    assert runner_sent == sent
+    trials = protocol.data.custom.trials
+    runner_trials = runner_protocol.data.custom.trials
+    for name in ('choice_correct', 'rewarded', 'min_sample',
+                 'feedback_delay'):
+        assert getattr(runner_trials, name)[:NUM_TRIALS] == \
+            getattr(trials, name)[:NUM_TRIALS], name
+    latencies = runner_protocol.data.timer.latencies
+    assert len(latencies.durations('prepare_state_matrix')) > 0
+    assert len(latencies.durations('build_state_matrix')) == len(sent)
+
+
+def test_runner_pauses_resumes_and_stops():
+    protocol = virtual_protocol(MANY_TRIALS, seed=2)
+    sent = _record_sent(protocol)
+    runner = SessionRunner(protocol)
+
+    async def control():
+        session = asyncio.create_task(runner.run())
+        await _until(lambda: protocol.num_trials >= NUM_CONTROLLED_TRIALS)
+        assert runner.state == RUNNING
+        runner.pause()
+        await _until(lambda: runner.state == PAUSED)
+        # The running trial ends, no other starts
+        await _until(lambda: len(sent) == protocol.num_trials)
+        paused_trials = protocol.num_trials
+        await asyncio.sleep(0.05)
+        assert protocol.num_trials == len(sent) == paused_trials
+        # The trial prepared before the pause gets the update all the same
+        runner.update_parameters(feedback_delay_grace=FEEDBACK_DELAY_GRACE)
+        runner.resume()
+        await _until(lambda: protocol.num_trials >=
+                     paused_trials + NUM_CONTROLLED_TRIALS)
+        runner.stop()
+        await session
+        assert runner.state == STOPPED
+        return paused_trials
+
+    paused_trials = asyncio.run(control())
+    assert len(sent) == protocol.num_trials
+    state_timers, _ = sent[paused_trials]
+    sma = protocol._bpod._sma
+    assert state_timers[sma.state_names.index(
+        str(MatrixState.PunishGrace))] == FEEDBACK_DELAY_GRACE
+    pauses = protocol.data.timer.handle_pause[:protocol.num_trials]
+    assert [i_trial for i_trial, pause in enumerate(pauses) if pause] == \
+        [paused_trials]
+
+
+def test_runner_stops_while_paused():
+    protocol = virtual_protocol(MANY_TRIALS, seed=2)
+    runner = SessionRunner(protocol)
+
+    async def control():
+        session = asyncio.create_task(runner.run())
+        await _until(lambda: protocol.num_trials >= NUM_CONTROLLED_TRIALS)
+        runner.pause()
+        await _until(lambda: runner.state == PAUSED)
+        runner.stop()
+        await session
+
+    asyncio.run(control())
+    assert runner.state == STOPPED
+    assert protocol.num_trials < MANY_TRIALS
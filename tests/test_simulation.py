@@ -0,0 +1,63 @@
+import logging
+import math
+
+from mouse2afc.simulation import simulate
+from mouse2afc.simulation import virtual_protocol
+
+NUM_TRIALS = 100
+# The first of the numbers pybpod stands undeclared states for
+UNDECLARED_STATE = 10000
+
+
+def _session_end(raw_data, num_trials):
+    states = raw_data.states(num_trials - 1)
+    return raw_data.trial_start_timestamp(num_trials - 1) + \
+        states['end'][-1]
+
+
+def test_states_and_events_are_relative_to_trial_start():
+    data = simulate(NUM_TRIALS, seed=0)
+    raw_data = data.raw_data
+    for i_trial in range(1, NUM_TRIALS):
+        states = raw_data.states(i_trial)
+        assert states['start'][0] == 0
+        duration = raw_data.trial_start_timestamp(i_trial) - \
+            raw_data.trial_start_timestamp(i_trial - 1)
+        assert raw_data.states(i_trial - 1)['end'][-1] <= duration
+        assert (raw_data.events(i_trial)['time'] <= states['end'][-1]).all()
+        timestamps = raw_data.original_state_timestamps(i_trial)
+        assert timestamps[0] == 0
+        assert len(timestamps) == len(states) + 1
+
+
+def test_last_reward_is_delivered_before_the_session_ends():
+    data = simulate(NUM_TRIALS, seed=0)
+    ledger = data.custom.reward_ledger
+    assert ledger.last_time is not None
+    assert ledger.last_time <= _session_end(data.raw_data, NUM_TRIALS)
+
+
+def test_sent_matrices_have_their_states_resolved():
+    protocol = virtual_protocol(3, seed=0)
+    protocol.run()
+    sma = protocol._bpod._sma
+    # Nothing left for `update_state_numbers()` to scan when it's sent
+    assert sma.undeclared == []
+    transitions = [destination
+                   for matrix in (sma.input_matrix, sma.conditions.matrix,
+                                  sma.global_timers.start_matrix,
+                                  sma.global_timers.end_matrix)
+                   for row in matrix for _, destination in row]
+    transitions += sma.state_timer_matrix
+    assert transitions
+    assert all(destination < UNDECLARED_STATE for destination in transitions
+               if not math.isnan(destination))
+
+
+def test_states_waiting_on_unset_conditions_are_not_warned_of(caplog):
+    with caplog.at_level(logging.DEBUG, logger='mouse2afc.simulation'):
+        simulate(NUM_TRIALS, seed=0)
+    assert not [record for record in caplog.records
+                if record.levelno >= logging.WARNING]
+    assert any('Condition4' in record.getMessage()
+               for record in caplog.records)
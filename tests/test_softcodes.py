@@ -0,0 +1,91 @@
+import threading
+import time
+
+from mouse2afc.softcodes import SoftcodeDispatcher
+
+# How long the stub handler holds the worker
+BLOCK_S = 0.05
+
+
+class _StubHandler:
+    "Records the softcodes it's called for, holding the worker if asked"
+    def __init__(self, calls, name, hold=None):
+        self._calls = calls
+        self._name = name
+        self._hold = hold
+        self.started = threading.Event()
+
+    def __call__(self):
+        self._calls.append((self._name, threading.current_thread()))
+        self.started.set()
+        if self._hold is not None:
+            self._hold.wait()
+
+
+def test_handlers_run_in_order_on_the_worker():
+    calls = []
+    dispatcher = SoftcodeDispatcher()
+    dispatcher.register(1, _StubHandler(calls, 'first'))
+    dispatcher.register(1, _StubHandler(calls, 'second'))
+    dispatcher.register(2, _StubHandler(calls, 'other'))
+    dispatcher.register(2, _StubHandler(calls, 'inline'), inline=True)
+    dispatcher.start()
+    for softcode in (1, 2, 1):
+        dispatcher(softcode)
+    # Inline handlers run in the thread receiving the softcodes, as they're
+    # received
+    assert calls[0] == ('inline', threading.current_thread())
+    dispatcher.stop()
+    assert [name for name, _ in calls[1:]] == [
+        'first', 'second', 'other', 'first', 'second']
+    assert all(thread is not threading.current_thread()
+               for _, thread in calls[1:])
+
+
+def test_softcodes_received_while_the_queue_is_full_are_dropped():
+    calls = []
+    hold = threading.Event()
+    handler = _StubHandler(calls, 'held', hold)
+    dispatcher = SoftcodeDispatcher(queue_size=2)
+    dispatcher.register(1, handler)
+    dispatcher.start()
+    dispatcher(1)
+    assert handler.started.wait(1)
+    # The worker holds the first, the queue takes two more
+    for _ in range(4):
+        dispatcher(1)
+    assert dispatcher.dropped == 2
+    hold.set()
+    dispatcher.stop()
+    assert len(calls) == 3
+
+
+def test_waits_are_stamped_when_softcodes_are_received():
+    calls = []
+    hold = threading.Event()
+    handler = _StubHandler(calls, 'held', hold)
+    dispatcher = SoftcodeDispatcher()
+    dispatcher.register(1, handler)
+    dispatcher.start()
+    dispatcher(1)
+    assert handler.started.wait(1)
+    dispatcher(1)
+    time.sleep(BLOCK_S)
+    hold.set()
+    dispatcher.stop()
+    waits = dispatcher.latencies.durations('softcode1_wait')
+    assert len(waits) == 2
+    # The second waited in the queue for the first to be handled
+    assert waits[1] >= BLOCK_S
+    assert len(dispatcher.latencies.durations('softcode1_run')) == 2
+
+
+def test_handlers_run_inline_without_a_worker():
+    calls = []
+    dispatcher = SoftcodeDispatcher(worker=False)
+    dispatcher.register(3, _StubHandler(calls, 'handler'))
+    dispatcher.start()
+    dispatcher(3)
+    dispatcher(4)
+    assert calls == [('handler', threading.current_thread())]
+    dispatcher.stop()
@@ -0,0 +1,153 @@
+import math
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+from mouse2afc.data import Data
+from mouse2afc.definitions.experiment import ExperimentType
+from mouse2afc.definitions.feedback_delay_selection \
+    import FeedbackDelaySelection
+from mouse2afc.simulation import bpod_hardware
+from mouse2afc.simulation import virtual_protocol
+from mouse2afc.state_matrix import StateMatrix
+from mouse2afc.state_matrix import StateMatrixCache
+from mouse2afc.task_parameters import TaskParameters
+
+NUM_TRIALS = 100
+# The variants of a trial that have a state matrix of their own
+VARIANTS = [
+    {'left_rewarded': True},
+    {'left_rewarded': False},
+    {'catch_trial': True},
+    {'opto_enabled': True},
+    {'forced_led_trial': True},
+]
+
+
+def _run(pipelined):
+    """Returns the timers and outputs of the state matrices sent in a
+       session whose staircases move every trial, and the number of them
+       built between trials"""
+    protocol = virtual_protocol(
+        NUM_TRIALS, seed=3,
+        feedback_delay_selection=FeedbackDelaySelection.auto_incr,
+        stim_delay_auto_increment=1)
+    bpod = protocol._bpod
+    sent = []
+    send_state_machine = bpod.send_state_machine
+    build_state_matrix = protocol.build_state_matrix
+    builds = []
+
+    def recording_send(sma):
+        sent.append((list(sma.state_timers),
+                     list(sma.global_timers.timers),
+                     [list(outputs) for outputs in sma.output_matrix]))
+        send_state_machine(sma)
+
+    def recording_build(i_trial):
+        if threading.current_thread() is threading.main_thread():
+            builds.append(i_trial)
+        return build_state_matrix(i_trial)
+
+    bpod.send_state_machine = recording_send
+    protocol.build_state_matrix = recording_build
+    protocol.run(pipelined=pipelined)
+    return sent, len(builds), protocol.data.timer.latencies
+
+
+def test_pipelined_state_matrices_follow_the_staircases():
+    sent, _, _ = _run(pipelined=False)
+    pipelined_sent, rebuilds, _ = _run(pipelined=True)
+    assert pipelined_sent == sent
+    # The staircases alone don't have the prepared matrices rebuilt
+    assert rebuilds < NUM_TRIALS / 2
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_state_matrix_builds_are_timed_once_per_trial(pipelined):
+    sent, _, latencies = _run(pipelined)
+    assert len(latencies.durations('build_state_matrix')) == len(sent)
+    prepared = len(latencies.durations('prepare_state_matrix'))
+    if pipelined:
+        assert 0 < prepared < len(sent)
+    else:
+        assert prepared == 0
+
+
+def _trial(experiment_type, variant):
+    "Returns the task parameters and data of a trial, `variant` set on it"
+    task_parameters = TaskParameters(open_gui=False).task_parameters
+    omega_prob = task_parameters.omega_table.columns.omega_prob
+    task_parameters.omega_table.columns.omega_prob = [
+        prob / sum(omega_prob) for prob in omega_prob]
+    task_parameters.primary_experiment_type = experiment_type
+    data = Data(None, task_parameters, seed=0)
+    data.custom.assign_future_trials(0, 1)
+    data.custom.generate_next_trial(0)
+    trials = data.custom.trials
+    for name, value in variant.items():
+        getattr(trials, name)[0] = value
+    return task_parameters, data
+
+
+def _change_trial_values(task_parameters, data):
+    "Changes the values that don't have the template compiled again"
+    task_parameters.feedback_delay += 0.25
+    task_parameters.min_sample += 0.05
+    task_parameters.stim_delay += 0.1
+    trials = data.custom.trials
+    trials.reward_magnitude[0] = [value + 1 for value in
+                                  trials.reward_magnitude[0]]
+    trials.center_port_rew_amount[0] += 0.5
+    trials.light_intensity_left[0] += 10
+    trials.light_intensity_right[0] += 5
+    trials.DV[0] = -trials.DV[0] if trials.DV[0] else 0.5
+
+
+def _comparable(value):
+    "`value` with its NaNs, e.g. of undeclared states, comparing equal"
+    if isinstance(value, (list, tuple)):
+        return [_comparable(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _comparable(item) for key, item in value.items()}
+    if isinstance(value, float) and math.isnan(value):
+        return 'nan'
+    return value
+
+
+def _contents(sma):
+    "Everything the Bpod is sent of `sma`, along with its draw parameters"
+    sma.update_state_numbers()
+    contents = {}
+    for name, value in vars(sma).items():
+        # The names of the undeclared states, resolved once sent
+        if name in ('hardware', 'undeclared'):
+            continue
+        contents[name] = vars(value) if hasattr(value, '__dict__') \
+            else value
+    return _comparable(contents)
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+@pytest.mark.parametrize('experiment_type', list(ExperimentType))
+def test_cached_state_matrices_match_built_ones(experiment_type, variant):
+    bpod = SimpleNamespace(hardware=bpod_hardware(), session=None)
+    task_parameters, data = _trial(experiment_type, variant)
+    cache = StateMatrixCache(bpod)
+    compiled = cache.state_matrix(task_parameters, data, 0)
+    assert _contents(compiled) == _contents(
+        StateMatrix(bpod, task_parameters, data, 0))
+    # Only the values of the trial changed: a cache hit, patched or not
+    _change_trial_values(task_parameters, data)
+    expected = _contents(StateMatrix(bpod, task_parameters, data, 0))
+    assert _contents(cache.state_matrix(task_parameters, data, 0)) == \
+        expected
+    assert len(cache._templates) == 1
+    prepared = cache.state_matrix(task_parameters, data, 0)
+    task_parameters.feedback_delay += 0.5
+    task_parameters.min_sample += 0.05
+    task_parameters.stim_delay += 0.1
+    assert _contents(cache.patch(prepared, task_parameters, data, 0)) == \
+        _contents(StateMatrix(bpod, task_parameters, data, 0))
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import signal
+import time
+import urllib.error
+import urllib.request
+
+from mouse2afc.session_file import SessionReader
+from mouse2afc.supervisor import FAILED
+from mouse2afc.supervisor import FINISHED
+from mouse2afc.supervisor import RUNNING
+from mouse2afc.supervisor import Supervisor
+from mouse2afc.task_parameters import TaskParameters
+
+# Of a session only the test ends
+MANY_TRIALS = 10 ** 6
+NUM_TRIALS = 5
+REPORT_INTERVAL = 0.05
+TIMEOUT_S = 60
+
+
+def _get_health(supervisor):
+    "Returns the status and the json of the health endpoint"
+    _, port = supervisor.health_address
+    try:
+        with urllib.request.urlopen(
+                f'http://127.0.0.1:{port}/health') as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as response:
+        return response.code, json.load(response)
+
+
+def _until(supervisor, condition):
+    "Returns the rigs' health once `condition(health)`"
+    deadline = time.monotonic() + TIMEOUT_S
+    while time.monotonic() < deadline:
+        health = supervisor.health()
+        if condition(health['rigs']):
+            return health
+        time.sleep(REPORT_INTERVAL)
+    raise AssertionError(f'The rigs did not get there in time: {health}')
+
+
+def test_crashed_rigs_are_restarted(tmp_path):
+    rig = {'name': 'box', 'virtual_trials': MANY_TRIALS, 'seed': 1,
+           'session_path': str(tmp_path / 'session')}
+    supervisor = Supervisor([rig], log_dir=str(tmp_path), health_port=0,
+                            report_interval=REPORT_INTERVAL, max_restarts=1)
+    with supervisor:
+        health = _until(supervisor, lambda rigs: rigs['box']['num_trials'])
+        pid = health['rigs']['box']['pid']
+        assert _get_health(supervisor)[0] == 200
+        os.kill(pid, signal.SIGKILL)
+        health = _until(supervisor, lambda rigs: rigs['box']['restarts'] and
+                        rigs['box']['num_trials'])
+        box = health['rigs']['box']
+        assert box['state'] == RUNNING
+        assert box['pid'] != pid
+        assert box['error'] == f'Exited with code {-signal.SIGKILL}'
+        status, body = _get_health(supervisor)
+        assert status == 200
+        assert body['healthy']
+        assert body['rigs']['box']['restarts'] == 1
+    # The restarted session is saved next to the one that crashed
+    assert not SessionReader(str(tmp_path / 'session-restart1')).complete
+    assert os.path.exists(tmp_path / 'box.log')
+
+
+def test_rigs_out_of_restarts_fail(tmp_path):
+    # Sessions already there can't be saved to: every session fails
+    for path in ('session', 'session-restart1'):
+        supervisor = Supervisor(
+            [{'name': 'first', 'virtual_trials': NUM_TRIALS,
+              'session_path': str(tmp_path / path)}],
+            log_dir=str(tmp_path))
+        supervisor.start()
+        supervisor.wait(REPORT_INTERVAL)
+        supervisor.stop()
+    rigs = [{'name': 'box', 'virtual_trials': NUM_TRIALS,
+             'session_path': str(tmp_path / 'session')},
+            {'name': 'other', 'virtual_trials': NUM_TRIALS}]
+    supervisor = Supervisor(rigs, log_dir=str(tmp_path), health_port=0,
+                            report_interval=REPORT_INTERVAL, max_restarts=1)
+    with supervisor:
+        health = supervisor.wait(REPORT_INTERVAL)
+        box = health['rigs']['box']
+        assert box['state'] == FAILED
+        assert box['restarts'] == 1
+        assert 'already holds a session' in box['error']
+        assert health['rigs']['other']['state'] == FINISHED
+        assert health['rigs']['other']['num_trials'] == NUM_TRIALS
+        status, body = _get_health(supervisor)
+        assert status == 503
+        assert not body['healthy']
+        assert body['rigs']['box']['state'] == FAILED
+
+
+def test_rigs_are_given_the_validated_parameters(tmp_path):
+    config_file = tmp_path / 'parameters.py'
+    shutil.copy(TaskParameters._default_file, config_file)
+    supervisor = Supervisor(
+        [{'name': 'box', 'virtual_trials': NUM_TRIALS,
+          'config_file': str(config_file)}],
+        log_dir=str(tmp_path), max_restarts=0)
+    # Loaded once, the rigs never read the file
+    os.remove(config_file)
+    supervisor.start()
+    health = supervisor.wait(REPORT_INTERVAL)
+    supervisor.stop()
+    assert health['rigs']['box']['state'] == FINISHED
+    assert health['rigs']['box']['num_trials'] == NUM_TRIALS
@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from mouse2afc import task_parameters as task_parameters_module
+from mouse2afc.task_parameters import TaskParameters
+from mouse2afc.task_parameters import TaskParametersError
+from mouse2afc.task_parameters import load_snapshot
+
+
+@pytest.fixture
+def executions(monkeypatch):
+    "The paths of the parameters files executed, the defaults included"
+    executed = []
+    exec_parameters_file = task_parameters_module._exec_parameters_file
+
+    def recording_exec(file_):
+        executed.append(file_)
+        return exec_parameters_file(file_)
+
+    monkeypatch.setattr(task_parameters_module, '_exec_parameters_file',
+                        recording_exec)
+    return executed
+
+
+def _edit(file_, old, new, mtime_ns):
+    with open(file_) as parameters:
+        contents = parameters.read()
+    with open(file_, 'w') as parameters:
+        parameters.write(contents.replace(old, new))
+    os.utime(file_, ns=(mtime_ns, mtime_ns))
+
+
+def test_snapshots_are_loaded_again_once_changed(tmp_path, executions):
+    file_ = str(tmp_path / 'parameters.py')
+    shutil.copy(TaskParameters._default_file, file_)
+    mtime_ns = os.stat(file_).st_mtime_ns
+    snapshot = load_snapshot(file_)
+    snapshot['stim_delay_max'] = 5
+    # A copy of the cached snapshot, the modified one isn't
+    assert load_snapshot(file_)['stim_delay_max'] == 0
+    assert executions.count(file_) == 1
+    # Same size, changed time
+    _edit(file_, 'stim_delay_max = 0', 'stim_delay_max = 1', mtime_ns + 1)
+    assert load_snapshot(file_)['stim_delay_max'] == 1
+    # Same time, changed size
+    _edit(file_, 'stim_delay_max = 1', 'stim_delay_max = 10', mtime_ns + 1)
+    assert load_snapshot(file_)['stim_delay_max'] == 10
+    assert executions.count(file_) == 3
+    assert TaskParameters(file_, open_gui=False).task_parameters \
+        .stim_delay_max == 10
+    assert executions.count(file_) == 3
+
+
+def test_invalid_parameters_files_are_rejected(tmp_path):
+    file_ = str(tmp_path / 'parameters.py')
+    shutil.copy(TaskParameters._default_file, file_)
+    _edit(file_, 'stim_delay_max = 0\n', '', os.stat(file_).st_mtime_ns)
+    with pytest.raises(TaskParametersError, match='stim_delay_max'):
+        load_snapshot(file_)
+
+
+def test_headless_parameters_dont_import_the_gui():
+    code = ('import sys\n'
+            'from mouse2afc.task_parameters import TaskParameters\n'
+            'TaskParameters(open_gui=False)\n'
+            'print(sorted(name for name in sys.modules\n'
+            "             if name.startswith(('AnyQt', 'mouse2afc.task_"
+            "parameters_gui'))))\n")
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+    assert output.strip() == '[]'
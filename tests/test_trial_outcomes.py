@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pybpodapi.com.messaging.trial import Trial
+from pybpodapi.session import Session
+
+from mouse2afc.data import Data
+from mouse2afc.definitions.matrix_state import MatrixState
+from mouse2afc.task_parameters import TaskParameters
+
+STATE_NAMES = [str(matrix_state) for matrix_state in MatrixState]
+# A trial rewarded after a wrong first choice, as the Habituate Ignore
+# Incorrect trials go: it waits for a choice twice
+PATH = [MatrixState.WaitForCenterPoke, MatrixState.TriggerWaitForStimulus,
+        MatrixState.WaitForStimulus, MatrixState.StimulusDelivery,
+        MatrixState.WaitCenterPortOut, MatrixState.WaitForChoice,
+        MatrixState.RegisterWrongWaitCorrect, MatrixState.WaitForChoice,
+        MatrixState.WaitForRewardStart, MatrixState.WaitForReward,
+        MatrixState.Reward, MatrixState.ITI]
+STATE_DURATION = 0.5
+NUM_TRIALS = 3
+
+
+class _Session(Session):
+    "pybpod's session, without its output streams"
+    def __init__(self):
+        self.history = []
+        self.trials = []
+        self.csvwriter = None
+
+    def __del__(self):
+        pass
+
+
+def _run_trial(session, path):
+    "Adds a trial going through the states `path` to `session`"
+    sma = SimpleNamespace(state_names=list(STATE_NAMES),
+                          total_states_added=len(STATE_NAMES))
+    session += Trial(sma)
+    trial = session.current_trial
+    trial.bpod_start_timestamp = 0
+    trial.trial_start_timestamp = 0
+    trial.states = [STATE_NAMES.index(str(state)) for state in path]
+    trial.state_timestamps = [i_state * STATE_DURATION
+                              for i_state in range(len(path) + 1)]
+    trial.event_timestamps = []
+    trial.trial_end_timestamp = trial.state_timestamps[-1]
+    session.add_trial_events()
+
+
+def _data(**task_parameters):
+    parameters = TaskParameters(open_gui=False).task_parameters
+    parameters.update(task_parameters)
+    data = Data(_Session(), parameters)
+    data.custom.assign_future_trials(0, NUM_TRIALS)
+    return data
+
+
+def _update(data, i_trial, catch_trial=False):
+    "Runs `i_trial` through `PATH` and updates the data with it"
+    data.custom.generate_next_trial(i_trial)
+    data.custom.trials.catch_trial[i_trial] = catch_trial
+    _run_trial(data.raw_data._session, PATH)
+    data.custom.update(i_trial)
+
+
+def test_movement_time_is_stored_at_its_trial():
+    data = _data(habituate_ignore_incorrect=True)
+    for i_trial in range(NUM_TRIALS):
+        _update(data, i_trial)
+        # From the first choice to the second
+        assert data.custom.trials.mt[i_trial] == \
+            pytest.approx(2 * STATE_DURATION)
+
+
+def test_rewarded_trials_are_the_non_catch_ones():
+    data = _data()
+    _update(data, 0, catch_trial=True)
+    _update(data, 1)
+    trials = data.custom.trials
+    assert not trials.rewarded[0]
+    assert trials.rewarded[1]
+    assert trials.reward_received_total[1] > \
+        trials.reward_received_total[0]